@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+""" End-to-end rollout benchmark
+
+Runs pan-dyn-update.py in a temporary folder against N mock devices from
+bench/mockpanos.py, and reports wall time, CPU time, peak RSS of the script,
+and API calls and bytes received by the mock devices. Each repeat starts with
+fresh mock devices and no state files, and the median of the repeats is shown.
+Results can be saved, and compared with a saved baseline to catch regressions.
+
+Usage: python bench/bench_rollout.py [-n DEVICES] [-r REPEATS] [--save FILE] [--baseline FILE] [-- script arguments]
+"""
+from os import path
+import os
+import sys
+import json
+import time
+import shutil
+import tarfile
+import tempfile
+import argparse
+import subprocess
+
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+import mockpanos
+
+SCRIPT = path.join(path.dirname(path.abspath(__file__)), "..", "pan-dyn-update.py")
+# Content file for each type, newer than the versions on mock devices
+CONTENT_FILES = {
+    "appthreat": ("panupv2-all-contents", "panupv2-all-contents-600-3500"),
+    "antivirus": ("panup-all-antivirus", "panup-all-antivirus-2500-3000"),
+    "wildfire2": ("panupv2-all-wildfire", "panupv2-all-wildfire-120000-123000"),
+}
+STATE_FILES = ["content-index.json", "inventory.json", "history.json", "breaker.json", "validation.json", "results.jsonl", "log.txt"]
+# Results compared with baseline. Higher is worse for all of them
+METRICS = ["wall", "cpu", "peak_rss_mb", "api_calls", "bytes_sent"]
+
+
+def write_content_file(filepath, size):
+    # Gzipped tar archive of about size bytes, as content files are. Random data, so it doesn't compress.
+    datafile = filepath + ".data"
+    with open(datafile, "wb") as f:
+        f.write(os.urandom(size))
+    with tarfile.open(filepath, "w:gz") as archive:
+        archive.add(datafile, arcname="content.bin")
+    os.remove(datafile)
+
+
+def prepare(workdir, types, size, devices):
+    # Content files, config.conf and devices.conf in workdir
+    for content_type in types:
+        folder, name = CONTENT_FILES[content_type]
+        if not path.isdir(path.join(workdir, folder)): os.mkdir(path.join(workdir, folder))
+        write_content_file(path.join(workdir, folder, name), size)
+    with open(path.join(workdir, "config.conf"), "w") as f:
+        f.write("apikey=benchkey\nsmtphost=localhost\nsmtpport=25\nsmtpsender=bench@localhost\nsmtpreceiver=bench@localhost\n")
+        # Mock devices read SCP imports from local path, so workdir is the SCP server path
+        f.write("scphost=127.0.0.1\nscpuser=bench\nscppass=bench\nscppath=%s\n" % (workdir))
+    with open(path.join(workdir, "devices.conf"), "w") as f:
+        for device in devices:
+            line = mockpanos.devices_line(device)
+            if line is not None: f.write("%s\n" % (line))
+    for name in STATE_FILES:
+        if path.exists(path.join(workdir, name)): os.remove(path.join(workdir, name))
+
+
+def run_once(args, workdir, certfile, keyfile):
+    fleet = mockpanos.MockFleet(args.devices, args, certfile, keyfile)
+    try:
+        prepare(workdir, args.types, args.file_size * 1024, fleet.devices)
+        cmd = [sys.executable, path.abspath(SCRIPT), "-v", "-t", ",".join(args.types)] + args.script_args
+        with open(path.join(workdir, "output.txt"), "w") as output:
+            start = time.time()
+            process = subprocess.Popen(cmd, cwd=workdir, stdout=output, stderr=subprocess.STDOUT)
+            # wait4 gives resource usage of this child only
+            pid, status, usage = os.wait4(process.pid, 0)
+            wall = time.time() - start
+        process.returncode = status
+        stats = fleet.stats()
+    finally:
+        fleet.stop()
+    with open(path.join(workdir, "output.txt"), "r") as f:
+        lines = f.read().splitlines()
+    results = {}
+    for line in lines:
+        prefix = line.split(":")[0]
+        if prefix in ("SUCCESS", "SKIPPED", "ERROR", "UNKNOWN", "ABORTED"): results[prefix] = results.get(prefix, 0) + 1
+    maxrss = usage.ru_maxrss / 1024.0  # kB on Linux
+    if sys.platform == "darwin": maxrss = usage.ru_maxrss / 1024.0 / 1024.0
+    return {
+        "wall": wall,
+        "cpu": usage.ru_utime + usage.ru_stime,
+        "peak_rss_mb": maxrss,
+        "api_calls": stats["api_calls"],
+        "bytes_sent": stats["bytes_received"],
+        "uploads": stats["uploads"],
+        "ha_overlaps": stats["ha_overlaps"],
+        "calls": stats["calls"],
+        "results": results,
+        "exit_status": status,
+    }
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2: return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def compare(result, baseline, tolerance):
+    # Returns metrics more than tolerance percent worse than baseline
+    regressions = []
+    for metric in METRICS:
+        if not baseline.get(metric): continue
+        change = (result[metric] - baseline[metric]) * 100.0 / baseline[metric]
+        print "%-12s %12.2f %12.2f %+8.1f%%" % (metric, baseline[metric], result[metric], change)
+        if change > tolerance: regressions.append(metric)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run pan-dyn-update.py against mock PAN-OS devices and measure it")
+    parser.add_argument("-n", "--devices", type=int, default=20, help="Number of mock devices. Defaults to 20")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Runs to take median of. Defaults to 3")
+    parser.add_argument("-t", "--types", default="appthreat", help="Content types, comma separated. Defaults to appthreat")
+    parser.add_argument("--file-size", type=int, default=1024, metavar="KB", help="Size of each content file in kB. Defaults to 1024")
+    parser.add_argument("--save", metavar="FILE", help="Save median results as JSON")
+    parser.add_argument("--baseline", metavar="FILE", help="Compare with results saved with --save. Exit status is 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=10.0, metavar="PERCENT", help="Allowed increase from baseline. Defaults to 10")
+    parser.add_argument("--keep", action="store_true", help="Keep temporary folder with output.txt and log.txt of last run")
+    parser.add_argument("script_args", nargs="*", help="Arguments for pan-dyn-update.py, after --. For example: -- -w -p 8")
+    mockpanos.add_options(parser)
+    args = parser.parse_args()
+    mockpanos.check_options(parser, args)
+    args.types = [content_type.strip() for content_type in args.types.split(",")]
+    for content_type in args.types:
+        if content_type not in CONTENT_FILES: parser.error("Supported types: %s" % (", ".join(sorted(CONTENT_FILES))))
+    workdir = tempfile.mkdtemp(prefix="bench-rollout-")
+    try:
+        certfile, keyfile = path.join(workdir, "cert.pem"), path.join(workdir, "key.pem")
+        mockpanos.make_certificate(certfile, keyfile)
+        runs = []
+        for i in range(args.repeat):
+            run = run_once(args, workdir, certfile, keyfile)
+            runs.append(run)
+            print "run %s: %.2fs wall, %.2fs cpu, %.1f MB peak RSS, %s API calls, %s bytes sent, results %s" % (
+                i + 1, run["wall"], run["cpu"], run["peak_rss_mb"], run["api_calls"], run["bytes_sent"], run["results"])
+            if args.ha_pairs: print "       %s install jobs started while HA peer was installing" % (run["ha_overlaps"])
+            if run["exit_status"]: print "pan-dyn-update.py exited with status %s" % (run["exit_status"])
+        result = dict((metric, median([run[metric] for run in runs])) for metric in METRICS)
+        result["devices"] = args.devices
+        result["calls"] = runs[-1]["calls"]
+        print
+        print "%s devices, %s x %s kB, arguments: %s" % (args.devices, len(args.types), args.file_size, " ".join(args.script_args))
+        for metric in METRICS: print "%-12s %12.2f" % (metric, result[metric])
+        for call, number in sorted(result["calls"].items()): print "  %-40s %8s" % (call, number)
+        if args.save:
+            with open(args.save, "w") as f:
+                json.dump(result, f, indent=1, sort_keys=True)
+        if args.baseline:
+            with open(args.baseline, "r") as f:
+                baseline = json.load(f)
+            print
+            print "%-12s %12s %12s %9s" % ("metric", "baseline", "now", "change")
+            regressions = compare(result, baseline, args.tolerance)
+            if regressions:
+                print "Regression in %s (tolerance %s%%)" % (", ".join(regressions), args.tolerance)
+                sys.exit(1)
+    finally:
+        if args.keep: print "Output kept in %s" % (workdir)
+        else: shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+""" Startup time benchmark
+
+Measures wall time of pan-dyn-update.py for -h, and for a no-op run where every
+device is skipped from a fresh inventory cache (no API calls). These are the
+runs done many times an hour from cron and health checks, so their time is
+mostly interpreter start and imports. Modules that are slow to load and should
+only be imported when used (SMTP, XML parser, HTTP server, ctypes,
+multiprocessing) are listed when a case loads them.
+Results can be saved, and compared with a saved baseline or an absolute budget.
+
+Usage: python bench/bench_startup.py [-r REPEATS] [--budget MS] [--save FILE] [--baseline FILE]
+"""
+from os import path
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import subprocess
+
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+from bench_rollout import median
+from bench_rollout import write_content_file
+
+SCRIPT = path.join(path.dirname(path.abspath(__file__)), "..", "pan-dyn-update.py")
+CONTENT_FOLDER, CONTENT_FILE = "panupv2-all-contents", "panupv2-all-contents-600-3500"
+# Modules that should not be loaded by -h or a no-op run
+HEAVY_MODULES = ["smtplib", "email", "lxml", "_elementtree", "pyexpat", "BaseHTTPServer", "ctypes", "multiprocessing", "uuid", "tarfile", "sqlite3"]
+
+
+def prepare(workdir, devices):
+    # Content file, config and devices, with inventory cache showing every device already has the file
+    os.mkdir(path.join(workdir, CONTENT_FOLDER))
+    write_content_file(path.join(workdir, CONTENT_FOLDER, CONTENT_FILE), 4096)
+    with open(path.join(workdir, "config.conf"), "w") as f:
+        f.write("apikey=benchkey\nsmtphost=localhost\nsmtpport=25\nsmtpsender=bench@localhost\nsmtpreceiver=bench@localhost\n")
+    inventory = {}
+    with open(path.join(workdir, "devices.conf"), "w") as f:
+        for i in range(devices):
+            hostname = "192.0.2.%s" % (i % 250 + 1)
+            if i >= 250: hostname += ":%s" % (10000 + i)
+            f.write("%s,fw%03d\n" % (hostname, i + 1))
+            inventory[hostname] = {"app_version": "600-3500", "threat_version": "600-3500", "av_version": "2500-3000",
+                                   "wf_version": "120000-123000", "model": "PA-220", "timestamp": time.time() + 3600}
+    with open(path.join(workdir, "inventory.json"), "w") as f:
+        json.dump(inventory, f)
+
+
+def cases(workdir):
+    # Name and arguments of each measured run. The devices don't exist, so noop is only fast when devices skipped
+    # from the inventory cache are not probed.
+    return [
+        ("help", ["-h"]),
+        ("noop", ["-t", "appthreat"]),
+    ]
+
+
+def run(cmd, workdir):
+    start = time.time()
+    with open(os.devnull, "w") as devnull:
+        status = subprocess.call(cmd, cwd=workdir, stdout=devnull, stderr=devnull)
+    return time.time() - start, status
+
+
+def imported_modules(cmd, workdir):
+    # Top level modules imported by run, from python -v
+    process = subprocess.Popen([cmd[0], "-v"] + cmd[1:], cwd=workdir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output = process.communicate()[1]
+    return set(name.split(".")[0] for name in re.findall(r"^import (\S+) #", output, re.M))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure startup time of pan-dyn-update.py for -h and a no-op run")
+    parser.add_argument("-r", "--repeat", type=int, default=10, help="Runs of each case to take median of. Defaults to 10")
+    parser.add_argument("-n", "--devices", type=int, default=50, help="Devices in no-op run. Defaults to 50")
+    parser.add_argument("--budget", type=float, metavar="MS", help="Exit status is 1 if median of any case is above MS milliseconds")
+    parser.add_argument("--save", metavar="FILE", help="Save median results as JSON")
+    parser.add_argument("--baseline", metavar="FILE", help="Compare with results saved with --save. Exit status is 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=20.0, metavar="PERCENT", help="Allowed increase from baseline. Defaults to 20")
+    args = parser.parse_args()
+    workdir = tempfile.mkdtemp(prefix="bench-startup-")
+    failed = []
+    try:
+        prepare(workdir, args.devices)
+        result = {}
+        print "%-8s %10s %10s %8s  %s" % ("case", "median ms", "min ms", "modules", "heavy modules loaded")
+        for name, arguments in cases(workdir):
+            cmd = [sys.executable, path.abspath(SCRIPT)] + arguments
+            times = []
+            for i in range(args.repeat):
+                seconds, status = run(cmd, workdir)
+                if status: print "%s exited with status %s" % (name, status)
+                times.append(seconds * 1000)
+            modules = imported_modules(cmd, workdir)
+            heavy = [module for module in HEAVY_MODULES if module in modules]
+            result[name] = median(times)
+            result["%s_modules" % (name)] = len(modules)
+            print "%-8s %10.1f %10.1f %8s  %s" % (name, median(times), min(times), len(modules), ", ".join(heavy) or "-")
+            if args.budget is not None and median(times) > args.budget: failed.append("%s above budget of %s ms" % (name, args.budget))
+        if args.save:
+            with open(args.save, "w") as f:
+                json.dump(result, f, indent=1, sort_keys=True)
+        if args.baseline:
+            with open(args.baseline, "r") as f:
+                baseline = json.load(f)
+            print
+            print "%-14s %12s %12s %9s" % ("metric", "baseline", "now", "change")
+            for metric in sorted(result):
+                if not baseline.get(metric): continue
+                change = (result[metric] - baseline[metric]) * 100.0 / baseline[metric]
+                print "%-14s %12.1f %12.1f %+8.1f%%" % (metric, baseline[metric], result[metric], change)
+                if change > args.tolerance: failed.append("%s regressed (tolerance %s%%)" % (metric, args.tolerance))
+    finally:
+        shutil.rmtree(workdir)
+    if failed:
+        for message in failed: print message
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+""" Microbenchmark for parse.XmlReader
+
+Parses recorded PAN-OS API responses in bench/responses with parse.XmlReader,
+and with the BeautifulSoup based reader it replaced (when bs4 is installed).
+Checks that both readers return the same results, and prints time per call.
+
+Usage: python bench/bench_xmlreader.py [-n ITERATIONS]
+"""
+from os import path
+import os
+import sys
+import timeit
+import argparse
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), ".."))
+import parse
+
+RESPONSES = path.join(path.dirname(path.abspath(__file__)), "responses")
+
+# Response file and reader methods called on it - as used by pancom.py and jobs.py
+CASES = [
+    ("system_info.xml", ["find_content_versions", "find_model"]),
+    ("install_started.xml", ["find_jobid"]),
+    ("job_active.xml", ["find_status", "find_jobs"]),
+    ("job_fin_nextjob.xml", ["find_status", "findnextjobid", "find_jobs"]),
+    ("show_jobs_all.xml", ["find_status", "find_jobs"]),
+    ("devices_connected.xml", ["find_serial"]),
+]
+
+
+class SoupXmlReader(object):
+    # Reference implementation - the BeautifulSoup reader used before parse.XmlReader moved to ElementTree
+    def __init__(self, content):
+        from bs4 import BeautifulSoup
+        self.soup = BeautifulSoup(content, "lxml-xml")
+
+    def find_serial(self, searchstring):
+        return [str(tags['name']) for tags in self.soup.find_all(searchstring)]
+
+    def find_jobid(self):
+        return self.soup.find('job').text
+
+    def findnextjobid(self):
+        return self.soup.find('nextjob').text
+
+    def find_status(self):
+        for tags in self.soup.find_all('job'):
+            for statustag in tags('status'): status = statustag.text
+            for progresstag in tags('progress'): progress = progresstag.text
+        return status, progress
+
+    def find_model(self):
+        return self.soup.find('model').text
+
+    def find_jobs(self):
+        jobs = []
+        for tags in self.soup.find_all('job'):
+            if tags.find('id') is None: continue
+            job = {}
+            for field in ('id', 'status', 'progress', 'result', 'nextjob'):
+                tag = tags.find(field)
+                if tag is None: job[field] = None
+                else: job[field] = tag.text.strip()
+            job['details'] = " ".join(line.text.strip() for line in tags.find_all('line'))
+            jobs.append(job)
+        return jobs
+
+    def find_content_versions(self):
+        for tags in self.soup.find_all('system'):
+            for version in tags('threat-version'): threat_version = version.text
+            for version in tags('app-version'): app_version = version.text
+            for version in tags('av-version'): av_version = version.text
+            for version in tags('wildfire-version'): wf_version = version.text
+        return app_version, threat_version, av_version, wf_version
+
+
+def call(reader_class, content, method):
+    reader = reader_class(content)
+    if method == "find_serial": return getattr(reader, method)("entry")
+    return getattr(reader, method)()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare XmlReader with the BeautifulSoup reader on recorded PAN-OS responses")
+    parser.add_argument("-n", type=int, default=2000, help="Iterations per case. Defaults to 2000")
+    args = parser.parse_args()
+    readers = [("etree", parse.XmlReader)]
+    try:
+        import bs4
+        readers.append(("bs4", SoupXmlReader))
+    except ImportError:
+        print "bs4 not installed - timing XmlReader only"
+    print "XmlReader backend: %s" % (parse._etree().__name__)
+    print "%-24s %-22s %12s %12s %8s" % ("response", "method", "etree us", "bs4 us", "speedup")
+    mismatches = 0
+    for filename, methods in CASES:
+        with open(path.join(RESPONSES, filename), "r") as f:
+            content = f.read()
+        for method in methods:
+            results = {}
+            timings = {}
+            for name, reader_class in readers:
+                results[name] = call(reader_class, content, method)
+                seconds = timeit.timeit(lambda: call(reader_class, content, method), number=args.n)
+                timings[name] = seconds / args.n * 1e6
+            if "bs4" in results and results["bs4"] != results["etree"]:
+                mismatches += 1
+                print "MISMATCH %s %s: etree=%r bs4=%r" % (filename, method, results["etree"], results["bs4"])
+            if "bs4" in timings:
+                print "%-24s %-22s %12.1f %12.1f %7.1fx" % (filename, method, timings["etree"], timings["bs4"], timings["bs4"] / timings["etree"])
+            else:
+                print "%-24s %-22s %12.1f %12s %8s" % (filename, method, timings["etree"], "-", "-")
+    if mismatches: sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,443 @@
+#!/usr/bin/env python
+""" Mock PAN-OS XML API server
+
+Simulates a number of PAN-OS devices, each on its own HTTPS port on localhost.
+Serves the API calls used by pancom.py and jobs.py:
+show system info, show high-availability state, type=import, scp import <type>,
+request <type> upgrade info, request <type> upgrade install and show jobs id/all. SCP imports read the file
+from the local path in the command, as if the SCP server was on this host. Latency, upload bandwidth, job duration,
+nextjob chains and failures can be set, and API calls and bytes received are
+counted per device. With --ha-pairs, devices are active/passive pairs, and install
+jobs started on a device while its peer is installing are counted as overlaps.
+With --panorama, the first device is a Panorama managing all the others. It
+serves show devices connected with the versions of the managed firewalls, and
+request batch <type> upload-install jobs that install a file uploaded to Panorama
+on the firewalls listed. Only Panorama is listed in devices.conf.
+Used by bench/bench_rollout.py, and can be run on its own.
+
+Usage: python bench/mockpanos.py [-n DEVICES] [--base-port PORT] [--cert FILE --key FILE] [options]
+"""
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
+from xml.etree import cElementTree as etree
+from os import path
+import os
+import sys
+import ssl
+import socket
+import time
+import random
+import urlparse
+import argparse
+import threading
+import subprocess
+
+
+# Content versions installed on devices when mock starts
+VERSIONS = {"content": "595-3465", "anti-virus": "2453-2943", "wildfire": "118130-120972"}
+# Fields in show system info for each API category
+VERSION_FIELDS = {"content": ["app-version", "threat-version"], "anti-virus": ["av-version"], "wildfire": ["wildfire-version"]}
+CHUNK_SIZE = 64 * 1024
+
+
+def make_certificate(certfile, keyfile):
+    # Self signed certificate for mock servers, made with openssl
+    with open(os.devnull, "w") as devnull:
+        subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "30",
+                               "-subj", "/CN=mockpanos", "-keyout", keyfile, "-out", certfile], stdout=devnull, stderr=devnull)
+
+
+def escape(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+class MockJob(object):
+    def __init__(self, jobid, duration, category, file, chain, fail):
+        self.id = jobid
+        self.started = time.time()
+        self.duration = duration
+        self.category = category
+        self.file = file
+        self.chain = chain  # Job ids following this one
+        self.fail = fail
+        self.applied = False  # Version of file set as installed
+        self.action = "install"  # "import" for SCP import jobs, "batch" for install on firewalls managed by Panorama
+        self.serials = []  # Firewalls of batch job
+
+
+class MockDevice(object):
+    def __init__(self, name, serial, options, seed):
+        self.name = name
+        self.serial = serial
+        self.options = options
+        self.model = options.model
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.versions = dict(VERSIONS)
+        self.files = dict((category, set()) for category in VERSIONS)
+        self.jobs = {}
+        self.next_jobid = 1
+        self.calls = {}  # API calls by command
+        self.bytes_received = 0
+        self.uploads = 0
+        self.ha_group = None  # Set with --ha-pairs
+        self.ha_state = None
+        self.peer = None
+        self.overlaps = 0  # Install jobs started while peer was installing
+        self.managed = []  # Firewalls managed by this device, set for Panorama with --panorama
+        self.panorama = None  # Panorama managing this firewall
+
+
+    def count(self, call, size):
+        with self.lock:
+            self.calls[call] = self.calls.get(call, 0) + 1
+            self.bytes_received += size
+
+
+    def failing(self, rate):
+        with self.lock:
+            return self.random.random() < rate
+
+
+    def import_file(self, category, filename):
+        with self.lock:
+            self.files.setdefault(category, set()).add(filename)
+            self.uploads += 1
+
+
+    def installing(self):
+        # True while an install job, or a job chained after it, is running
+        now = time.time()
+        with self.lock:
+            for job in self.jobs.values():
+                if job.action == "install" and job.started <= now < job.started + job.duration: return True
+        return False
+
+
+    def start_install(self, category, filename, serials=None):
+        # Install job, followed by options.nextjobs chained jobs. Returns first job id
+        # serials - firewalls to install on, for batch job on Panorama
+        if self.peer is not None and self.peer.installing():
+            with self.lock: self.overlaps += 1
+        with self.lock:
+            jobids = range(self.next_jobid, self.next_jobid + 1 + self.options.nextjobs)
+            self.next_jobid += len(jobids)
+            fail = self.random.random() < self.options.fail_install
+        for i, jobid in enumerate(jobids):
+            # Chained jobs start when the job before is done
+            job = MockJob(jobid, self.options.job_duration, category, filename, jobids[i + 1:], fail and i == len(jobids) - 1)
+            job.started += i * self.options.job_duration
+            if serials is not None: job.action, job.serials = "batch", serials
+            with self.lock: self.jobs[jobid] = job
+        return jobids[0]
+
+
+    def start_import(self, category, filename, size):
+        # SCP import job, taking size/bandwidth seconds, or job duration with unlimited bandwidth. Returns job id
+        if self.options.bandwidth: duration = size / self.options.bandwidth
+        else: duration = self.options.job_duration
+        with self.lock:
+            jobid = self.next_jobid
+            self.next_jobid += 1
+            job = MockJob(jobid, duration, category, filename, [], self.random.random() < self.options.fail_upload)
+            job.action = "import"
+            self.jobs[jobid] = job
+            self.bytes_received += size
+        return jobid
+
+
+    def update_versions(self):
+        # Installed versions change when last job in a chain has completed, whether it is polled or not
+        now = time.time()
+        batches = []
+        with self.lock:
+            for job in self.jobs.values():
+                if job.applied or job.fail or job.chain or now < job.started + job.duration: continue
+                job.applied = True
+                if job.action == "import":
+                    self.files.setdefault(job.category, set()).add(job.file)
+                    self.uploads += 1
+                elif job.action == "batch": batches.append(job)
+                elif job.category in self.versions: self.versions[job.category] = "-".join(job.file.split('-')[3:5])
+        # Installed on managed firewalls. Panorama lock is not held, so firewalls are never locked inside it.
+        for job in batches:
+            for device in self.managed:
+                if device.serial not in job.serials: continue
+                with device.lock:
+                    device.uploads += 1
+                    if job.category in device.versions: device.versions[job.category] = "-".join(job.file.split('-')[3:5])
+
+
+    def job_xml(self, job):
+        elapsed = time.time() - job.started
+        if elapsed < 0: status, progress, result = "PEND", 0, "PEND"
+        elif elapsed < job.duration: status, progress, result = "ACT", int(elapsed * 100 / job.duration), "PEND"
+        else:
+            status, progress = "FIN", 100
+            if job.fail: result = "FAIL"
+            else: result = "OK"
+        details = {"OK": "Configuration committed successfully", "FAIL": "Failed to install content", "PEND": ""}[result]
+        nextjob = ""
+        if status == "FIN" and job.chain and not job.fail: nextjob = "<nextjob>%s</nextjob>" % (job.chain[0])
+        return ("<job><id>%s</id><type>Content</type><status>%s</status><result>%s</result><progress>%s</progress>"
+                "<details><line>%s</line></details>%s</job>" % (job.id, status, result, progress, details, nextjob))
+
+
+    def system_info(self):
+        self.update_versions()
+        with self.lock: versions = dict(self.versions)
+        fields = "".join("<%s>%s</%s>" % (field, versions[category], field) for category, names in sorted(VERSION_FIELDS.items()) for field in names)
+        return ("<system><hostname>%s</hostname><devicename>%s</devicename><model>%s</model><serial>%s</serial>"
+                "<sw-version>7.1.5</sw-version>%s</system>" % (self.name, self.name, self.model, self.serial, fields))
+
+
+    def connected_devices(self):
+        # Managed firewalls as in show devices connected on Panorama
+        entries = []
+        for device in self.managed:
+            with device.lock: versions = dict(device.versions)
+            fields = "".join("<%s>%s</%s>" % (field, versions[category], field) for category, names in sorted(VERSION_FIELDS.items()) for field in names)
+            entries.append('<entry name="%s"><hostname>%s</hostname><model>%s</model><connected>yes</connected>%s</entry>' % (device.serial, device.name, device.model, fields))
+        return "<devices>%s</devices>" % ("".join(entries))
+
+
+    def op(self, cmd):
+        # Returns (status, result xml) for operational command
+        try:
+            root = etree.fromstring(cmd)
+        except SyntaxError:
+            return "error", "<msg><line>Malformed command</line></msg>"
+        if root.tag == "show" and root.find("system/info") is not None:
+            return "success", self.system_info()
+        if root.tag == "show" and root.find("high-availability/state") is not None:
+            if self.ha_state is None: return "success", "<enabled>no</enabled>"
+            peer = {"active": "passive", "passive": "active"}[self.ha_state]
+            return "success", ("<enabled>yes</enabled><group><mode>Active-Passive</mode><local-info><state>%s</state></local-info>"
+                               "<peer-info><state>%s</state></peer-info></group>" % (self.ha_state, peer))
+        if root.tag == "show" and root.find("jobs") is not None:
+            jobs = root.find("jobs")
+            with self.lock: alljobs = dict(self.jobs)
+            if jobs.find("all") is not None: return "success", "".join(self.job_xml(alljobs[jobid]) for jobid in sorted(alljobs))
+            jobid = jobs.findtext("id", "").strip()
+            if not jobid.isdigit() or int(jobid) not in alljobs: return "error", "<msg><line>job %s not found</line></msg>" % (escape(jobid))
+            return "success", self.job_xml(alljobs[int(jobid)])
+        if root.tag == "show" and root.find("devices/connected") is not None and self.managed:
+            self.update_versions()
+            return "success", self.connected_devices()
+        if root.tag == "request" and len(root) and root[0].tag == "batch" and len(root[0]) and self.managed:
+            category = root[0][0].tag
+            filename = root[0][0].findtext("upload-install/uploaded-file")
+            serials = [member.text for member in root[0][0].iterfind("upload-install/devices/member")]
+            with self.lock: found = filename in self.files.get(category, set())
+            if not found: return "error", "<msg><line>File %s not found</line></msg>" % (escape(filename or ""))
+            unknown = set(serials) - set(device.serial for device in self.managed)
+            if unknown: return "error", "<msg><line>Devices %s are not managed</line></msg>" % (escape(",".join(sorted(unknown))))
+            jobid = self.start_install(category, filename, serials)
+            return "success", "<msg><line>Batch upload-install job enqueued with jobid %s</line></msg><job>%s</job>" % (jobid, jobid)
+        if root.tag == "request" and len(root) and root[0].find("upgrade") is not None:
+            category = root[0].tag
+            upgrade = root[0].find("upgrade")
+            if upgrade.find("info") is not None:
+                self.update_versions()
+                with self.lock: files = sorted(self.files.get(category, []))
+                entries = "".join("<entry><filename>%s</filename><downloaded>yes</downloaded></entry>" % (escape(name)) for name in files)
+                return "success", "<content-updates>%s</content-updates>" % (entries)
+            filename = upgrade.findtext("install/file")
+            if filename is not None:
+                with self.lock: found = filename in self.files.get(category, set())
+                if not found: return "error", "<msg><line>File %s not found</line></msg>" % (escape(filename))
+                jobid = self.start_install(category, filename)
+                return "success", "<msg><line>Content install job enqueued with jobid %s</line></msg><job>%s</job>" % (jobid, jobid)
+        if root.tag == "scp" and len(root) and root[0].tag == "import" and len(root[0]):
+            category = root[0][0].tag
+            remote = root[0][0].findtext("from", "")
+            filename = remote.split(":", 1)[-1]
+            if not path.isfile(filename): return "error", "<msg><line>scp: %s: No such file or directory</line></msg>" % (escape(filename))
+            jobid = self.start_import(category, path.basename(filename), path.getsize(filename))
+            return "success", "<msg><line>SCP import job enqueued with jobid %s</line></msg><job>%s</job>" % (jobid, jobid)
+        return "error", "<msg><line>Unsupported command for mock device</line></msg>"
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, as on PAN-OS
+
+    def do_POST(self):
+        device = self.server.device
+        options = device.options
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        length = int(self.headers.get("Content-Length", 0))
+        if query.get("type") == ["import"]:
+            self.read_body(length, options.bandwidth)
+            device.count("import", length)
+            if device.failing(options.fail_upload): return self.reply(500, "error", "<msg><line>Upload failed</line></msg>")
+            device.import_file(query.get("category", [""])[0], query.get("file-name", [""])[0])
+            return self.reply(200, "success", "<msg><line>%s saved</line></msg>" % (escape(query.get("file-name", [""])[0])))
+        form = urlparse.parse_qs(self.read_body(length, None))
+        cmd = form.get("cmd", [""])[0]
+        # API calls are counted by command, for example "show jobs id"
+        try:
+            element = etree.fromstring(cmd)
+            tags = [element.tag]
+            while len(element):
+                element = element[0]
+                tags.append(element.tag)
+            call = " ".join(tags)
+        except SyntaxError:
+            call = "invalid"
+        device.count(call, length)
+        if form.get("type") != ["op"]: return self.reply(200, "error", "<msg><line>Unsupported request type</line></msg>")
+        if device.failing(options.fail_api): return self.reply(200, "error", "<msg><line>Injected API error</line></msg>")
+        status, result = device.op(cmd)
+        self.reply(200, status, result)
+
+
+    def read_body(self, length, bandwidth):
+        # Read request body. Reading is slowed down to bandwidth bytes/s when set
+        start = time.time()
+        received = 0
+        chunks = []
+        while received < length:
+            chunk = self.rfile.read(min(CHUNK_SIZE, length - received))
+            if not chunk: break
+            received += len(chunk)
+            if bandwidth is None: chunks.append(chunk)
+            else:
+                delay = start + float(received) / bandwidth - time.time()
+                if delay > 0: time.sleep(delay)
+        return "".join(chunks)
+
+
+    def reply(self, code, status, result):
+        if self.server.device.options.latency: time.sleep(self.server.device.options.latency)
+        body = '<response status="%s"><result>%s</result></response>' % (status, result)
+        if status == "error": body = '<response status="error">%s</response>' % (result)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+    def handle_error(self, request, client_address):
+        # Clients closing keep-alive connections are expected
+        error = sys.exc_info()[1]
+        if isinstance(error, (ssl.SSLError, socket.error)): return
+        HTTPServer.handle_error(self, request, client_address)
+
+
+class MockFleet(object):
+    def __init__(self, count, options, certfile, keyfile, base_port=0, address="127.0.0.1"):
+        # Starts count mock devices. Port 0 gives each device a free port.
+        self.devices = []
+        self.servers = []
+        self.threads = []
+        for i in range(count):
+            device = MockDevice("mock-fw%03d" % (i + 1), "0079%08d" % (i + 1), options, options.seed + i)
+            port = 0
+            if base_port: port = base_port + i
+            server = MockServer((address, port), MockHandler)
+            server.socket = ssl.wrap_socket(server.socket, keyfile=keyfile, certfile=certfile, server_side=True)
+            server.device = device
+            device.address = "%s:%s" % server.server_address[:2]
+            thread = threading.Thread(target=server.serve_forever, name=device.name)
+            thread.daemon = True
+            thread.start()
+            self.devices.append(device)
+            self.servers.append(server)
+            self.threads.append(thread)
+        if options.ha_pairs:
+            # First device of each pair is active, so passive peer is listed last in devices.conf
+            for active, passive in zip(self.devices[0::2], self.devices[1::2]):
+                active.ha_group = passive.ha_group = "ha-%s" % (active.name)
+                active.ha_state, passive.ha_state = "active", "passive"
+                active.peer, passive.peer = passive, active
+        if options.panorama and self.devices:
+            panorama = self.devices[0]
+            panorama.name, panorama.model = "mock-panorama", "Panorama"
+            panorama.managed = self.devices[1:]
+            for device in panorama.managed: device.panorama = panorama
+
+
+    def stats(self):
+        calls = {}
+        received = 0
+        uploads = 0
+        overlaps = 0
+        for device in self.devices:
+            with device.lock:
+                for call, number in device.calls.items(): calls[call] = calls.get(call, 0) + number
+                received += device.bytes_received
+                uploads += device.uploads
+                overlaps += device.overlaps
+        return {"calls": calls, "api_calls": sum(calls.values()), "bytes_received": received, "uploads": uploads, "ha_overlaps": overlaps}
+
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+
+def devices_line(device):
+    # devices.conf line for mock device, or None for firewall managed by mock Panorama
+    if device.panorama is not None: return None
+    line = "%s,%s" % (device.address, device.name)
+    if device.ha_group: line += ",ha=%s" % (device.ha_group)
+    if device.managed: line += ",type=panorama"
+    return line
+
+
+def add_options(parser):
+    # Options for mock devices. Also used by bench_rollout.py
+    parser.add_argument("--latency", type=float, default=0.0, metavar="SECONDS", help="Delay before each response. Defaults to 0")
+    parser.add_argument("--bandwidth", type=float, metavar="BYTES", help="Upload bandwidth per device in bytes/s. Defaults to unlimited")
+    parser.add_argument("--job-duration", type=float, default=2.0, metavar="SECONDS", help="Time for each install job. Defaults to 2")
+    parser.add_argument("--nextjobs", type=int, default=0, metavar="N", help="Jobs chained after each install job with nextjob. Defaults to 0")
+    parser.add_argument("--fail-upload", type=float, default=0.0, metavar="RATE", help="Share of uploads failing with HTTP 500, 0-1")
+    parser.add_argument("--fail-install", type=float, default=0.0, metavar="RATE", help="Share of install jobs ending with result FAIL, 0-1")
+    parser.add_argument("--fail-api", type=float, default=0.0, metavar="RATE", help="Share of op commands returning an error response, 0-1")
+    parser.add_argument("--model", default="PA-3020", help="Model reported in show system info")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for failure injection")
+    parser.add_argument("--ha-pairs", action="store_true", help="Make devices active/passive HA pairs, active listed first")
+    parser.add_argument("--panorama", action="store_true", help="Make first device a Panorama managing all other devices")
+
+
+def check_options(parser, options):
+    if options.ha_pairs and options.panorama: parser.error("--ha-pairs can't be used with --panorama")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock PAN-OS XML API devices on localhost")
+    parser.add_argument("-n", "--devices", type=int, default=1, help="Number of devices. Defaults to 1")
+    parser.add_argument("--base-port", type=int, default=9443, help="Port of first device. Defaults to 9443")
+    parser.add_argument("--cert", help="Certificate file. Self signed certificate is made with openssl when not set")
+    parser.add_argument("--key", help="Key file for --cert")
+    add_options(parser)
+    args = parser.parse_args()
+    check_options(parser, args)
+    certfile, keyfile = args.cert, args.key
+    if certfile is None:
+        certfile, keyfile = path.abspath("mockpanos-cert.pem"), path.abspath("mockpanos-key.pem")
+        if not path.exists(certfile): make_certificate(certfile, keyfile)
+    fleet = MockFleet(args.devices, args, certfile, keyfile, args.base_port)
+    print "# devices.conf lines for mock devices"
+    for device in fleet.devices:
+        if devices_line(device) is not None: print devices_line(device)
+    try:
+        while True: time.sleep(3600)
+    except KeyboardInterrupt:
+        print fleet.stats()
+        fleet.stop()
+
+
+if __name__ == "__main__":
+    main()
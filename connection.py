@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+#Copyright (c) 2016 Data Equipment AS
+#Author: Tor Mogstad <torm _AT_ dataequipment.no>
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+""" Module for HTTPS connections to PAN-OS devices
+
+ConnectionPool - keep-alive HTTPS connections, pooled per host and shared by all
+devices. Used for version checks, uploads, install commands and job polls, so a
+TLS handshake is only done when no idle connection to the host is available.
+Counts how many requests reused a connection, and how many connections were opened.
+"""
+import re
+import errno
+import ssl
+import socket
+import httplib
+import logging
+import threading
+import time
+
+
+MAX_IDLE = 4  # Max idle connections kept per host
+
+
+class ApiError(StandardError):
+    pass
+
+
+def cmd_xml(cmd):
+    # Convert operational command to XML, as done by pan.xapi with cmd_xml=True.
+    # show jobs id "5" -> <show><jobs><id>5</id></jobs></show>. Quoted words are text of the element before them.
+    xml = ""
+    stack = []
+    for quoted, word in re.findall(r'"([^"]*)"|(\S+)', cmd):
+        if word:
+            xml += "<%s>" % (word)
+            stack.append(word)
+        else:
+            xml += quoted.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    while stack: xml += "</%s>" % (stack.pop())
+    return xml
+
+
+def _closed_while_idle(error, sent):
+    # True if error shows a kept-alive connection was closed by the device before it got the request
+    if isinstance(error, socket.timeout): return False
+    if not sent:
+        if isinstance(error, ssl.SSLError): return error.errno in (ssl.SSL_ERROR_EOF, ssl.SSL_ERROR_ZERO_RETURN)
+        return isinstance(error, socket.error) and error.errno in (errno.ECONNRESET, errno.EPIPE)
+    # Closed with no status line at all. A partial or malformed status line means the device answered.
+    return isinstance(error, httplib.BadStatusLine) and (not error.line or error.line == "''" or error.line.startswith("No status line received"))
+
+
+class ConnectionPool(object):
+    def __init__(self, context, maxidle=MAX_IDLE):
+        self.context = context
+        self.maxidle = maxidle
+        self.opened = 0  # Connections opened - each is a new TCP connection and TLS handshake
+        self.reused = 0  # Requests sent on an already open connection
+        self.connect_time = 0.0  # Seconds spent opening connections
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.metrics = None  # Optional Metrics, records time to open each connection
+
+
+    def _get(self, host, timeout):
+        # Returns (connection, reused). Idle connection is used if one is available.
+        with self.lock:
+            connections = self.idle.get(host)
+            if connections:
+                self.reused += 1
+                connection = connections.pop()
+                connection.sock.settimeout(timeout)
+                return connection, True
+        connection = httplib.HTTPSConnection(host, timeout=timeout, context=self.context)
+        start = time.time()
+        connection.connect()
+        seconds = time.time() - start
+        with self.lock:
+            self.opened += 1
+            self.connect_time += seconds
+            metrics = self.metrics
+        if metrics is not None: metrics.observe("connect", host, seconds)
+        return connection, False
+
+
+    def _put(self, host, connection):
+        with self.lock:
+            connections = self.idle.setdefault(host, [])
+            if len(connections) < self.maxidle:
+                connections.append(connection)
+                return
+        connection.close()
+
+
+    def request(self, host, method, url, body=None, headers=None, timeout=None):
+        # Send request and return (status, response body). body can be a string, or an iterable of chunks
+        # that can be iterated more than once (Content-Length must then be set in headers).
+        # A reused connection the device has closed while idle is replaced, and the request sent again, only when
+        # it is certain the device never got the request: sending failed with a reset or broken pipe, or the
+        # connection was closed without a single byte of response. A request is never sent twice after a timeout,
+        # as the device may already be working on it (an install job or upload).
+        if headers is None: headers = {}
+        while True:
+            try:
+                connection, reused = self._get(host, timeout)
+            except (socket.error, ssl.SSLError, httplib.HTTPException) as e:
+                raise ApiError("Unable to connect to %s: %s" % (host, e))
+            sent = False
+            try:
+                connection.putrequest(method, url, skip_accept_encoding=True)
+                if isinstance(body, str): connection.putheader("Content-Length", str(len(body)))
+                for header, value in headers.items(): connection.putheader(header, value)
+                connection.endheaders()
+                if isinstance(body, str): connection.send(body)
+                elif body is not None:
+                    for chunk in body: connection.send(chunk)
+                sent = True
+                response = connection.getresponse()
+                data = response.read()
+            except (socket.error, ssl.SSLError, httplib.HTTPException) as e:
+                connection.close()
+                if reused and _closed_while_idle(e, sent):
+                    logging.debug("Idle connection to %s was closed by device (%s). Sending request on new connection" % (host, e))
+                    continue
+                raise ApiError("Request to %s failed: %s" % (host, e))
+            except:
+                # Error raised by body while sending - connection is in unknown state
+                connection.close()
+                raise
+            if response.will_close: connection.close()
+            else: self._put(host, connection)
+            return response.status, data
+
+
+    def stats(self):
+        with self.lock:
+            return {"opened": self.opened, "reused": self.reused, "connect_time": self.connect_time}
+
+
+    def close(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = {}
+        for connections in idle.values():
+            for connection in connections: connection.close()
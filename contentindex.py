@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+#Copyright (c) 2016 Data Equipment AS
+#Author: Tor Mogstad <torm _AT_ dataequipment.no>
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+""" Module for indexing content update files
+
+ContentIndex - persistent index of content files in the package folders. Holds
+version, size, mtime and sha256 of each file, and the newest version of each
+content type. Folders are only listed again when their mtime has changed, but
+each indexed file is checked for a new size or mtime on every refresh, as a file
+written in place doesn't change the folder mtime. Only new or changed files are
+hashed.
+"""
+from os import path
+import os
+import re
+import json
+import hashlib
+import logging
+import threading
+
+
+HASH_BLOCKSIZE = 1024 * 1024
+
+
+def parse_version(filename):
+    # Version from content file name, using the same fields as PanOsDevice.needs_update()
+    # panupv2-all-contents-595-3465 -> (595, 3465). Returns None for names not matching.
+    fields = filename.split('-')
+    if len(fields) < 5: return None
+    minor = re.match(r"\d+", fields[4])
+    if not fields[3].isdigit() or minor is None: return None
+    return (int(fields[3]), int(minor.group(0)))
+
+
+_digests = {}  # Memoized file hashes, by path, size and mtime
+_digests_lock = threading.Lock()
+
+
+def file_digest(filepath):
+    # sha256 of file. Memoized, so a file is only read once per run unless it changes.
+    stat = os.stat(filepath)
+    key = (path.abspath(filepath), stat.st_size, stat.st_mtime)
+    with _digests_lock:
+        if key in _digests: return _digests[key]
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        while True:
+            block = f.read(HASH_BLOCKSIZE)
+            if not block: break
+            digest.update(block)
+    with _digests_lock:
+        _digests[key] = digest.hexdigest()
+    return _digests[key]
+
+
+class ContentIndex(object):
+    def __init__(self, filename, packages):
+        # packages - dict of content type and folder, as PACKAGE in pan-dyn-update.py
+        self.filename = filename
+        self.packages = packages
+        self.lock = threading.Lock()
+        self.folders = {}
+        self.newest_files = {}
+        if path.exists(filename):
+            try:
+                with open(filename, "r") as f:
+                    self.folders = json.load(f)
+            except (IOError, ValueError) as e:
+                logging.warning("Unable to read content index %s. Rebuilding index. %s" % (filename, e))
+        for package in self.packages: self._update_newest(package)
+
+
+    def refresh(self):
+        # Rescan folders changed since last refresh. Returns list of content types with changes
+        changed = []
+        with self.lock:
+            for package, folder in sorted(self.packages.items()):
+                if self._refresh_folder(folder):
+                    self._update_newest(package)
+                    changed.append(package)
+        return changed
+
+
+    def _refresh_folder(self, folder):
+        try:
+            mtime = os.stat(folder).st_mtime
+        except OSError:
+            if folder in self.folders:
+                del self.folders[folder]
+                return True
+            return False
+        indexed = self.folders.get(folder)
+        old_files = {}
+        if indexed is not None: old_files = indexed["files"]
+        # Same folder mtime - no file added, removed or renamed, so only indexed files are checked
+        unchanged_folder = indexed is not None and indexed["mtime"] == mtime
+        if unchanged_folder: names = list(old_files)
+        else: names = os.listdir(folder)
+        files = {}
+        for name in names:
+            filepath = path.join(folder, name)
+            if not path.isfile(filepath): continue
+            version = parse_version(name)
+            if version is None:
+                logging.debug("Skipping %s in content index - version not found in file name" % (filepath))
+                continue
+            stat = os.stat(filepath)
+            entry = old_files.get(name)
+            if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+                entry = {"version": list(version), "size": stat.st_size, "mtime": stat.st_mtime, "sha256": file_digest(filepath)}
+                logging.debug("Indexed content file %s - version %s-%s" % (filepath, version[0], version[1]))
+            files[name] = entry
+        if unchanged_folder and files == old_files: return False
+        self.folders[folder] = {"mtime": mtime, "files": files}
+        return True
+
+
+    def _update_newest(self, package):
+        newest = None
+        indexed = self.folders.get(self.packages[package])
+        if indexed is not None:
+            for name, entry in indexed["files"].items():
+                version = tuple(entry["version"])
+                if newest is None or (version, name) > newest: newest = (version, name)
+        self.newest_files[package] = newest
+
+
+    def newest(self, package):
+        # Name of newest file for content type, or None if no files are found
+        newest = self.newest_files.get(package)
+        if newest is None: return None
+        return newest[1]
+
+
+    def newest_newer_than(self, package, version):
+        # Name of newest file for content type if it is newer than version (tuple), otherwise None
+        newest = self.newest_files.get(package)
+        if newest is None or newest[0] <= tuple(version): return None
+        return newest[1]
+
+
+    def older_sizes(self, package, name):
+        # Sizes of indexed files of content type with lower version than name
+        indexed = self.folders.get(self.packages[package])
+        version = parse_version(name)
+        if indexed is None or version is None: return []
+        return [entry["size"] for other, entry in indexed["files"].items() if tuple(entry["version"]) < version]
+
+
+    def digest(self, package, name):
+        # sha256 of file - from index when file is indexed, otherwise computed (and memoized)
+        entry = self.entry(package, name)
+        if entry is not None: return entry["sha256"]
+        return file_digest(path.join(self.packages[package], name))
+
+
+    def entry(self, package, name):
+        # Index entry with version, size, mtime and sha256 for file
+        indexed = self.folders.get(self.packages[package])
+        if indexed is None: return None
+        return indexed["files"].get(name)
+
+
+    def save(self):
+        with self.lock:
+            content = json.dumps(self.folders, indent=1, sort_keys=True)
+        tmpfile = "%s.tmp" % (self.filename)
+        with open(tmpfile, "w") as f:
+            f.write(content)
+        os.rename(tmpfile, self.filename)
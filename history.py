@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+#Copyright (c) 2016 Data Equipment AS
+#Author: Tor Mogstad <torm _AT_ dataequipment.no>
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+""" Module for keeping measurements from earlier runs
+
+History - on-disk store of recent samples (upload throughput, durations) per
+device and per model, used to plan later runs. Model samples cover devices
+without history of their own.
+"""
+from os import path
+import os
+import json
+import logging
+import threading
+
+
+MAX_SAMPLES = 20  # Samples kept per device and measurement
+
+
+def percentile(samples, p):
+    # Value at fraction p (0-1) of sorted samples, or None if there are none
+    samples = sorted(samples)
+    if not samples: return None
+    return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+
+class History(object):
+    def __init__(self, filename, maxsamples=MAX_SAMPLES):
+        self.filename = filename
+        self.maxsamples = maxsamples
+        self.lock = threading.Lock()
+        self.devices = {}
+        self.models = {}
+        if path.exists(filename):
+            try:
+                with open(filename, "r") as f:
+                    content = json.load(f)
+                if "devices" in content:
+                    self.devices = content["devices"]
+                    self.models = content.get("models", {})
+                else: self.devices = content  # Written before model samples were kept
+            except (IOError, ValueError) as e:
+                logging.warning("Unable to read history file %s. Starting with empty history. %s" % (filename, e))
+
+
+    def record(self, hostname, key, value, model=None):
+        # Sample is also kept for model when set
+        with self.lock:
+            for store, name in ((self.devices, hostname), (self.models, model)):
+                if name is None: continue
+                samples = store.setdefault(name, {}).setdefault(key, [])
+                samples.append(value)
+                del samples[:-self.maxsamples]
+
+
+    def samples(self, hostname, key):
+        with self.lock:
+            return list(self.devices.get(hostname, {}).get(key, []))
+
+
+    def model_samples(self, model, key):
+        with self.lock:
+            return list(self.models.get(model, {}).get(key, []))
+
+
+    def median(self, hostname, key):
+        # Median of recorded samples, or None if there are none
+        return percentile(self.samples(hostname, key), 0.5)
+
+
+    def save(self):
+        with self.lock:
+            content = json.dumps({"devices": self.devices, "models": self.models}, indent=1, sort_keys=True)
+        tmpfile = "%s.tmp" % (self.filename)
+        with open(tmpfile, "w") as f:
+            f.write(content)
+        os.rename(tmpfile, self.filename)
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+#Copyright (c) 2016 Data Equipment AS
+#Author: Tor Mogstad <torm _AT_ dataequipment.no>
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+""" Module for caching content versions installed on devices
+
+InventoryCache - on-disk cache of app, threat, AV and WildFire versions and model
+for each device, keyed by hostname. Entries older than ttl seconds are ignored.
+"""
+from os import path
+import os
+import json
+import logging
+import threading
+import time
+
+
+# Device attributes stored in cache
+FIELDS = ("app_version", "threat_version", "av_version", "wf_version", "model")
+
+
+class InventoryCache(object):
+    def __init__(self, filename, ttl):
+        self.filename = filename
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.devices = {}
+        if path.exists(filename):
+            try:
+                with open(filename, "r") as f:
+                    self.devices = json.load(f)
+            except (IOError, ValueError) as e:
+                logging.warning("Unable to read inventory cache %s. Starting with empty cache. %s" % (filename, e))
+
+
+    def get(self, hostname):
+        # Returns cached entry for device, or None if device is not cached or entry is expired
+        with self.lock:
+            entry = self.devices.get(hostname)
+        if entry is None: return None
+        if time.time() - entry["timestamp"] > self.ttl: return None
+        return entry
+
+
+    def load(self, device):
+        # Set cached versions on device. Returns True if a valid entry was found
+        entry = self.get(device.hostname)
+        if entry is None: return False
+        for field in FIELDS: setattr(device, field, entry.get(field))
+        return True
+
+
+    def update(self, device):
+        entry = dict((field, getattr(device, field)) for field in FIELDS)
+        entry["timestamp"] = time.time()
+        with self.lock:
+            self.devices[device.hostname] = entry
+
+
+    def invalidate(self, hostname=None):
+        # Remove single device, or all devices if hostname is not set
+        with self.lock:
+            if hostname is None: self.devices = {}
+            else: self.devices.pop(hostname, None)
+
+
+    def save(self):
+        # Write to temporary file first, so an interrupted run never leaves a half written cache
+        with self.lock:
+            content = json.dumps(self.devices, indent=1, sort_keys=True)
+        tmpfile = "%s.tmp" % (self.filename)
+        with open(tmpfile, "w") as f:
+            f.write(content)
+        os.rename(tmpfile, self.filename)
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+#Copyright (c) 2016 Data Equipment AS
+#Author: Tor Mogstad <torm _AT_ dataequipment.no>
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+""" Module for tracking PAN-OS jobs
+
+JobTracker - owns every outstanding job on every device, and polls them from one
+background thread with adaptive backoff. nextjob chains are followed, and a
+device with several outstanding jobs is polled with a single "show jobs all".
+JobFuture - returned for each tracked job. Completion is reported through
+result() or through callbacks.
+"""
+from parse import XmlReader
+import threading
+import logging
+import traceback
+import time
+
+
+# Poll intervals in seconds. Interval grows with BACKOFF while job progress is unchanged.
+POLL_MIN = 2
+POLL_MAX = 30
+BACKOFF = 1.5
+# Use "show jobs all" when a device has this many jobs due for polling
+BATCH_THRESHOLD = 2
+# Number of devices polled at the same time
+POLL_WORKERS = 8
+
+
+class JobError(StandardError):
+    pass
+
+
+class JobFuture(object):
+    def __init__(self, device, jobid):
+        self.device = device
+        self.jobid = jobid  # First job id. Current id in chain is kept by tracker
+        self.jobids = [jobid]  # All job ids in chain, in order
+        self.status = None
+        self.progress = None
+        self.polls = 0
+        self._done = False
+        self._finisher = None  # Thread running callbacks
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._exception = None
+
+
+    def done(self):
+        return self._done
+
+
+    def result(self, timeout=None):
+        # Blocks until job chain is complete and callbacks have run. Returns details for last job, or raises JobError
+        # A callback calling result() gets it at once
+        if not (self._done and threading.current_thread() is self._finisher): self._event.wait(timeout)
+        if not self._done: raise JobError("Timeout waiting for job %s on device %s" % (self.jobid, self.device.name))
+        if self._exception is not None: raise self._exception
+        return self._result
+
+
+    def exception(self):
+        return self._exception
+
+
+    def add_done_callback(self, callback):
+        # Callback is called with future as only argument. Called at once if job is already done
+        with self._lock:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+        self._run_callback(callback)
+
+
+    def _set_result(self, result):
+        self._finish(result, None)
+
+
+    def _set_exception(self, exception):
+        self._finish(None, exception)
+
+
+    def _finish(self, result, exception):
+        # Callbacks run before waiting threads are released, so anything they record is in place when result() returns
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._done = True
+            self._finisher = threading.current_thread()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for callback in callbacks: self._run_callback(callback)
+        self._event.set()
+
+
+    def _run_callback(self, callback):
+        try:
+            callback(self)
+        except Exception:
+            logging.error("Error in callback for job %s on device %s" % (self.jobid, self.device.name))
+            logging.error(traceback.format_exc())
+
+
+class _TrackedJob(object):
+    def __init__(self, future, timeout, interval):
+        self.future = future
+        self.jobid = future.jobid
+        self.deadline = time.time() + timeout
+        self.poll_min = interval  # Interval used while job progress moves
+        self.interval = interval
+        self.due = time.time() + interval
+        self.last_progress = None
+
+
+class JobTracker(object):
+    def __init__(self, poll_min=POLL_MIN, poll_max=POLL_MAX, backoff=BACKOFF, batch_threshold=BATCH_THRESHOLD, workers=POLL_WORKERS):
+        self.poll_min = poll_min
+        self.poll_max = poll_max
+        self.backoff = backoff
+        self.batch_threshold = batch_threshold
+        self.workers = workers
+        self.api_calls = 0
+        self._jobs = []
+        self._polling = set()  # id() of devices with a poll in flight
+        self._condition = threading.Condition()
+        self._thread = None
+        self._pool = None
+        self._stopped = False
+
+
+    def track(self, device, jobid, timeout, callback=None, interval=None):
+        # Start tracking job on device. Device must provide op(cmd, cmd_xml) and name.
+        # interval - poll interval for this job, for example from expected job duration. Defaults to poll_min.
+        future = JobFuture(device, jobid)
+        if callback is not None: future.add_done_callback(callback)
+        if interval is None: interval = self.poll_min
+        job = _TrackedJob(future, timeout, interval)
+        with self._condition:
+            if self._stopped: raise JobError("Job tracker is stopped")
+            self._jobs.append(job)
+            if self._thread is None:
+                from multiprocessing.pool import ThreadPool  # Imported on first job, not for runs without jobs
+                self._pool = ThreadPool(self.workers)
+                self._thread = threading.Thread(target=self._run, name="JobTracker")
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+        return future
+
+
+    def outstanding(self):
+        with self._condition:
+            return len(self._jobs)
+
+
+    def stop(self):
+        # Stops polling. Jobs still outstanding are failed.
+        with self._condition:
+            self._stopped = True
+            jobs = self._jobs
+            self._jobs = []
+            self._condition.notify()
+        for job in jobs: job.future._set_exception(JobError("Job tracker stopped before job %s on device %s completed" % (job.jobid, job.future.device.name)))
+        if self._thread is not None:
+            self._thread.join()
+            self._pool.close()
+            self._pool.join()
+
+
+    def _run(self):
+        # Polls are handed to the pool without waiting for them, so a slow device never delays polls of other devices.
+        # A device with a poll in flight is skipped until that poll is done.
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    now = time.time()
+                    waiting = [job for job in self._jobs if id(job.future.device) not in self._polling]
+                    due = [job for job in waiting if job.due <= now]
+                    if due: break
+                    if waiting: self._condition.wait(min(job.due for job in waiting) - now)
+                    else: self._condition.wait()
+                if self._stopped: return
+                # Group due jobs on device, and poll devices in parallel
+                devices = {}
+                for job in due: devices.setdefault(id(job.future.device), []).append(job)
+                self._polling.update(devices)
+            for jobs in devices.values(): self._pool.apply_async(self._poll_device, (jobs,))
+
+
+    def _poll_device(self, jobs):
+        try:
+            self._poll(jobs)
+        except Exception:
+            logging.error(traceback.format_exc())
+        finally:
+            with self._condition:
+                self._polling.discard(id(jobs[0].future.device))
+                self._condition.notify()
+
+
+    def _poll(self, jobs):
+        device = jobs[0].future.device
+        with self._condition:
+            # Jobs failed by stop() while poll was queued are not polled
+            jobs = [job for job in jobs if job in self._jobs]
+        if not jobs: return
+        try:
+            if len(jobs) >= self.batch_threshold:
+                self._count_call()
+                output = device.op("show jobs all", cmd_xml=True)
+                status = dict((job['id'], job) for job in XmlReader(output).find_jobs())
+            else:
+                status = {}
+                for job in jobs:
+                    self._count_call()
+                    output = device.op('show jobs id "%s"' % (job.jobid), cmd_xml=True)
+                    for found in XmlReader(output).find_jobs(): status[found['id']] = found
+        except Exception as e:
+            logging.error(traceback.format_exc())
+            for job in jobs: self._fail(job, JobError("Error when executing API call to find job status for device %s. Job id: %s. Error: %s" % (device.name, job.jobid, e)))
+            return
+        for job in jobs:
+            job.future.polls += 1
+            found = status.get(job.jobid)
+            if found is None:
+                self._fail(job, JobError("Job %s not found in job list for device %s" % (job.jobid, device.name)))
+            else:
+                self._update(job, found)
+
+
+    def _update(self, job, found):
+        future = job.future
+        device = future.device
+        future.status = found['status']
+        future.progress = found['progress']
+        if device.verbose: print "Job %s running on %s - Status : %s %s%%" % (job.jobid, device.name, found['status'], found['progress'])
+        if found['status'] == "FIN":
+            if found['result'] == "FAIL":
+                self._fail(job, JobError("Job %s failed on device %s. Details: %s" % (job.jobid, device.name, found['details'])))
+            elif found['nextjob']:
+                # Follow chain - same future, new job id
+                logging.info("Job %s completed on %s. Following next job %s" % (job.jobid, device.name, found['nextjob']))
+                job.jobid = found['nextjob']
+                future.jobids.append(job.jobid)
+                job.last_progress = None
+                self._schedule(job, job.poll_min)
+            else:
+                if device.verbose: print "Job %s completed on %s." % (job.jobid, device.name)
+                self._remove(job)
+                future._set_result(found)
+            return
+        if time.time() > job.deadline:
+            self._fail(job, JobError("Timeout waiting for completion of job %s on device %s" % (job.jobid, device.name)))
+            return
+        # Back off while nothing happens, poll faster again when job moves
+        if found['progress'] == job.last_progress: interval = min(job.interval * self.backoff, self.poll_max)
+        else: interval = job.poll_min
+        job.last_progress = found['progress']
+        self._schedule(job, interval)
+
+
+    def _count_call(self):
+        with self._condition:
+            self.api_calls += 1
+
+
+    def _schedule(self, job, interval):
+        with self._condition:
+            job.interval = interval
+            job.due = time.time() + interval
+            self._condition.notify()
+
+
+    def _remove(self, job):
+        with self._condition:
+            if job in self._jobs: self._jobs.remove(job)
+
+
+    def _fail(self, job, exception):
+        logging.error(str(exception))
+        self._remove(job)
+        job.future._set_exception(exception)
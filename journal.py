@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+#Copyright (c) 2016 Data Equipment AS
+#Author: Tor Mogstad <torm _AT_ dataequipment.no>
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+
+""" Module for the rollout journal
+
+Journal - append-only JSONL file recording the progress of each device in a
+rollout: version checked, file uploaded, install job started (with job id), job
+installed or failed, and device finished or failed. Each record is flushed to
+disk before the run moves on, so after a crash or kill a new run with --resume
+can skip finished devices and re-attach to install jobs that were running.
+"""
+from os import path
+import os
+import json
+import logging
+import threading
+import time
+
+
+class Journal(object):
+    def __init__(self, filename, resume=False):
+        # resume - read journal left by earlier run. Otherwise journal is cleared when first rollout begins.
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.resume = resume
+        self.devices = {}  # hostname -> {"finished": files or None, "packages": {package: record}}
+        self.file = None
+        if resume: self._load()
+
+
+    def _load(self):
+        if not path.exists(self.filename): return
+        records = 0
+        with open(self.filename, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Last line may be cut short if run was killed while writing it
+                    logging.warning("Skipping unreadable line in journal %s" % (self.filename))
+                    continue
+                self._apply(record)
+                records += 1
+        logging.info("Read %s records for %s devices from journal %s" % (records, len(self.devices), self.filename))
+
+
+    def _apply(self, record):
+        if "device" not in record: return
+        device = self.devices.setdefault(record["device"], {"finished": None, "packages": {}})
+        if record["phase"] == "finished": device["finished"] = record.get("files")
+        elif record["phase"] == "failed" and record.get("package") is None: device["finished"] = None
+        elif record.get("package") is not None: device["packages"][record["package"]] = record
+
+
+    def begin(self, content_files):
+        # Start of rollout. Journal of an earlier run is kept only for the first rollout when resuming.
+        with self.lock:
+            if self.file is None and self.resume: self.file = open(self.filename, "a")
+            else:
+                if self.file is not None: self.file.close()
+                self.file = open(self.filename, "w")
+                self.devices = {}
+            self.resume = False
+        self._write({"phase": "begin", "files": [content_file for package, content_file in content_files]})
+
+
+    def _write(self, record):
+        record["time"] = time.time()
+        line = json.dumps(record, sort_keys=True) + "\n"
+        with self.lock:
+            if "device" in record: self._apply(record)
+            if self.file is None: return
+            self.file.write(line)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+
+    def record(self, device, phase, package=None, file=None, jobid=None):
+        # phase - checked, uploaded, job, started, installed or failed
+        record = {"device": device.hostname, "name": device.name, "phase": phase}
+        if package is not None: record.update({"package": package, "file": file})
+        if jobid is not None: record["jobid"] = jobid
+        self._write(record)
+
+
+    def track(self, device, package, file, future):
+        # Record job id of install job, and its result when done
+        self.record(device, "job", package, file, future.jobid)
+        def done(future):
+            if future.exception() is None: self.record(device, "installed", package, file, future.jobid)
+            else: self.record(device, "failed", package, file, future.jobid)
+        future.add_done_callback(done)
+
+
+    def finish(self, device, content_files, failed):
+        # Device done with all content files
+        record = {"device": device.hostname, "name": device.name, "phase": "finished", "files": [content_file for package, content_file in content_files]}
+        if failed: record = {"device": device.hostname, "name": device.name, "phase": "failed"}
+        self._write(record)
+
+
+    def finished(self, device, content_files):
+        # True if device finished the same content files in journal
+        with self.lock:
+            entry = self.devices.get(device.hostname)
+            return entry is not None and entry["finished"] == [content_file for package, content_file in content_files]
+
+
+    def entry(self, device, package, file):
+        # Last record for content file on device, or None
+        with self.lock:
+            entry = self.devices.get(device.hostname)
+            if entry is None: return None
+            record = entry["packages"].get(package)
+        if record is None or record.get("file") != file: return None
+        return record
+
+
+    def close(self):
+        with self.lock:
+            if self.file is not None: self.file.close()
+            self.file = None
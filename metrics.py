@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+#Copyright (c) 2016 Data Equipment AS
+#Author: Tor Mogstad <torm _AT_ dataequipment.no>
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+
+""" Module for run metrics
+
+Metrics - timings of each phase of the work done on devices: connect, show system
+info, upload (time and throughput), time to job id, total job time and number of
+job polls. Values are kept per device and per phase, and written as a JSON report
+and as a Prometheus textfile collector file with one histogram per phase.
+"""
+from os import path
+import os
+import json
+import time
+import threading
+
+
+PREFIX = "pan_dyn_update"
+# Phase, Prometheus metric name, help text and histogram buckets
+PHASES = [
+    ("connect", "connect_seconds", "Time to open HTTPS connection to device",
+        (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)),
+    ("system_info", "system_info_seconds", "Time for show system info",
+        (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)),
+    ("upload", "upload_seconds", "Time to upload content file",
+        (1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)),
+    ("upload_throughput", "upload_throughput_bytes_per_second", "Upload throughput",
+        (10e3, 50e3, 100e3, 500e3, 1e6, 5e6, 10e6, 50e6, 100e6)),
+    ("job_start", "job_start_seconds", "Time from install command to job id",
+        (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)),
+    ("job", "job_seconds", "Time from job start until job (and any next job) is done",
+        (5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600)),
+    ("polls", "job_polls", "Job status polls for each job",
+        (1, 2, 3, 5, 10, 20, 50, 100)),
+]
+
+
+def summary(values):
+    # Count, sum, min, max, mean and percentiles of list of values
+    if not values: return {"count": 0}
+    values = sorted(values)
+    def percentile(p): return values[min(len(values) - 1, int(p * len(values)))]
+    return {"count": len(values), "sum": sum(values), "min": values[0], "max": values[-1],
+            "mean": sum(values) / float(len(values)), "p50": percentile(0.5), "p90": percentile(0.9), "p99": percentile(0.99)}
+
+
+def _write_atomic(filename, content):
+    # Textfile collector must never see a partly written file
+    tmpfile = path.join(path.dirname(path.abspath(filename)), ".%s.tmp" % (path.basename(filename)))
+    with open(tmpfile, "w") as f:
+        f.write(content)
+    os.rename(tmpfile, filename)
+
+
+def _format_value(value):
+    if value == float("inf"): return "+Inf"
+    return repr(float(value))
+
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.finished = None
+        self.values = dict((phase[0], []) for phase in PHASES)
+        self.devices = {}  # hostname -> {"name": name, phase: [values]}
+        self.gauges = []  # (name, help, labels, value)
+
+
+    def observe(self, phase, hostname, value, name=None):
+        with self.lock:
+            self.values[phase].append(value)
+            device = self.devices.setdefault(hostname, {"name": name})
+            if name is not None: device["name"] = name
+            device.setdefault(phase, []).append(value)
+
+
+    def gauge(self, name, help, value, labels=None):
+        with self.lock:
+            self.gauges.append((name, help, labels or {}, value))
+
+
+    def finish(self):
+        self.finished = time.time()
+
+
+    def report(self):
+        with self.lock:
+            finished = self.finished or time.time()
+            return {
+                "started": self.started,
+                "finished": finished,
+                "duration": finished - self.started,
+                "phases": dict((phase, summary(values)) for phase, values in self.values.items()),
+                "devices": dict((hostname, dict(values)) for hostname, values in self.devices.items()),
+                "gauges": [{"name": name, "labels": labels, "value": value} for name, help, labels, value in self.gauges],
+            }
+
+
+    def write_json(self, filename):
+        _write_atomic(filename, json.dumps(self.report(), indent=1, sort_keys=True))
+
+
+    def prometheus(self):
+        # Text exposition format. One histogram per phase, for this run only
+        lines = []
+        with self.lock:
+            finished = self.finished or time.time()
+            for phase, metric, help, buckets in PHASES:
+                name = "%s_%s" % (PREFIX, metric)
+                values = self.values[phase]
+                lines.append("# HELP %s %s" % (name, help))
+                lines.append("# TYPE %s histogram" % (name))
+                for bound in list(buckets) + [float("inf")]:
+                    lines.append('%s_bucket{le="%s"} %s' % (name, _format_value(bound), len([value for value in values if value <= bound])))
+                lines.append("%s_sum %s" % (name, _format_value(sum(values))))
+                lines.append("%s_count %s" % (name, len(values)))
+            written = set()
+            for name, help, labels, value in sorted(self.gauges, key=lambda gauge: gauge[0]):
+                name = "%s_%s" % (PREFIX, name)
+                if name not in written:
+                    lines.append("# HELP %s %s" % (name, help))
+                    lines.append("# TYPE %s gauge" % (name))
+                    written.add(name)
+                label = ",".join('%s="%s"' % (key, str(labels[key]).replace('\\', '\\\\').replace('"', '\\"')) for key in sorted(labels))
+                if label: name = "%s{%s}" % (name, label)
+                lines.append("%s %s" % (name, _format_value(value)))
+            lines.append("# HELP %s_run_duration_seconds Duration of last run" % (PREFIX))
+            lines.append("# TYPE %s_run_duration_seconds gauge" % (PREFIX))
+            lines.append("%s_run_duration_seconds %s" % (PREFIX, _format_value(finished - self.started)))
+            lines.append("# HELP %s_last_run_timestamp_seconds End of last run" % (PREFIX))
+            lines.append("# TYPE %s_last_run_timestamp_seconds gauge" % (PREFIX))
+            lines.append("%s_last_run_timestamp_seconds %s" % (PREFIX, _format_value(finished)))
+        return "\n".join(lines) + "\n"
+
+
+    def write_prometheus(self, filename):
+        _write_atomic(filename, self.prometheus())
+
+
+class Timer(object):
+    # Context manager observing time used in block. Nothing is recorded if metrics is None, or block raises.
+    def __init__(self, metrics, phase, device):
+        self.metrics = metrics
+        self.phase = phase
+        self.device = device
+
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.seconds = time.time() - self.start
+        if self.metrics is not None and exc_type is None:
+            self.metrics.observe(self.phase, self.device.hostname, self.seconds, self.device.name)
+        return False
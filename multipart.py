@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+#Copyright (c) 2016 Data Equipment AS
+#Author: Tor Mogstad <torm _AT_ dataequipment.no>
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+""" Streaming multipart/form-data body for file uploads
+
+Used by pancom.py when importing content files. The body length is known up
+front, and the file is memory mapped and sent in chunks, so the request body is
+never built in memory.
+"""
+from os import path
+import os
+import mmap
+import binascii
+
+
+CHUNK_SIZE = 64 * 1024  # Bytes sent per write to the connection
+
+
+class MultipartError(StandardError):
+    pass
+
+
+class MultipartFile(object):
+    def __init__(self, filepath, fieldname="file", chunksize=CHUNK_SIZE):
+        self.filepath = filepath
+        self.filename = path.basename(filepath)
+        self.chunksize = chunksize
+        self.boundary = binascii.hexlify(os.urandom(16))  # Random, as uuid4. uuid is not used, as it loads ctypes
+        self.size = os.path.getsize(filepath)
+        self.preamble = ('--%s\r\n'
+                         'Content-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                         'Content-Type: application/octet-stream\r\n'
+                         '\r\n' % (self.boundary, fieldname, self.filename))
+        self.trailer = '\r\n--%s--\r\n' % (self.boundary)
+        self.content_length = len(self.preamble) + self.size + len(self.trailer)
+
+
+    def headers(self):
+        return {
+            "Content-Type": "multipart/form-data; boundary=%s" % (self.boundary),
+            "Content-Length": str(self.content_length),
+        }
+
+
+    def __len__(self):
+        return self.content_length
+
+
+    def __iter__(self):
+        # Preamble, file content in chunks of chunksize, then trailer. Chunks are buffers into the memory map,
+        # so file content is not copied, and are only valid until the next chunk is asked for.
+        # Raises MultipartError if the file size has changed since Content-Length was found.
+        yield self.preamble
+        with open(self.filepath, 'rb') as f:
+            # The whole file is mapped, so the size of the open file is the size of the map
+            size = os.fstat(f.fileno()).st_size
+            if size != self.size: raise MultipartError("%s changed size from %s to %s bytes before upload" % (self.filepath, self.size, size))
+            if size:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for offset in xrange(0, size, self.chunksize):
+                        yield buffer(mm, offset, self.chunksize)
+                finally:
+                    mm.close()
+        yield self.trailer
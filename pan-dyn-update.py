@@ -35,27 +35,90 @@ Use at your own risk.
 
 """
 
-from poster.encode import multipart_encode
-from poster.streaminghttp import register_openers
 from pancom import PanOsDevice
+from pancom import Panorama
 from pancom import UploadError
 from pancom import InstallError
+from pancom import ScpSource
+from pancom import is_newer
+from jobs import JobTracker
+from connection import ConnectionPool
+from history import History
+from rollout import WaveScheduler
+from rollout import ha_groups
+from rollout import ha_order
+from rollout import RolloutError
+from uploadsched import UploadScheduler
+from uploadsched import UploadScheduleError
+from uploadsched import parse_rate
+import uploadsched
+from inventory import InventoryCache
+from inventory import FIELDS as VERSION_FIELDS
+from metrics import Metrics
+from timeouts import TimeoutPolicy
+from timeouts import Progress
+from journal import Journal
+from probe import Prober
+from probe import CircuitBreaker
+from probe import PROBE_TIMEOUT
+from plan import RolloutPlan
+from shard import LeaseStore
+from shard import ShardRunner
+from shard import ShardError
+from shard import assign_shards
+from shard import rollout_id
+from plan import PlanError
+from watch import DirectoryWatcher
+from watch import StatusServer
+from watch import SETTLE
+from contentindex import ContentIndex
+from contentindex import file_digest
+from validate import ContentValidator
+from validate import ValidationError
+from results import ResultStream
+from results import LogSink
+from results import StdoutSink
+from results import FileSink
+from results import WebhookSink
+from results import EmailSink
 from parse import EmailSender
-import glob
 import sys
 import time
-import os
+import ssl
 from os import path
 import argparse
 import logging
+import signal
+import threading
 import traceback
 
 ##### Static variables used in script - change only if needed
 CONFIG_FILE = "config.conf"  # Config file
 DEVICES_FILE = "devices.conf"  # Devices file
 LOG_FILE = "log.txt"  # Log file used by script
-# API timeout - also used when waiting for install job completion.
-API_TIMEOUT = 300 #For devices like PA-200/PA-500 this value needs to be increased.
+CONTENT_INDEX_FILE = "content-index.json"  # Index of versions and hashes of files in content folders
+INVENTORY_FILE = "inventory.json"  # Cache of content versions installed on devices
+INVENTORY_TTL = 3600  # Seconds a cached device version is trusted. 0 disables cache
+# API timeout - also used when waiting for install job completion. Used until enough durations are recorded in history
+# for a device or its model. Set timeout=<seconds> for a device, or model-timeout=<model>:<seconds>, in devices.conf to override.
+API_TIMEOUT = 300
+
+JOURNAL_FILE = "journal.jsonl"  # Progress of each device in last rollout, used by --resume
+BREAKER_FILE = "breaker.json"  # Failed reachability probes per device, so dead devices are backed off between runs
+SHARD_STORE = "shards.sqlite"  # Lease store for --shards. Must be on storage shared by all runners
+VALIDATION_FILE = "validation.json"  # Results of content file validation, by sha256
+HISTORY_FILE = "history.json"  # Measurements from earlier runs, like upload throughput per device
+STATUS_ADDRESS = "127.0.0.1"  # Daemon mode status server. GET /status for status, POST /trigger to start rollout
+STATUS_PORT = 8470
+PLAN_PARALLEL = 20  # Devices asked for installed versions at the same time by --plan, unless --parallel is higher
+# Settings supported in devices.conf
+DEVICES_SETTINGS = {
+    "bandwidth",        # Max total upload bandwidth in bytes/s. k, M and G suffixes can be used
+    "site-bandwidth",   # Max upload bandwidth for devices with site=<site>. Format: <site>:<bandwidth>
+    "upload-retries",   # Retries after a failed upload
+    "upload-deadline",  # Max seconds from first upload attempt until upload of a file must be complete
+    "model-timeout",    # Fixed API and install timeout for a model. Format: <model>:<seconds>
+}
 
 # List of supported content types
 PACKAGE = {
@@ -77,29 +140,54 @@ class FileError(StandardError):
 class ApiKeyException(StandardError):
     pass
 
-def find_newest_file(package):
+def find_newest_file(package, index):
+    # Newest file is found by version in file name, from index of content folders
     try:
-        #Search for files in subdirectory under SCRIPT_PATH
-        searchpath = PACKAGE[package] + "*"
-        newest=max(glob.iglob(searchpath), key=os.path.getctime)
-        #Remove path from filename and return it
-        filename = newest.split('/')[-1]
-        return filename
+        index.refresh()
+        index.save()
     except Exception as e:
+        logging.error("Error updating content index %s" % (CONTENT_INDEX_FILE))
+        logging.error(traceback.format_exc())
+        raise FileError(e)
+    filename = index.newest(package)
+    if filename is None:
         log_message = """Error checking for newest content file. Check if directorys ./panupv2-all-contents, ./panupv2-all-apps,
                         ./panupv2-all-apps, ./panup-all-wildfire, panupv2-all-wildfire  and ./panupv2-all-wildfire exists, and that files exits"""
         logging.error(log_message)
-        logging.error(traceback.format_exc())
-        raise FileError(e)
+        raise FileError(log_message)
+    return filename
 
 
 def get_passed_arguments():
     parser = argparse.ArgumentParser(description='Upload and install dynamic updates on Palo Alto Networks devices.')
     parser.add_argument('-l', '--loglevel', help="Set loglevel. Options: DEBUG, INFO, WARNING, ERROR or CRITICAL. Defaults to INFO")
-    parser.add_argument('-t', '--type', help="Set content type. Must be <appthreat/app/antivirus/wildfire/wildfire2/wf500", required=True)
+    parser.add_argument('-t', '--type', action='append', help="Set content type. Must be <appthreat/app/antivirus/wildfire/wildfire2/wf500. Several types can be comma separated, or -t can be repeated. Not needed with --apply")
     parser.add_argument('-w', action='store_true', help="When set, script wait for install job to complete on devices, and reports status")
     parser.add_argument('-e', action='store_true', help="When set, email is sent with status of install jobs.")
+    parser.add_argument('--email-digest', action='store_true', help="With -e, only send number of devices by result and the status messages of failed devices")
     parser.add_argument('-v', action='store_true', help="Verbose mode. Prints status messages to prompt")
+    parser.add_argument('--inventory-ttl', type=int, default=INVENTORY_TTL, metavar='SECONDS', help="Trust cached device content versions for SECONDS. 0 disables cache. Defaults to %s" % (INVENTORY_TTL))
+    parser.add_argument('--refresh', action='store_true', help="Invalidate cached device content versions, and query all devices")
+    parser.add_argument('-p', '--parallel', type=int, default=1, metavar='N', help="Process up to N devices in parallel. Defaults to 1 (one device at a time)")
+    parser.add_argument('--waves', metavar='PERCENTAGES', help="Staged rollout. Comma separated share of devices done after each wave, for example 1,10,50,100")
+    parser.add_argument('--wave-parallel', metavar='NUMBERS', help="Devices processed in parallel in each wave, for example 1,4,16,32. Defaults to --parallel for all waves")
+    parser.add_argument('--distribution', choices=['push', 'scp'], default='push', help="push - upload files from this host to each device (default). scp - devices pull files from SCP server set in config.conf")
+    parser.add_argument('--plan', metavar='FILE', help="Only find which devices need which content files, and write rollout plan to FILE as JSON")
+    parser.add_argument('--apply', metavar='FILE', help="Install content files on devices as planned in FILE, written by --plan")
+    parser.add_argument('--resume', action='store_true', help="Continue interrupted run from %s. Finished devices are skipped, and running install jobs are followed instead of started again" % (JOURNAL_FILE))
+    parser.add_argument('--metrics-json', metavar='FILE', help="Write timings of each phase (connect, system info, upload, job start, job, polls) for each device to FILE as JSON")
+    parser.add_argument('--metrics-prom', metavar='FILE', help="Write timing histograms and run results to FILE for the Prometheus node exporter textfile collector")
+    parser.add_argument('--daemon', action='store_true', help="Keep running, and roll out new files as soon as they are added to the content folders")
+    parser.add_argument('--settle', type=int, default=SETTLE, metavar='SECONDS', help="Daemon mode. Wait until content folders have had no changes for SECONDS before rollout. Defaults to %s" % (SETTLE))
+    parser.add_argument('--status-port', type=int, default=STATUS_PORT, metavar='PORT', help="Daemon mode. Port for status server on %s. 0 disables. Defaults to %s" % (STATUS_ADDRESS, STATUS_PORT))
+    parser.add_argument('--shards', type=int, metavar='N', help="Sharded run. Devices are split in N shards over N runner hosts sharing --shard-store")
+    parser.add_argument('--shard-index', type=int, metavar='I', help="Shard processed by this runner, 0 to N-1")
+    parser.add_argument('--shard-by', choices=['hash', 'site'], default='hash', help="Split devices by hash of hostname (default), or keep devices with the same site= in one shard")
+    parser.add_argument('--shard-store', default=SHARD_STORE, metavar='FILE', help="SQLite lease store shared by runners. Defaults to %s" % (SHARD_STORE))
+    parser.add_argument('--probe-timeout', type=int, default=PROBE_TIMEOUT, metavar='SECONDS', help="Probe all devices before rollout, and skip devices not answering within SECONDS. 0 disables probe. Defaults to %s" % (PROBE_TIMEOUT))
+    parser.add_argument('--results', metavar='FILE', help="Append result of each device to FILE as a JSON line as soon as it is done")
+    parser.add_argument('--webhook', metavar='URL', help="POST result of each device to URL as JSON as soon as it is done")
+    parser.add_argument('--max-failures', type=float, metavar='PERCENT', help="Stop rollout when more than PERCENT of processed devices have failed")
     return parser.parse_args()
 
 
@@ -108,6 +196,7 @@ def parse_config_file(email,verbose):
     smtpuser = None
     smtppass = None
     smtpreceivers = []
+    scp = {}  # SCP server settings for --distribution scp
     try:
         object = open(CONFIG_FILE, "r")
     except Exception as e:
@@ -125,6 +214,7 @@ def parse_config_file(email,verbose):
             elif type == "smtpreceiver": smtpreceivers.append(value.rstrip())
             elif type == "smtpuser": smtpuser = value.rstrip()
             elif type == "smtppass": smtppass = value.rstrip()
+            elif type in ("scphost", "scpport", "scpuser", "scppass", "scppath"): scp[type] = value.rstrip()
             else:
                 log_message = "Error parsing config file at line %s" % (line.rstrip())
                 logging.error(log_message)
@@ -137,11 +227,29 @@ def parse_config_file(email,verbose):
             emailobj.smtppass = smtppass
     else: emailobj = None
     if apikey is None: raise ApiKeyException("No API-KEY configued in config file")
-    return emailobj,apikey
+    return emailobj,apikey,scp
+
+
+def create_scp_source(scp):
+    # SCP server from scp settings in config.conf
+    for setting in ("scphost", "scpuser", "scppath"):
+        if setting not in scp:
+            log_message = "%s must be set in config file for --distribution scp" % (setting)
+            logging.error(log_message)
+            raise FileError(log_message)
+    port = scp.get("scpport")
+    if port is not None and not port.isdigit():
+        log_message = "scpport in config file must be a number"
+        logging.error(log_message)
+        raise FileError(log_message)
+    return ScpSource(scp["scphost"], scp["scpuser"], scp.get("scppass"), scp["scppath"], port)
 
 
-def parse_devices_file(apikey,verbose,package):
+def parse_devices_file(apikey,verbose,package,jobtracker,pool):
+    # Returns list of devices, and dict of settings. Settings are lines without comma (<setting>=<value>),
+    # stored as a list of values for each setting as some settings can be repeated.
     fw_list = []
+    settings = {}
     try:
         object = open(DEVICES_FILE, "r")
     except Exception as e:
@@ -149,19 +257,79 @@ def parse_devices_file(apikey,verbose,package):
         logging.error(traceback.format_exc())
         raise FileError(e)
     for i, line in enumerate(object):
-        if not line.startswith("#"):
-            ip = line.split(',',1)[-2].rstrip()
-            name = line.split(',',1)[-1].rstrip()
-            fw = PanOsDevice(ip,apikey,name,API_TIMEOUT,verbose,package)
+        if not line.startswith("#") and line.strip() and ',' not in line:
+            setting, value = line.split('=',1)[0].strip(), line.split('=',1)[-1].strip()
+            if '=' not in line or setting not in DEVICES_SETTINGS:
+                log_message = "Error parsing devices file at line %s. Unknown setting" % (line.rstrip())
+                logging.error(log_message)
+                raise FileError(log_message)
+            settings.setdefault(setting, []).append(value)
+        elif not line.startswith("#") and line.strip():
+            # Format: <ip/hostname>,<name>[,<option>=<value>,...]
+            fields = [field.strip() for field in line.split(',')]
+            ip = fields[0]
+            name = fields[1]
+            options = {}
+            for field in fields[2:]:
+                if '=' not in field:
+                    log_message = "Error parsing devices file at line %s. Options must be <option>=<value>" % (line.rstrip())
+                    logging.error(log_message)
+                    raise FileError(log_message)
+                option, value = field.split('=',1)
+                options[option.strip()] = value.strip()
+            if "timeout" in options and not options["timeout"].isdigit():
+                log_message = "Error parsing devices file at line %s. timeout must be a number of seconds" % (line.rstrip())
+                logging.error(log_message)
+                raise FileError(log_message)
+            if options.get("type") == "panorama" and "ha" in options:
+                log_message = "Error parsing devices file at line %s. ha is not supported for Panorama" % (line.rstrip())
+                logging.error(log_message)
+                raise FileError(log_message)
+            if options.get("type") == "panorama": fw = Panorama(ip,apikey,name,API_TIMEOUT,verbose,package,jobtracker,pool)
+            else: fw = PanOsDevice(ip,apikey,name,API_TIMEOUT,verbose,package,jobtracker,pool)
+            fw.options = options
             fw_list.append(fw)
+    object.close()
     if not fw_list:
         log_message = "No devices in devices file(devices.conf). Please add firewalls there, or don't use -f"
         logging.error(log_message)
         raise FileError("log_message")
-    return fw_list
+    return fw_list, settings
+
+
+def create_upload_scheduler(settings, history):
+    # Upload scheduler with bandwidth limits and retry settings from devices.conf
+    try:
+        global_rate = None
+        if "bandwidth" in settings: global_rate = parse_rate(settings["bandwidth"][-1])
+        site_rates = {}
+        for value in settings.get("site-bandwidth", []):
+            site, rate = value.split(':',1)
+            site_rates[site.strip()] = parse_rate(rate)
+        retries = int(settings.get("upload-retries", [uploadsched.RETRIES])[-1])
+        deadline = int(settings.get("upload-deadline", [uploadsched.DEADLINE])[-1])
+    except (ValueError, UploadScheduleError) as e:
+        log_message = "Error in upload settings in devices file: %s" % (e)
+        logging.error(log_message)
+        raise FileError(log_message)
+    return UploadScheduler(history, global_rate, site_rates, retries=retries, deadline=deadline)
+
 
+def create_timeout_policy(settings, history):
+    # Timeouts learned from history, with fixed timeouts per model from devices.conf
+    model_timeouts = {}
+    try:
+        for value in settings.get("model-timeout", []):
+            model, timeout = value.split(':',1)
+            model_timeouts[model.strip()] = int(timeout)
+    except ValueError as e:
+        log_message = "Error in model-timeout setting in devices file: %s" % (e)
+        logging.error(log_message)
+        raise FileError(log_message)
+    return TimeoutPolicy(history, API_TIMEOUT, model_timeouts)
 
-def start_logging(args="loglevel"):
+
+def start_logging(args="loglevel", parallel=False):
 	global loglevel  # Need to change global loglevel variable
 	# Setting log level and logfile
 	if args is None:
@@ -173,18 +341,12 @@ def start_logging(args="loglevel"):
 		log_message = "Unknown loglevel type: %s" % args
 		print log_message
 		sys.exit()
+	# When devices are processed in parallel, tag each line with the worker thread name (set to device name)
+	if parallel: logformat = '%(asctime)s - %(levelname)s - [%(threadName)s] %(message)s'
+	else: logformat = '%(asctime)s - %(levelname)s - %(message)s'
 	# Set logging.basicConfig based on loglevel
 	try:
-		if loglevel == "DEBUG":
-			logging.basicConfig(filename=LOG_FILE, level=logging.DEBUG, format='%(asctime)s - %(levelname)s -  %(message)s', datefmt='%Y/%m/%d %H:%M:%S')
-		elif loglevel == "INFO":
-			logging.basicConfig(filename=LOG_FILE, level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y/%m/%d %H:%M:%S')
-	        elif loglevel == "WARNING":
-        	        logging.basicConfig(filename=LOG_FILE, level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y/%m/%d %H:%M:%S')
-	        elif loglevel == "ERROR":
-        	        logging.basicConfig(filename=LOG_FILE, level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y/%m/%d %H:%M:%S')
-	        elif loglevel == "CRITICAL":
-        	        logging.basicConfig(filename=LOG_FILE, level=logging.CRITICAL, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y/%m/%d %H:%M:%S')
+		logging.basicConfig(filename=LOG_FILE, level=getattr(logging, loglevel), format=logformat, datefmt='%Y/%m/%d %H:%M:%S')
 	except Exception as e:
 		print "ERROR setting logging level"
 		print(e)
@@ -193,90 +355,746 @@ def start_logging(args="loglevel"):
 	logging.info("Script started, and logging to file initialized")
 
 
+def install_status_messages(device, content_file, package, future, inventory=None):
+    # Wait for install job started with install_async(), and return the status message for it - one per install job
+    try:
+        install_status = device.wait_for_install(future, content_file, package)
+    except InstallError as e:
+        return ["ERROR: %s" % (str(e))] #If we get installerror - it is the status of the job
+    if not install_status:
+        return ["UNKNOWN: Installation of %s to %s - %s returned unknown status. Check logfile for more details" % (content_file, device.hostname, device.name)]
+    device.set_installed_version(content_file, package)
+    if inventory is not None: inventory.update(device)
+    return ["SUCCESS: Installation of %s to %s - %s successfully completed" % (content_file, device.hostname, device.name)]
+
+
+def process_panorama(panorama, content_files, wait):
+    # Upload each content file once to Panorama, and install it on managed firewalls needing it in batched jobs.
+    statuslist = []
+    try:
+        managed_devices = panorama.find_managed_devices()
+    except UploadError as e:
+        log_message = "ERROR: Unable to find devices connected to Panorama %s. Skipping Panorama" % (panorama.name)
+        statuslist.append(log_message)
+        logging.error(log_message)
+        logging.error(str(e))
+        return statuslist
+    logging.info("Found %s firewalls connected to Panorama %s" % (len(managed_devices), panorama.name))
+    running = []  # (file, serials, future) for install jobs of previous content type
+    for package, content_file in content_files:
+        serials = panorama.devices_needing_update(managed_devices, content_file, package)
+        if not serials:
+            statuslist.append("SKIPPED: Upload of %s to Panorama %s - %s. All connected firewalls have the same or newer version" % (content_file, panorama.hostname, panorama.name))
+            continue
+        try:
+            panorama.import_file(content_file, package)
+        except UploadError as e:
+            log_message = "ERROR: Error while uploading %s to Panorama %s. Skipping content file" % (content_file, panorama.hostname)
+            logging.error(log_message)
+            logging.error(str(e))
+            statuslist.append(log_message)
+            continue
+        statuslist.append("SUCCESS: Upload of %s to Panorama %s - %s" % (content_file, panorama.hostname, panorama.name))
+        # Install jobs for previous content type must be done before next one is started
+        statuslist.extend(panorama_status_messages(panorama, running))
+        try:
+            running = [(content_file, batch, future) for batch, future in panorama.install_to_devices(content_file, serials, package)]
+        except InstallError as e:
+            statuslist.append("ERROR: %s" % (str(e)))
+            running = []
+    if wait:
+        statuslist.extend(panorama_status_messages(panorama, running))
+    else:
+        for content_file, batch, future in running:
+            statuslist.append("SUCCESS: Installation of %s to %s through Panorama %s started. Did not wait for completion" % (content_file, ",".join(batch), panorama.name))
+    return statuslist
+
+
+def panorama_status_messages(panorama, running):
+    # Wait for install jobs started through Panorama, and return status messages for them
+    statuslist = []
+    for content_file, batch, future in running:
+        try:
+            panorama.wait_for_install(future, content_file)
+            statuslist.append("SUCCESS: Installation of %s to %s through Panorama %s successfully completed" % (content_file, ",".join(batch), panorama.name))
+        except InstallError as e:
+            statuslist.append("ERROR: %s. Firewalls: %s" % (str(e), ",".join(batch)))
+    return statuslist
+
+
+def process_device(device, content_files, wait, inventory=None, journal=None):
+    # Runs check, upload and install of all content types for a single device, and records progress in journal.
+    # Returns list of status messages for the device.
+    statuslist = []
+    if journal is not None and journal.finished(device, content_files):
+        statuslist.append("SKIPPED: %s - %s was finished by interrupted run (journal)" % (device.hostname, device.name))
+        return statuslist
+    statuslist = update_device(device, content_files, wait, inventory, journal)
+    if journal is not None: journal.finish(device, content_files, device_failed(statuslist))
+    return statuslist
+
+
+def update_device(device, content_files, wait, inventory=None, journal=None):
+    # Runs check, upload and install of all content types for a single device. content_files is a list of
+    # (content type, file name). Returns list of status messages for the device.
+    # Any error is contained here, so one failing device never stops processing of the others.
+    statuslist = []
+    # Name worker thread after device, so log lines from parallel runs can be told apart
+    thread = threading.current_thread()
+    threadname = thread.name
+    thread.name = device.name
+    try:
+        if isinstance(device, Panorama): return process_panorama(device, content_files, wait)
+        # Content files with install job started or done in an interrupted run, from journal
+        resumed = {}
+        if journal is not None:
+            for package, content_file in content_files:
+                record = journal.entry(device, package, content_file)
+                if record is not None and record["phase"] in ("job", "started", "installed"): resumed[package] = record
+        # Devices already at or above version in all content files according to inventory cache are skipped without any API call
+        if inventory is not None and inventory.load(device):
+            if not [package for package, content_file in content_files if device.needs_update(content_file, package)]:
+                for package, content_file in content_files:
+                    statuslist.append("SKIPPED: Upload of %s to %s - %s. Cached content version is the same or newer" % (content_file, device.hostname, device.name))
+                return statuslist
+        # Check and set installed versions on device - one check covers all content types. Not needed when all were resumed.
+        if len(resumed) < len(content_files):
+            try:
+                device.check_installed_version()
+            except UploadError as e:
+                log_message = "ERROR: Timeout when checking current content versions for device %s. Skipping device" % (device.name)
+                statuslist.append(log_message)
+                logging.error(log_message)
+                logging.error(str(e))
+                return statuslist # go to next device if we could not check current versions on device
+            if inventory is not None: inventory.update(device)
+            if journal is not None: journal.record(device, "checked")
+        # Content types are handled in order. Upload of next file runs while install job of previous file is running,
+        # but only one install job is started at a time on device.
+        running = None  # (package, file, future) of install job running on device
+        for package, content_file in content_files:
+            record = resumed.get(package)
+            if record is not None:
+                if record["phase"] == "installed" or (record["phase"] == "started" and not wait):
+                    statuslist.append("SKIPPED: Installation of %s on %s - %s was %s by interrupted run (journal)" % (content_file, device.hostname, device.name, record["phase"]))
+                    continue
+                # Install job is still running, or its result is not known. Re-attach to it instead of uploading and installing again.
+                if running is not None:
+                    statuslist.extend(install_status_messages(device, running[1], running[0], running[2], inventory))
+                    running = None
+                logging.info("Re-attaching to install job %s of %s on %s" % (record["jobid"], content_file, device.name))
+                future = device.track_job(record["jobid"])
+                if journal is not None: journal.track(device, package, content_file, future)
+                running = (package, content_file, future)
+                continue
+            # Skip content types where device already has the same or newer version
+            if not device.needs_update(content_file, package):
+                statuslist.append("SKIPPED: Upload of %s to %s - %s. Content version we tried to install is the same or older as current version" % (content_file, device.hostname, device.name))
+                continue
+            # File uploaded by an earlier run where install failed or timed out is not uploaded again
+            if device.has_file(content_file, package):
+                statuslist.append("SUCCESS: %s already on %s - %s. Upload skipped" % (content_file, device.hostname, device.name))
+            else:
+                try:
+                    device.upload_to_device(content_file, package)
+                except UploadError as e:
+                    log_message = "ERROR: Error while uploading %s to %s. Skipping content file" % (content_file, device.hostname)
+                    logging.error(log_message)
+                    logging.error(str(e))
+                    statuslist.append(log_message)
+                    continue
+                statuslist.append("SUCCESS: Upload of %s to %s - %s" % (content_file, device.hostname, device.name))
+                if journal is not None: journal.record(device, "uploaded", package, content_file)
+            # Previous install job must be done before next one is started
+            if running is not None:
+                statuslist.extend(install_status_messages(device, running[1], running[0], running[2], inventory))
+                running = None
+            # Run install job. Job is tracked if we wait for it, or if another content type might follow it.
+            try:
+                if wait or (package, content_file) != content_files[-1]:
+                    running = (package, content_file, device.install_async(content_file, package=package))
+                    if journal is not None: journal.track(device, package, content_file, running[2])
+                else:
+                    jobid = device.start_install(content_file, package)
+                    if journal is not None: journal.record(device, "started", package, content_file, jobid)
+                    statuslist.append("""SUCCESS: Installation of %s to %s - %s started.
+                                                    Did not wait for completion""" % (content_file, device.hostname, device.name))
+            except InstallError as e:
+                statuslist.append("ERROR: %s" % (str(e)))
+        # Last install job is only waited for when -w is set
+        if running is not None and wait:
+            statuslist.extend(install_status_messages(device, running[1], running[0], running[2], inventory))
+        elif running is not None:
+            statuslist.append("""SUCCESS: Installation of %s to %s - %s started.
+                                                    Did not wait for completion""" % (running[1], device.hostname, device.name))
+    except Exception as e:
+        log_message = "ERROR: Unexpected error while processing device %s - %s. Skipping device" % (device.hostname, device.name)
+        logging.error(log_message)
+        logging.error(traceback.format_exc())
+        statuslist.append(log_message)
+    finally:
+        thread.name = threadname
+    return statuslist
+
+
+def device_failed(statuslist):
+    # Device is counted as failed in a staged rollout if any step failed, or install status is unknown
+    for status in statuslist:
+        if status.startswith("ERROR") or status.startswith("UNKNOWN"): return True
+    return False
+
+
+def process_devices(device_list, content_files, wait, rollout, results, inventory=None, scheduler=None, journal=None, progress=None, plan=None, prober=None, shard=None):
+    # Process all devices in waves given by rollout, each wave serially or on a bounded pool of worker threads.
+    # Status messages of each device are emitted to results as soon as the device is done, and are not kept here.
+    # Devices in an HA group are one unit: peers are updated one at a time, passive first, and each peer's install
+    # job is waited for before the next peer is started. Peers after one that failed or was skipped are not updated.
+    # Upload scheduler decides the order units are started in within a wave.
+    # With a plan, each device only gets the content files planned for it.
+    # Before each wave, devices in it that still need work are probed, and devices not answering are skipped.
+    # In a sharded run, the result of each device is stored in the shard store when it is done.
+    order = None
+    if scheduler is not None:
+        def order(wave):
+            # Units in order of their first device in upload order
+            position = dict((id(device), number) for number, device in enumerate(scheduler.order([device for unit in wave for device in unit])))
+            return sorted(wave, key=lambda unit: min(position[id(device)] for device in unit))
+    def aborted(unit):
+        for device in unit: finish(device, ["ABORTED: %s - %s not updated. Rollout stopped because too many devices failed" % (device.hostname, device.name)])
+        return False
+    def finish(device, statuslist):
+        if shard is not None: shard.complete(device, statuslist)
+        results.emit(device, statuslist)
+        return statuslist
+    def device_files(device):
+        if plan is not None: return plan.files(device.hostname)
+        return content_files
+    unreachable = {}  # Hostname and reason, from probe
+    def needs_work(device):
+        # False when device is skipped without updating anything, so devices are only probed, and HA state only read,
+        # where it matters
+        if device.hostname in unreachable: return False
+        files = device_files(device)
+        if not files: return False
+        if journal is not None and journal.finished(device, files): return False
+        if inventory is not None and inventory.load(device):
+            return bool([package for package, content_file in files if device.needs_update(content_file, package)])
+        return True
+    def process_unit(unit):
+        # Returns True if any device in unit failed
+        if len(unit) == 1: return device_failed(finish(unit[0], process_one(unit[0], wait)))
+        peers = unit
+        if len([device for device in unit if needs_work(device)]) > 1: peers = ha_order(unit)
+        failed = False
+        held = None
+        for number, device in enumerate(peers):
+            if held is not None:
+                finish(device, ["SKIPPED: %s - %s not updated. HA peer %s was not updated" % (device.hostname, device.name, held.name)])
+                continue
+            # Install job is waited for on all but the last peer, so peers never install at the same time
+            statuslist = finish(device, process_one(device, wait or number < len(peers) - 1))
+            failed = failed or device_failed(statuslist)
+            if device_failed(statuslist) or device.hostname in unreachable: held = device
+        return failed
+    def probe(wave):
+        if prober is None: return
+        unreachable.update(probe_devices(prober, [device for unit in wave for device in unit if needs_work(device)]))
+    def process_one(device, wait):
+        if device.hostname in unreachable:
+            return ["SKIPPED: %s - %s. Device unreachable: %s" % (device.hostname, device.name, unreachable[device.hostname])]
+        files = device_files(device)
+        if not files: return ["SKIPPED: %s - %s. No content files planned for device" % (device.hostname, device.name)]
+        if progress is None: return process_device(device, files, wait, inventory, journal)
+        progress.started(device)
+        try:
+            return process_device(device, files, wait, inventory, journal)
+        finally:
+            progress.finished(device)
+    rollout.run(ha_groups(device_list), process_unit, bool, aborted, order, probe)
+
+
+def parse_percentages(value, name):
+    # List of integers from comma separated argument value
+    try:
+        return [int(number) for number in value.split(',')]
+    except ValueError:
+        print "%s must be a comma separated list of numbers" % (name)
+        sys.exit()
+
+
+def parse_rollout_options(args):
+    # Waves, concurrency per wave and failure threshold. Without --waves all devices are done in one wave, with --parallel workers.
+    if args.waves: waves = parse_percentages(args.waves, "--waves")
+    else: waves = [100]
+    if args.wave_parallel: concurrency = parse_percentages(args.wave_parallel, "--wave-parallel")
+    else: concurrency = [args.parallel]
+    try:
+        WaveScheduler(waves, concurrency, args.max_failures)
+    except RolloutError as e:
+        print str(e)
+        sys.exit()
+    return waves, concurrency, args.max_failures
+
+
+def find_content_files(content_types, index, validator=None):
+    # Newest file of each content type. Files are validated before anything is uploaded.
+    content_files = [(content_type, find_newest_file(content_type, index)) for content_type in content_types]
+    if validator is not None: validate_content_files(content_files, index, validator)
+    return content_files
+
+
+def validate_content_files(content_files, index, validator):
+    # A corrupt, truncated or misnamed file stops the rollout, instead of being uploaded to every device and failing to install
+    try:
+        for package, content_file in content_files:
+            try:
+                validator.validate(PACKAGE[package], content_file, index.digest(package, content_file), index.older_sizes(package, content_file))
+            except ValidationError as e:
+                log_message = "Content file %s is not valid, and is not rolled out. %s" % (content_file, e)
+                logging.error(log_message)
+                raise FileError(log_message)
+    finally:
+        try:
+            validator.save()
+        except (IOError, OSError) as e:
+            logging.error("Unable to write validation cache %s: %s" % (VALIDATION_FILE, e))
+
+
+def start_metrics(device_list):
+    # New Metrics for a rollout, recording timings for all devices and the shared connection pool.
+    # Returns metrics, and connection and job poll counters at start, as these are counted for the whole process.
+    metrics = Metrics()
+    baseline = None
+    for device in device_list: device.metrics = metrics
+    if device_list:
+        device_list[0].pool.metrics = metrics
+        baseline = device_list[0].pool.stats()
+        baseline["poll_calls"] = device_list[0].jobtracker.api_calls
+    return metrics, baseline
+
+
+def write_metrics(metrics, baseline, device_list, summary, metrics_json, metrics_prom):
+    # Results, connections and job polls of the rollout are added as gauges, and report files written
+    metrics.finish()
+    for result, count in sorted(summary.messages.items()):
+        metrics.gauge("status_messages", "Status messages from last run by result", count, {"result": result})
+    metrics.gauge("devices", "Devices in devices.conf", len(device_list))
+    for device in device_list: device.metrics = None
+    if baseline is not None:
+        pool = device_list[0].pool
+        pool.metrics = None
+        stats = pool.stats()
+        metrics.gauge("connections_opened", "HTTPS connections opened in last run", stats["opened"] - baseline["opened"])
+        metrics.gauge("connections_reused", "Requests sent on reused HTTPS connections in last run", stats["reused"] - baseline["reused"])
+        metrics.gauge("job_poll_calls", "API calls used to poll jobs in last run", device_list[0].jobtracker.api_calls - baseline["poll_calls"])
+    try:
+        if metrics_json: metrics.write_json(metrics_json)
+        if metrics_prom: metrics.write_prometheus(metrics_prom)
+    except (IOError, OSError) as e:
+        logging.error("Unable to write metrics: %s" % (e))
+
+
+def content_file_sizes(content_files, index):
+    sizes = []
+    for package, content_file in content_files:
+        entry = index.entry(package, content_file)
+        if entry is not None: sizes.append(entry["size"])
+        else: sizes.append(path.getsize(path.join(PACKAGE[package], content_file)))
+    return sizes
+
+
+def run_rollout(device_list, content_files, wait, rollout_options, index, inventory, scheduler, history, journal, results, metrics_json=None, metrics_prom=None, verbose=False, plan=None, prober=None, shard_runner=None):
+    # One rollout of content files to all devices. Done once per run, or each time new files are found in daemon mode.
+    # Result of each device is emitted to results when the device is done.
+    waves, concurrency, max_failures = rollout_options
+    for content_type, content_file in content_files:
+        logging.info("Newest %s file is %s (sha256 %s)" % (content_type, content_file, index.digest(content_type, content_file)))
+    metrics = None
+    if metrics_json or metrics_prom: metrics, baseline = start_metrics(device_list)
+    journal.begin(content_files)
+    # Fleet ETA from expected time for each device, learned from history. Sharded runs only estimate their own shard.
+    files = [(package, size) for (package, content_file), size in zip(content_files, content_file_sizes(content_files, index))]
+    estimated = device_list
+    if shard_runner is not None: estimated = [device for device in device_list if shard_runner.assignment[device.hostname] == shard_runner.shard]
+    progress = Progress(estimated, lambda device: device.timeouts.expected(device, files, wait), max(concurrency), verbose)
+    # Devices needing work are probed before each wave, so dead devices don't each use the full API timeout
+    def process(devices):
+        if not devices: return
+        process_devices(devices, content_files, wait, WaveScheduler(waves, concurrency, max_failures), results, inventory, scheduler, journal, progress, plan, prober, shard_runner)
+    progress.start()
+    try:
+        if shard_runner is None: process(device_list)
+        else: shard_runner.run(device_list, process)
+    finally:
+        progress.stop()
+    save_cache(history, HISTORY_FILE, "history")
+    if inventory is not None: save_cache(inventory, INVENTORY_FILE, "inventory cache")
+    if metrics is not None: write_metrics(metrics, baseline, device_list, results.summary, metrics_json, metrics_prom)
+
+
+def save_cache(cache, filename, description):
+    # Caches only save work in later runs, so a failed write (full disk, read-only folder) is logged and the run goes on
+    try:
+        cache.save()
+    except (IOError, OSError) as e:
+        logging.error("Unable to write %s %s: %s" % (description, filename, e))
+
+
+def probe_devices(prober, device_list):
+    # Hostname and reason for devices not answering the probe. Empty when probe is disabled
+    if prober is None or not device_list: return {}
+    unreachable = prober.probe(device_list)
+    if prober.breaker is None: return unreachable
+    try:
+        prober.breaker.save()
+    except (IOError, OSError) as e:
+        logging.error("Unable to write circuit breaker state %s: %s" % (BREAKER_FILE, e))
+    return unreachable
+
+
+def create_shard_runner(args, device_list, content_files):
+    # Runner for this host's shard, with leases in the shared store for the rollout of content_files
+    try:
+        assignment = assign_shards(device_list, args.shards, args.shard_by)
+        store = LeaseStore(args.shard_store, rollout_id(content_files))
+    except ShardError as e:
+        logging.error(str(e))
+        raise FileError(e)
+    logging.info("Sharded run as %s: shard %s of %s by %s, store %s" % (store.owner, args.shard_index, args.shards, args.shard_by, args.shard_store))
+    return ShardRunner(store, args.shard_index, args.shards, assignment)
+
+
+def plan_device(device, content_files, inventory=None):
+    # Content files device needs, from installed versions in inventory cache or asked from device.
+    # Returns (files, versions, error). Firewalls behind Panorama are found again on --apply, as they may change.
+    thread = threading.current_thread()
+    threadname = thread.name
+    thread.name = device.name
+    try:
+        if isinstance(device, Panorama):
+            managed_devices = device.find_managed_devices()
+            files = [(package, content_file) for package, content_file in content_files
+                     if device.devices_needing_update(managed_devices, content_file, package)]
+            return files, {}, None
+        if inventory is None or not inventory.load(device):
+            device.check_installed_version()
+            if inventory is not None: inventory.update(device)
+        versions = dict((field, getattr(device, field)) for field in VERSION_FIELDS)
+        files = [(package, content_file) for package, content_file in content_files if is_newer(content_file, device.installed_version(package))]
+        return files, versions, None
+    except UploadError as e:
+        logging.error("Unable to find content versions on %s. %s" % (device.name, e))
+        return [], {}, str(e)
+    except Exception as e:
+        logging.error("Unexpected error while planning device %s - %s" % (device.hostname, device.name))
+        logging.error(traceback.format_exc())
+        return [], {}, str(e)
+    finally:
+        thread.name = threadname
+
+
+def make_plan(device_list, content_files, index, inventory, workers, prober=None):
+    # Installed versions are found for all devices at the same time on up to workers threads.
+    # Nothing is uploaded or installed.
+    plan = RolloutPlan([(package, content_file, size, index.digest(package, content_file))
+                        for (package, content_file), size in zip(content_files, content_file_sizes(content_files, index))])
+    if device_list:
+        # Devices with valid cached versions are planned without any API call, and are not probed
+        unreachable = probe_devices(prober, [device for device in device_list if isinstance(device, Panorama) or inventory is None or not inventory.load(device)])
+        def plan_reachable(device):
+            if device.hostname in unreachable: return [], {}, "Device unreachable: %s" % (unreachable[device.hostname])
+            return plan_device(device, content_files, inventory)
+        from multiprocessing.pool import ThreadPool  # Imported when needed, to keep startup fast
+        pool = ThreadPool(min(workers, len(device_list)))
+        try:
+            results = pool.map(plan_reachable, device_list)
+        finally:
+            pool.close()
+            pool.join()
+        for device, (files, versions, error) in zip(device_list, results):
+            plan.add(device, files, versions, error)
+    if inventory is not None: save_cache(inventory, INVENTORY_FILE, "inventory cache")
+    return plan
+
+
+def load_plan(filename, index, validator=None):
+    # Plan written by --plan. Content files must still be in the content folders with the same sha256.
+    try:
+        plan = RolloutPlan.load(filename)
+    except PlanError as e:
+        logging.error(str(e))
+        raise FileError(e)
+    index.refresh()
+    for package, content_file, size, digest in plan.content_files:
+        filepath = path.join(PACKAGE[package], content_file)
+        if not path.isfile(filepath):
+            log_message = "%s in plan %s is not found in %s" % (content_file, filename, PACKAGE[package])
+            logging.error(log_message)
+            raise FileError(log_message)
+        # Hashed from file, as the index only rescans folders when their mtime changes
+        if file_digest(filepath) != digest:
+            log_message = "%s has changed since plan %s was made (sha256 differs)" % (content_file, filename)
+            logging.error(log_message)
+            raise FileError(log_message)
+    index.save()
+    if validator is not None: validate_content_files([(package, content_file) for package, content_file, size, digest in plan.content_files], index, validator)
+    summary = plan.summary()
+    logging.info("Applying plan %s from %s: %s of %s devices, %s bytes" % (filename, time.strftime("%Y/%m/%d %H:%M:%S", time.localtime(plan.created)), summary["needing_update"], summary["devices"], summary["bytes"]))
+    return plan
+
+
+def report_plan(plan, filename, verbose):
+    summary = plan.summary()
+    log_message = "Plan written to %s: %s of %s devices need updates (%s bytes), %s up to date, %s did not answer" % (
+        filename, summary["needing_update"], summary["devices"], summary["bytes"], summary["up_to_date"], summary["errors"])
+    logging.info(log_message)
+    if verbose:
+        for entry in plan.devices:
+            if entry["files"]: print "%s - %s: %s (%s bytes)" % (entry["hostname"], entry["name"], ", ".join(planned["file"] for planned in entry["files"]), entry["bytes"])
+            elif "error" in entry: print "%s - %s: ERROR %s" % (entry["hostname"], entry["name"], entry["error"])
+        print log_message
+
+
+def create_result_stream(args, verbose, emailobj, email, content_files):
+    # Status messages go to logfile, to stdout with -v, to the results file and webhook as each device is done.
+    # With -e all status messages are sent by e-mail when the rollout is done, or a digest with --email-digest.
+    sinks = [LogSink()]
+    if verbose: sinks.append(StdoutSink())
+    if args.results:
+        try:
+            sinks.append(FileSink(args.results))
+        except IOError as e:
+            log_message = "Unable to open results file %s: %s" % (args.results, e)
+            logging.error(log_message)
+            raise FileError(log_message)
+    if args.webhook: sinks.append(WebhookSink(args.webhook))
+    if email: sinks.append(EmailSink(emailobj, args.email_digest))
+    return ResultStream(sinks, content_files)
+
+
+def report_merged(shard_runner, device_list, verbose, emailobj, email, digest=False):
+    # Summary of all shards, from results in the shard store. Devices were logged by the runner processing them.
+    sinks = []
+    if email: sinks.append(EmailSink(emailobj, digest))
+    merged = ResultStream(sinks)
+    for device, statuslist in shard_runner.merged_results(device_list): merged.emit(device, statuslist)
+    logging.info("Merged results of all shards: %s" % (merged.summary.counts()))
+    if verbose: print "Merged results of all shards: %s" % (merged.summary.counts())
+    merged.close()
+
+
+def run_daemon(args, device_list, content_types, wait, rollout_options, index, inventory, scheduler, history, journal, emailobj, verbose, prober=None, validator=None):
+    # Roll out newest files at start, and then each time files in the content folders change.
+    # Devices, inventory cache, job tracker and connections are kept between rollouts.
+    watcher = DirectoryWatcher([PACKAGE[content_type] for content_type in content_types], args.settle)
+    lock = threading.Lock()
+    trigger = threading.Event()
+    status = {"state": "starting", "started": time.time(), "rollouts": 0, "content_files": {}, "last_rollout": None, "error": None}
+    def get_status():
+        with lock:
+            current = dict(status)
+            current["trigger_pending"] = trigger.is_set()
+            return current
+    def set_status(**values):
+        with lock: status.update(values)
+    def request_rollout():
+        logging.info("Rollout requested through status server")
+        trigger.set()
+        watcher.wake()
+    server = None
+    if args.status_port:
+        server = StatusServer(STATUS_ADDRESS, args.status_port, get_status, request_rollout)
+        server.start()
+    # SIGTERM stops daemon the same way as Ctrl-C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    rolled_out = None
+    forced = True  # Newest files are rolled out when daemon starts
+    try:
+        while True:
+            if trigger.is_set():
+                trigger.clear()
+                forced = True
+            if not forced:
+                set_status(state="watching")
+                changed = watcher.wait()
+                if trigger.is_set(): continue  # Rollout is forced at start of loop
+                if not changed: continue
+                logging.info("Changes found in %s" % (", ".join(changed)))
+            try:
+                content_files = find_content_files(content_types, index, validator)
+            except Exception as e:
+                # FileError is logged where it is raised. Anything else is unexpected, and logged with traceback.
+                if not isinstance(e, FileError): logging.error(traceback.format_exc())
+                set_status(state="error", error=str(e))
+                forced = False
+                continue
+            if content_files == rolled_out and not forced:
+                logging.info("No new content files found")
+                continue
+            forced = False
+            started = time.time()
+            set_status(state="running", content_files=dict(content_files), error=None)
+            # A failed rollout is reported, and the daemon keeps watching. Files are rolled out again on next change or trigger.
+            results = ResultStream([])
+            error = None
+            try:
+                results = create_result_stream(args, verbose, emailobj, args.e, content_files)
+                run_rollout(device_list, content_files, wait, rollout_options, index, inventory, scheduler, history, journal, results, args.metrics_json, args.metrics_prom, verbose, prober=prober)
+                rolled_out = content_files
+            except Exception as e:
+                error = "Rollout of %s failed: %s" % (", ".join(content_file for package, content_file in content_files), e)
+                logging.error(error)
+                logging.error(traceback.format_exc())
+            finally:
+                results.close()
+            summary = results.summary
+            with lock:
+                status["rollouts"] += 1
+                status["last_rollout"] = {"started": started, "finished": time.time(), "content_files": dict(content_files), "results": dict(summary.messages),
+                                          "devices": dict(summary.results), "failures": list(summary.failures), "error": error}
+                if error is not None: status.update(state="error", error=error)
+    except (KeyboardInterrupt, SystemExit):
+        logging.info("Daemon stopped")
+    finally:
+        if server is not None: server.stop()
+        watcher.close()
+
+
 def main():
     # Get passed arguments
     args = get_passed_arguments()
-    statuslist = [] # list used for storeing status messages
     # Setting verbose if set - false is default
     if args.v: verbose = True
     else: verbose = False
+    if args.parallel < 1:
+        print "--parallel must be 1 or higher"
+        sys.exit()
+    parallel = args.parallel > 1 or args.wave_parallel is not None
     # Start logging
     if args.loglevel:
-        if args.loglevel in LOGLEVELS: start_logging(args.loglevel)
+        if args.loglevel in LOGLEVELS: start_logging(args.loglevel, parallel)
         else:
             log_message = "Unsupported log leve set %s. Exiting...." % (args.loglevel)
             logging.error(log_message)
             if verbose: print log_message
             sys.exit()
-    else: start_logging("INFO")  # INFO is default
+    else: start_logging("INFO", parallel)  # INFO is default
     # Set content type based on user input. Exit if -t is not set
-    if not args.type:
+    if not args.type and not args.apply:
         log_message = "-t content-type is mandatory. Please see -h for more info"
         logging.error(log_message)
         print log_message
         sys.exit()
-    content_type = args.type
-    if content_type not in PACKAGE:
-        log_message = "Unsupported value set for content-type. Please check -h for help"
-        print log_message
-        logging.error(log_message)
+    # Several content types can be given as -t a,b or -t a -t b. Duplicates are ignored.
+    content_types = []
+    for value in args.type or []:
+        for content_type in value.split(','):
+            content_type = content_type.strip()
+            if content_type not in PACKAGE:
+                log_message = "Unsupported value set for content-type. Please check -h for help"
+                print log_message
+                logging.error(log_message)
+                sys.exit()
+            if content_type not in content_types: content_types.append(content_type)
+    if args.daemon and (args.plan or args.apply):
+        print "--plan and --apply can't be used with --daemon"
+        sys.exit()
+    if args.plan and args.apply:
+        print "--plan and --apply can't be used together"
         sys.exit()
-    # Find newest file in directory based on content_type
-    content_file = find_newest_file(content_type)
+    if args.shards is not None:
+        if args.shards < 1 or args.shard_index is None or not 0 <= args.shard_index < args.shards:
+            print "--shards must be 1 or higher, and --shard-index from 0 to --shards minus 1"
+            sys.exit()
+        if args.daemon or args.plan:
+            print "--shards can't be used with --daemon or --plan"
+            sys.exit()
+    # Find newest file in directory based on content_type. In daemon mode this is done when folders change.
+    # With --apply, files are taken from the plan.
+    index = ContentIndex(CONTENT_INDEX_FILE, PACKAGE)
+    validator = ContentValidator(VALIDATION_FILE, args.settle)
+    plan = None
+    if args.apply:
+        plan = load_plan(args.apply, index, validator)
+        content_files = [(package, content_file) for package, content_file, size, digest in plan.content_files]
+        if not content_files:
+            log_message = "Plan %s lists no content files - nothing to apply" % (args.apply)
+            logging.info(log_message)
+            if verbose: print log_message
+            return
+        if not content_types: content_types = [package for package, content_file in content_files]
+    elif not args.daemon: content_files = find_content_files(content_types, index, validator)
+    # Staged rollout
+    rollout_options = parse_rollout_options(args)
+    waves, concurrency, max_failures = rollout_options
     # Parse config file
-    emailobj,apikey = parse_config_file(args.e,verbose)
+    emailobj,apikey,scp = parse_config_file(args.e,verbose)
+    if args.distribution == "scp": scp_source = create_scp_source(scp)
+    else: scp_source = None
+    # One job tracker polls install jobs for all devices, and all API calls share one pool of keep-alive connections
+    jobtracker = JobTracker()
+    pool = ConnectionPool(ssl._create_unverified_context())
     # Parse device file - Find devices to install on
-    device_list = parse_devices_file(apikey,verbose,content_type)
-    # Run through all devices found and install
+    device_list, settings = parse_devices_file(apikey,verbose,content_types[0],jobtracker,pool)
+    # Upload scheduler limits bandwidth and retries failed uploads. Throughput measured in earlier runs
+    # decides device order and number of uploads at the same time.
+    history = History(HISTORY_FILE)
+    scheduler = create_upload_scheduler(settings, history)
+    scheduler.plan_waves(device_list, max(concurrency))
+    # API timeouts, install job deadlines and poll intervals are learned from history, unless set in devices.conf
+    timeouts = create_timeout_policy(settings, history)
     for device in device_list:
-        # Check and set installed versions on device
+        device.upload_scheduler = scheduler
+        device.timeouts = timeouts
+        device.scp_source = scp_source
+    # Argument w --wait determines if script should wait for completed install job
+    if args.w: wait = True
+    else: wait = False
+    # Cached content versions - lets devices already up to date be skipped without API calls
+    if args.inventory_ttl > 0:
+        inventory = InventoryCache(INVENTORY_FILE, args.inventory_ttl)
+        if args.refresh: inventory.invalidate()
+    else: inventory = None
+    # Devices are probed before each rollout, and hosts failing repeatedly are backed off between runs
+    if args.probe_timeout > 0: prober = Prober(CircuitBreaker(BREAKER_FILE), args.probe_timeout)
+    else: prober = None
+    # Plan only finds versions, and writes which devices need which files
+    if args.plan:
+        plan = make_plan(device_list, content_files, index, inventory, max(PLAN_PARALLEL, max(concurrency)), prober)
         try:
-            device_status = device.check_installed_version()
-        except UploadError as e:
-            log_message = "Timeout when checking current content versions for device %s. Skipping device" % (device.name)
-            statuslist.append(log_message)
-            logging.error(log_message)
-            logging.error(str(e))
-            device_status = False
-            pass
-        if not device_status: continue # go to next device if we could not check current versions on device
-        # Upload file - status (true or false) returned. True is succesfull upload, false is skipped or failed.
+            plan.save(args.plan)
+        except (IOError, OSError) as e:
+            logging.error("Unable to write plan %s: %s" % (args.plan, e))
+            raise FileError(e)
+        report_plan(plan, args.plan, verbose)
+        jobtracker.stop()
+        pool.close()
+        return
+    # Progress of each device is journaled. With --resume, devices finished by an interrupted run are skipped,
+    # and install jobs it started are followed instead of being started again.
+    journal = Journal(JOURNAL_FILE, args.resume)
+    # Run through all devices found and install
+    if args.daemon:
+        # Status is reported after each rollout
+        run_daemon(args, device_list, content_types, wait, rollout_options, index, inventory, scheduler, history, journal, emailobj, verbose, prober, validator)
+    else:
+        # Sharded run e-mails the merged results of all shards from the runner finishing last. Each runner reports its own devices.
+        shard_runner = None
+        if args.shards is not None: shard_runner = create_shard_runner(args, device_list, content_files)
+        results = create_result_stream(args, verbose, emailobj, args.e and shard_runner is None, content_files)
         try:
-            upload_status = device.upload_to_device(content_file)
-        except UploadError as e:
-            log_message = "Error while uploading %s to %s. Skipping device" % (content_file, device.hostname)
-            log.error(log_message)
-            statuslist.append(log_message)
-        # Only run install if upload status is true (succesfull)
-        if upload_status:
-            statuslist.append("SUCCESS: Upload of %s to %s - %s" % (content_file, device.hostname, device.name))
-            # Argument w --wait determines if script should wait for completed install job
-            if args.w: wait = True
-            else: wait = False
-            # Run install job
-            try:
-                install_status = device.install_on_device(content_file, wait)
-            except InstallError as e:
-                statuslist.append(str(e)) #If we get installerror - add it to statuslist
-                install_status = False
-            # Store status messages based on result of install job
-            if install_status and wait: statuslist.append("SUCCESS: Installation of %s to %s - %s successfully completed" % (content_file, device.hostname, device.name))
-            elif install_status and not wait: statuslist.append("""SUCCESS: Installation of %s to %s - %s started.
-                                                        Did not wait for completion""" % (content_file, device.hostname, device.name))
-            else: statuslist.append("UNKNOWN: Installation of %s to %s - %s returned unknown status. Check logfile for more details" % (content_file, device.hostname, device.name))
-        else: statuslist.append("SKIPPED: Upload of %s to %s - %s. Content version we tried to install is the same or older as current version" % (content_file, device.hostname, device.name))
-    # Print status messages to logfile, and/or prints them to stdout and sets email-content
-    emailcontent = ""
-    for status in statuslist:
-        logging.info(status)
-        if verbose: print status
-        emailcontent = "%s\n%s" % (emailcontent,status)
-    # if -e is set - send email with status messages
-    if args.e:
-        emailobj.content = emailcontent
-        emailobj.send_email()
-    # Print statusmessages to logfile
-
+            run_rollout(device_list, content_files, wait, rollout_options, index, inventory, scheduler, history, journal, results, args.metrics_json, args.metrics_prom, verbose, plan, prober, shard_runner)
+        finally:
+            results.close()
+        if shard_runner is not None:
+            if shard_runner.merged: report_merged(shard_runner, device_list, verbose, emailobj, args.e, args.email_digest)
+            shard_runner.store.close()
+    # Journal is closed first, so jobs failed by stopping the job tracker are not journaled as failed
+    journal.close()
+    jobtracker.stop()
+    logging.debug("Job tracker used %s API calls to poll install jobs" % (jobtracker.api_calls))
+    pool.close()
+    logging.info("HTTPS connections: %(opened)s opened, %(reused)s requests on reused connections" % pool.stats())
 
 if __name__ == '__main__':
 	main()
@@ -25,17 +25,31 @@
 Module consist of two classes.
 PanOsDevice - used for importing and installation on single device
 Panorama- used when importing and installing to multiple devices through panorama
+ScpSource - SCP server devices pull content files from, when files are not pushed by the script
 """
-from poster.encode import multipart_encode
-from poster.streaminghttp import register_openers
 from parse import XmlReader
+from parse import ParseError
+from multipart import MultipartError
+from multipart import MultipartFile
+from jobs import JobTracker
+from jobs import JobError
+from connection import ConnectionPool
+from uploadsched import UploadScheduleError
+from connection import ApiError
+from connection import cmd_xml as to_cmd_xml
+from metrics import Timer
+from timeouts import install_key
+from contentindex import parse_version
+from xml.sax.saxutils import escape
 from os import path
-import os
 import sys
 import ssl
-import pan.xapi
+import posixpath
+import re
+import urllib
 import logging
-import urllib2
+import httplib
+import threading
 import traceback
 import time
 
@@ -46,6 +60,58 @@ class UploadError(StandardError):
 class InstallError(StandardError):
     pass
 
+
+SCP_POLL = 5  # Seconds between checks for file on device during SCP import
+
+
+class ScpSource(object):
+    # SCP server with the same content folders as the script host, below path
+    def __init__(self, host, user, password, path, port=None):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.path = path
+        self.port = port
+
+
+    def command(self, type, folder, file, password=True):
+        # XML for "scp import <type> from <user>@<host>:<path>". password=False masks password, for logging
+        remote = posixpath.join(self.path, posixpath.normpath(folder), file)
+        options = "<from>%s@%s:%s</from>" % (escape(self.user), escape(self.host), escape(remote))
+        if self.password is not None:
+            if password: options += "<password>%s</password>" % (escape(self.password))
+            else: options += "<password>*****</password>"
+        if self.port is not None: options += "<remote-port>%s</remote-port>" % (self.port)
+        return "<scp><import><%s>%s</%s></import></scp>" % (type, options, type)
+
+def api_type(package):
+    # Need to set type to correct value for use in API call
+    if package == "wildfire2": return "wildfire"
+    elif package == "app": return "content"
+    elif package == "appthreat": return "content"
+    elif package == "antivirus": return "anti-virus"
+    else: return package
+
+def installed_version_tuple(version):
+    # Installed version "<major>-<minor>" as (major, minor) numbers, for comparing with parse_version().
+    # Returns None if version is not known or can't be parsed.
+    if version is None: return None
+    fields = version.split('-')
+    if len(fields) < 2: return None
+    minor = re.match(r"\d+", fields[1])
+    if not fields[0].isdigit() or minor is None: return None
+    return (int(fields[0]), int(minor.group(0)))
+
+def is_newer(file, current_version):
+    # Compare version to install with version currently installed ("<major>-<minor>").
+    # Versions are compared as numbers, so 1000-100 is newer than 999-200.
+    current = installed_version_tuple(current_version)
+    if current is None or current[0] == 0: return True  # Installed version not known, or nothing is installed
+    install = parse_version(file)
+    if install is None: return True  # File name without version. Installing it is left to the device
+    # Skip upload if current version is the same or newer
+    return install > current
+
 ### Class for single PAN-OS Device
 
 
@@ -60,13 +126,10 @@ class PanOsDevice(object):
         "wf500": "./panup-all-wfmeta/",
         }
 
-    def __init__(self, hostname, apikey, name, timeout, verbose, package):
-        # Need to set type to correct value for use in API call
-        if package == "wildfire2": self.type = "wildfire"
-        elif package == "app": self.type = "content"
-        elif package == "appthreat": self.type = "content"
-        elif package == "antivirus": self.type = "anti-virus"
-        else: self.type = package
+    # package set on device is the default content type. Methods taking a package argument can handle
+    # any other content type, so one device object is used for all content types in a run.
+    def __init__(self, hostname, apikey, name, timeout, verbose, package, jobtracker=None, pool=None):
+        self.type = api_type(package)
         self.hostname = hostname
         self.username = None
         self.password = None
@@ -77,142 +140,334 @@ class PanOsDevice(object):
         self.threat_version = None
         self.av_version = None
         self.wf_version = None
+        self.model = None
         self.package = package
         self.path = self.PACKAGE[package]
         self.verbose = verbose
         self.cert_verify = False
-        self.panxapi = pan.xapi.PanXapi(hostname=hostname, api_key=apikey, timeout=timeout)
-        if not self.cert_verify: self.context = ssl._create_unverified_context()
-        else: self.context = ssl._create_default_https_context()
-
-
-    def upload_to_device(self,file):
-        # Compere version to install with version currently installed.
-        install_version = file.split('-')
-        install_version = install_version[3] + install_version [4]
-        if self.package == 'appthreat': current_version = self.app_version.split('-')
-        elif self.package == 'app': current_version = self.app_version.split('-')
-        elif self.package == 'antivirus': current_version = self.av_version.split('-')
-        elif self.package == 'wildfire': current_version = self.wf_version.split('-')
-        elif self.package == 'wildfire2': current_version = self.wf_version.split('-')
-        elif self.package == 'wf500': current_version = self.wf_version.split('-')
+        self.lock = threading.Lock()
+        # Job tracker is normally shared by all devices, so all install jobs are polled from one place
+        if jobtracker is None: jobtracker = JobTracker()
+        self.jobtracker = jobtracker
+        # Connection pool is normally shared by all devices. Keep-alive connections are reused for all API calls.
+        # TLS context is only created for a pool of its own, as creating one per device is slow with many devices.
+        if pool is None:
+            if not self.cert_verify: context = ssl._create_unverified_context()
+            else: context = ssl._create_default_https_context()
+            pool = ConnectionPool(context)
+        self.pool = pool
+        self.context = pool.context
+        self.upload_scheduler = None  # Optional UploadScheduler, set for all devices by pan-dyn-update.py
+        self.metrics = None  # Optional Metrics, records timings of each phase
+        self.timeouts = None  # Optional TimeoutPolicy. timeout is used for all API calls and jobs when not set
+        self.scp_source = None  # Optional ScpSource. When set, device pulls content files by SCP instead of upload
+        self.options = {}  # Options from devices.conf
+
+
+    def api_timeout(self):
+        if self.timeouts is None: return self.timeout
+        return self.timeouts.api_timeout(self)
+
+
+    def upload_timeout(self, size):
+        if self.timeouts is None: return self.timeout
+        return self.timeouts.upload_timeout(self, size)
+
+
+    def job_timeout(self, package=None):
+        if package is None: package = self.package
+        if self.timeouts is None: return self.timeout
+        return self.timeouts.job_timeout(self, package)
+
+
+    def installed_version(self,package=None):
+        # Returns version installed on device for content type, as "<major>-<minor>"
+        if package is None: package = self.package
+        if package == 'appthreat': return self.app_version
+        elif package == 'app': return self.app_version
+        elif package == 'antivirus': return self.av_version
+        elif package == 'wildfire': return self.wf_version
+        elif package == 'wildfire2': return self.wf_version
+        elif package == 'wf500': return self.wf_version
         else:
-            print self.package, " is not a supported content type. Usage: push_updates.py -h"
+            print package, " is not a supported content type. Usage: push_updates.py -h"
             sys.exit()
-        # Skip upload if current version is the same or newer
-        if not current_version[0] == "0": #If version is 0, nothing is installed, and we want to continue
-            current_version = current_version[0] + current_version[1]
-            if current_version >= install_version:
-                logging.info("Current version(%s) of %s is the same or newer than verison we tried to install(%s). Skipping upload for device %s" % (current_version,self.package,install_version, self.name))
-                return False  # Return false to indicate file was noe uploaded.
-        # Set filepath to update file location, and store current location
-        currentdir = os.getcwd()
-        os.chdir( self.path )
-        # Build api url
-        api_call = "https://%s/api/?type=import&category=%s&file-name=%s&key=%s" % (self.hostname, self.type, file, self.apikey)
-        # Open File and upload it
-        with open(file, 'r') as f:
-            log_message = "%s file %s opened. Uploading to device.." % (self.package,file)
-            logging.debug(log_message)
-            log_message = "API request: %s" % (api_call)
-            logging.debug(log_message)
-            # Use multipart_encode to encode file and generate headers.
-            datagen, headers = multipart_encode({"file": f})
-            data =str().join(datagen)  # Data must be a string
-            # Generate request
-            request = urllib2.Request(api_call, data, headers)
+
+
+    def set_installed_version(self,file,package=None):
+        # Set installed version from name of content file - used after successfull install
+        if package is None: package = self.package
+        version = file.split('-')
+        version = "%s-%s" % (version[3], version[4])
+        if package in ('appthreat', 'app'): self.app_version = version
+        elif package == 'antivirus': self.av_version = version
+        else: self.wf_version = version
+
+
+    def needs_update(self,file,package=None):
+        if package is None: package = self.package
+        current_version = self.installed_version(package)
+        if not is_newer(file, current_version):
+            logging.info("Current version(%s) of %s is the same or newer than verison we tried to install(%s). Skipping upload for device %s" % (current_version,package,file, self.name))
+            return False
+        return True
+
+
+    def has_file(self,file,package=None):
+        # True if content file is already on device (uploaded earlier, but maybe not installed).
+        # Any error is logged and False returned, so file is uploaded as normal.
+        if package is None: package = self.package
+        cmd = "<request><%s><upgrade><info></info></upgrade></%s></request>" % (api_type(package), api_type(package))
+        try:
+            files = XmlReader(self.op(cmd)).find_downloaded_files()
+        except (ApiError, ParseError) as e:
+            logging.warning("Unable to list content files on %s. %s" % (self.name, e))
+            return False
+        return file in files
+
+
+    def upload_to_device(self,file,package=None):
+        if package is None: package = self.package
+        if not self.needs_update(file, package): return False  # Return false to indicate file was noe uploaded.
+        # Device pulls file from SCP server, or file is pushed from script host
+        if self.scp_source is not None:
+            transfer, key = self.scp_import, "scp_throughput"
+        else:
+            transfer, key = self.import_file, "throughput"
+        if self.upload_scheduler is None:
+            transfer(file, package)
+        else:
+            # Scheduler limits bandwidth, and retries failed uploads until its deadline
+            size = path.getsize(path.join(self.PACKAGE[package], file))
             try:
-                response = urllib2.urlopen(request, context=self.context, timeout=self.timeout).read()
-            except Exception as e:
-                os.chdir( currentdir )
-                f.close()
+                self.upload_scheduler.run(self, lambda deadline: transfer(file, package, deadline), size, key)
+            except UploadScheduleError as e:
                 raise UploadError(e)
-        f.close()
-        os.chdir( currentdir )
-        logging.debug("%s successfully uploaded to %s" % (file, self.name))
         return True  # Return true to indicate successfull upload
 
 
-    def install_on_device(self,file,wait):
+    def scp_import(self,file,package=None,deadline=None):
+        # Device pulls content file from SCP server. Returns when file is on device. Raises UploadError on failure.
+        if package is None: package = self.package
+        type = api_type(package)
+        cmd = self.scp_source.command(type, self.PACKAGE[package], file)
+        if deadline is None: deadline = time.time() + self.job_timeout(package)
+        if self.verbose: print "Starting SCP import of %s on %s" % (file, self.name)
+        try:
+            with Timer(self.metrics, "upload", self) as timer:
+                output = self.op(cmd, log_cmd=self.scp_source.command(type, self.PACKAGE[package], file, password=False))
+                # Import is run as a job on some PAN-OS versions, and is done when command returns on others
+                try:
+                    jobid = XmlReader(output).find_jobid()
+                except ParseError:
+                    jobid = None
+                if jobid is not None:
+                    logging.info("SCP import job %s for %s started on %s" % (jobid, file, self.name))
+                    self.jobtracker.track(self, jobid, max(deadline - time.time(), 1)).result()
+                # Transfer is complete when device lists file as downloaded
+                while not self.has_file(file, package):
+                    if time.time() > deadline: raise UploadError("Timeout waiting for %s on %s after SCP import" % (file, self.name))
+                    time.sleep(SCP_POLL)
+        except (ApiError, JobError) as e:
+            raise UploadError("SCP import of %s on %s failed: %s" % (file, self.name, e))
+        logging.info("%s pulled %s by SCP in %.1f seconds" % (self.name, file, timer.seconds))
+
+
+    def import_file(self,file,package=None,deadline=None):
+        # Upload content file to device without checking installed version. Raises UploadError on failure.
+        if package is None: package = self.package
+        # Build api url
+        api_call = "/api/?type=import&category=%s&file-name=%s&key=%s" % (api_type(package), file, self.apikey)
+        # Multipart body is streamed from file. Path is joined instead of changing directory, as cwd is shared by all threads.
+        body = MultipartFile(path.join(self.PACKAGE[package], file))
+        headers = body.headers()
+        size = body.content_length
+        log_message = "%s file %s opened. Uploading %s bytes to device.." % (package,file,body.content_length)
+        logging.debug(log_message)
+        if self.upload_scheduler is not None: body = self.upload_scheduler.throttle(self, body, deadline)
+        log_message = "API request: https://%s%s" % (self.hostname, api_call)
+        logging.debug(log_message)
+        try:
+            with Timer(None, "upload", self) as timer:
+                status, output = self.pool.request(self.hostname, "POST", api_call, body, headers, self.upload_timeout(size))
+        except (ApiError, UploadScheduleError, MultipartError) as e:
+            raise UploadError(e)
+        if status != httplib.OK:
+            raise UploadError("Upload of %s to %s failed with HTTP status %s. Output: %s" % (file, self.name, status, output))
+        logging.debug("%s successfully uploaded to %s in %.1f seconds" % (file, self.name, timer.seconds))
+        if self.metrics is not None:
+            self.metrics.observe("upload", self.hostname, timer.seconds, self.name)
+            if timer.seconds > 0: self.metrics.observe("upload_throughput", self.hostname, size / timer.seconds, self.name)
+
+
+    def op(self, cmd, cmd_xml=False, log_cmd=None):
+        # Run operational command and return response as xml string. Raises ApiError if device returns an error.
+        # cmd_xml=True converts a CLI style command to XML ("show system info").
+        # log_cmd is logged instead of cmd, for commands with passwords.
+        # Calls to same device are serialized, as the job tracker polls from its own threads.
+        if cmd_xml: cmd = to_cmd_xml(cmd)
+        if log_cmd is None: log_cmd = cmd
+        logging.debug("API op on %s: %s" % (self.name, log_cmd))
+        body = urllib.urlencode({"type": "op", "cmd": cmd, "key": self.apikey})
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        with self.lock:
+            status, output = self.pool.request(self.hostname, "POST", "/api/", body, headers, self.api_timeout())
+        try:
+            response_status, message = XmlReader(output).find_response_status()
+        except ParseError:
+            raise ApiError("Unable to parse response from %s. HTTP status %s" % (self.name, status))
+        if response_status != "success":
+            raise ApiError("API error from %s: %s" % (self.name, message))
+        return output
+
+
+    def start_install(self,file,package=None):
+        # Start install job on device, and return job id
+        if package is None: package = self.package
+        type = api_type(package)
         if self.verbose: print "Starting install of %s on %s" % (file, self.name)
-        xpath = "<request><%s><upgrade><install><file>%s</file></install></upgrade></%s></request>" % (self.type, file, self.type)
-        # Timeout for while loop - used if wait is true
-        whiletimeout = time.time() + self.timeout
+        xpath = "<request><%s><upgrade><install><file>%s</file></install></upgrade></%s></request>" % (type, file, type)
         try:
-            self.panxapi.op(xpath)
-            result = self.panxapi.xml_root()
-            # If wait is not set, we are done. False returned to indicate we did not wait
-            if not wait : return False
-            if self.verbose: print "Waiting for install job to complete on %s - will wait for max %s seconds" % (self.name, self.timeout)
-            xmlreader = XmlReader(result)
-            jobid = xmlreader.find_jobid()
-            cmd = 'show jobs id "%s"' % (jobid)
-        except:
-            log_message = "Error running API command to install update on Panorama"
+            with Timer(self.metrics, "job_start", self):
+                result = self.op(xpath)
+                jobid = XmlReader(result).find_jobid()
+        except Exception as e:
+            log_message = "Error running API command to install %s on device %s" % (file, self.name)
             logging.error(log_message)
             logging.error(str(e))
             raise InstallError(log_message)
-        while True:
-            # cheks for completed job every 5 seconds. Exit if wait timeer is expired
-            if time.time() > whiletimeout:
-                log_message = "Timeout waiting for completetion of install job of %s on device %s. Command: %s" % (self.name, file, cmd)
-                logging.error(log_message)
-                raise InstallError(log_message)
-            time.sleep(5)
-            try:
-                self.panxapi.op(cmd=cmd, cmd_xml=True)
-                output = self.panxapi.xml_result()
-            except Exception as e:
-                logging.error(str(e))
-                raise InstallError("Error when executing API call to find job status for firewall %s. Command: %s" % (self.name, cmd))
-            try:
-                xmlreader = XmlReader(output)
-                status,progress = xmlreader.find_status()
-            except:
-                raise InstallError("Error when parsing xml output to find job status for device %s. Output: %s" % (self.name, output))
-            if self.verbose: print "Install job running on %s - Status : %s %s%%" % (self.name, status, progress)
-            # when job statis is "FIN" - continue
-            if status == "FIN":
-                if self.verbose: print "Install job completed on %s." % (self.name)
-                try:
-                    nextjobid = xmlreader.findnextjobid()
-                except:
-                    logging.info("Next job id not found when in response from job %s on fw %s. Installation succeeded." % (jobid, self.name))
-                    return True # exception here means there is no new job started, and installation suceeded.
-                # Monitor status of next job (content install job)
-                while True:
-                    cmd2 = 'show jobs id "%s"' % (nextjobid)
-                    # cheks for completed job every 5 seconds. Exit if wait timeer is expired
-                    if time.time() > whiletimeout:
-                        log_message = "Timeout waiting for completetion of install job of %s on device %s. Command: %s" % (self.name, file, cmd2)
-                        log.error(log_message)
-                        raise InstallError(log_message)
-                    time.sleep(5)
-                    try:
-                        self.panxapi.op(cmd=cmd2, cmd_xml=True)
-                        output2 = self.panxapi.xml_result()
-                    except Exception as e:
-                        logging.error(str(e))
-                        raise InstallError("Error when executing API call to find job status for firewall %s. Install job might not be necessary or failed. Command: %s" % (self.name, cmd2))
-                    try:
-                        xmlreader2 = XmlReader(output2)
-                        status2,progress2 = xmlreader2.find_status()
-                    except:
-                        raise InstallError("Error when parsing xml output to find job status for device %s. Output: %s" % (self.name, output))
-                    if self.verbose: print "%s job is running on %s - Status: %s %s%%" % (type,self.name,status2,progress2)
-                    # When status is FIN - job is completed successfully
-                    if status2 == "FIN":
-                        if self.verbose: print "%s job is done on %s" % (type, self.name)
-                        return True
+        logging.info("Install job %s for %s started on %s" % (jobid, file, self.name))
+        return jobid
+
+
+    def install_async(self,file,callback=None,package=None):
+        # Start install job, and return JobFuture completed by the job tracker when job (and any next job) is done
+        jobid = self.start_install(file, package)
+        return self.track_job(jobid, callback, package)
+
+
+    def track_job(self, jobid, callback=None, package=None):
+        # Track install job of content type with job tracker. Total job time and number of polls are recorded when job is done
+        # Learned install time is recorded for jobs that completed
+        if package is None: package = self.package
+        started = time.time()
+        interval = None
+        if self.timeouts is not None: interval = self.timeouts.poll_interval(self, package)
+        future = self.jobtracker.track(self, jobid, self.job_timeout(package), interval=interval)
+        metrics, timeouts = self.metrics, self.timeouts
+        def record(future):
+            if metrics is not None:
+                metrics.observe("job", self.hostname, time.time() - started, self.name)
+                metrics.observe("polls", self.hostname, future.polls, self.name)
+            if timeouts is not None and future.exception() is None: timeouts.record(self, install_key(package), time.time() - started)
+        future.add_done_callback(record)
+        if callback is not None: future.add_done_callback(callback)
+        return future
+
+
+    def install_on_device(self,file,wait,package=None):
+        # If wait is not set, we are done when job is started. True returned to indicate job was started
+        if not wait:
+            self.start_install(file, package)
+            return True
+        future = self.install_async(file, package=package)
+        return self.wait_for_install(future, file, package)
+
+
+    def wait_for_install(self,future,file,package=None):
+        # Block until install job started with install_async() is done. Raises InstallError if job failed or timed out.
+        if self.verbose: print "Waiting for install job to complete on %s - will wait for max %s seconds" % (self.name, int(self.job_timeout(package)))
+        try:
+            future.result()
+        except JobError as e:
+            log_message = "Install job of %s on device %s did not complete. %s" % (file, self.name, e)
+            logging.error(log_message)
+            raise InstallError(log_message)
+        if self.verbose: print "Install job of %s is done on %s" % (file, self.name)
+        return True
 
 
     def check_installed_version(self):
         cmd = "show system info"
         try:
-            self.panxapi.op(cmd=cmd,cmd_xml=True)
-            output = self.panxapi.xml_root()
+            with Timer(self.metrics, "system_info", self) as timer:
+                output = self.op(cmd, cmd_xml=True)
             reader = XmlReader(output)
             self.app_version,self.threat_version,self.av_version,self.wf_version = reader.find_content_versions()
+            self.model = reader.find_model()
+            if self.timeouts is not None: self.timeouts.record(self, "system_info", timer.seconds)
             return True
-        except pan.xapi.PanXapiError as e:
+        except ApiError as e:
             raise UploadError(e)
+        except ParseError as e:
+            raise UploadError("Unable to find content versions in output from %s. %s" % (self.name, e))
+
+
+    def ha_state(self):
+        # Local HA state of device (active, passive, ...), or None when HA is not enabled
+        try:
+            output = self.op("show high-availability state", cmd_xml=True)
+            return XmlReader(output).find_ha_state()
+        except ApiError as e:
+            raise UploadError(e)
+        except ParseError as e:
+            raise UploadError("Unable to find HA state in output from %s. %s" % (self.name, e))
+
+
+### Class for Panorama - content is uploaded once to Panorama, and installed on managed firewalls from there
+
+
+class Panorama(PanOsDevice):
+
+    BATCH_SIZE = 25  # Max number of firewalls in one install job
+
+    def find_managed_devices(self):
+        # Returns firewalls connected to Panorama as dicts with serial, hostname, model and content versions
+        try:
+            output = self.op("show devices connected", cmd_xml=True)
+            return XmlReader(output).find_managed_devices()
+        except ApiError as e:
+            raise UploadError(e)
+        except ParseError as e:
+            raise UploadError("Unable to find connected devices in output from %s. %s" % (self.name, e))
+
+
+    def devices_needing_update(self,managed_devices,file,package=None):
+        # Serials of managed firewalls with older version than file installed
+        if package is None: package = self.package
+        field = {"appthreat": "app_version", "app": "app_version", "antivirus": "av_version"}.get(package, "wf_version")
+        serials = []
+        for device in managed_devices:
+            if is_newer(file, device[field]): serials.append(device["serial"])
+            else: logging.info("Current version(%s) of %s on %s (%s) is the same or newer than %s" % (device[field], package, device["hostname"], device["serial"], file))
+        return serials
+
+
+    def start_batch_install(self,file,serials,package=None):
+        # Start install job on Panorama for a batch of managed firewalls, and return job id
+        if package is None: package = self.package
+        type = api_type(package)
+        members = "".join("<member>%s</member>" % (serial) for serial in serials)
+        xpath = "<request><batch><%s><upload-install><devices>%s</devices><uploaded-file>%s</uploaded-file></upload-install></%s></batch></request>" % (type, members, file, type)
+        if self.verbose: print "Starting install of %s on %s firewalls through %s" % (file, len(serials), self.name)
+        try:
+            with Timer(self.metrics, "job_start", self):
+                result = self.op(xpath)
+                jobid = XmlReader(result).find_jobid()
+        except Exception as e:
+            log_message = "Error running API command to install %s on firewalls through Panorama %s" % (file, self.name)
+            logging.error(log_message)
+            logging.error(str(e))
+            raise InstallError(log_message)
+        logging.info("Install job %s for %s started on %s for %s" % (jobid, file, self.name, ",".join(serials)))
+        return jobid
+
+
+    def install_to_devices(self,file,serials,package=None):
+        # Start install jobs in batches of BATCH_SIZE firewalls. Returns list of (serials, JobFuture), one per batch
+        batches = []
+        for i in range(0, len(serials), self.BATCH_SIZE):
+            batch = serials[i:i + self.BATCH_SIZE]
+            jobid = self.start_batch_install(file, batch, package)
+            batches.append((batch, self.track_job(jobid, package=package)))
+        return batches
@@ -25,86 +25,159 @@
 Used in both content_installer.py and pancom.py
 
 """
-from bs4 import BeautifulSoup
-from email.MIMEMultipart import MIMEMultipart
-from email.MIMEText import MIMEText
-
-import time
-import smtplib
 import logging
 import traceback
 
+# XML parser and SMTP modules are imported on first use, so runs that don't parse XML or send e-mail
+# (-h, or all devices skipped from cache) don't pay for loading them.
+etree = None  # lxml.etree when installed, otherwise cElementTree. Set by _etree()
+
 
 # SMTP-config variables - set in config.conf
 smtpmessage_template = "This is an automatically generated e-mail. Script pan-dyn-update.py has performed the following task:\n"
 
-class SoupException(StandardError):
+class ParseError(StandardError):
     pass
 
+SoupException = ParseError  # Name used before XmlReader moved from BeautifulSoup to ElementTree
+
+
+def _etree():
+	global etree
+	if etree is None:
+		try:
+			from lxml import etree as module
+		except ImportError:
+			import xml.etree.cElementTree as module
+		etree = module
+	return etree
+
+
+def _text(element):
+	# All text inside element, including text of child elements
+	return "".join(element.itertext())
+
+
 class XmlReader:
 	def __init__(self, content):
 		self.content = content
-		self.soup = BeautifulSoup(content, "lxml-xml")
+		if isinstance(content, unicode): content = content.encode("utf-8")
+		try:
+			self.root = _etree().fromstring(content)
+		except Exception as e:
+			raise ParseError("Unable to parse XML: %s" % (e))
+
 
-	# Static methods
+	def _find_text(self, tag):
+		# Text of first matching element in document, or None if not found
+		if self.root.tag == tag: element = self.root
+		else: element = self.root.find(".//%s" % (tag))
+		if element is None: return None
+		return _text(element)
 
 
 	def find_serial(self,searchstring):
 		output_list = []
-		for tags in self.soup.find_all(searchstring):
-			serial = str(tags['name'])
+		for tags in self.root.iter(searchstring):
+			serial = str(tags.attrib['name'])
 			output_list.append(serial)
 		return output_list
 
 
+	def find_response_status(self):
+		# Status attribute of response element ("success" or "error"), and any message text in response
+		message = " ".join(_text(line).strip() for line in self.root.iter('line'))
+		if not message:
+			msg = self.root.find('.//msg')
+			if msg is not None: message = _text(msg).strip()
+		return self.root.get('status'), message
+
+
+	def find_downloaded_files(self):
+		# File names of content updates present on device, from "request <type> upgrade info".
+		# Uploaded files are listed as downloaded.
+		files = []
+		for entry in self.root.iter('entry'):
+			filename = entry.find('filename')
+			downloaded = entry.find('downloaded')
+			if filename is not None and downloaded is not None and _text(downloaded).strip() == "yes":
+				files.append(_text(filename).strip())
+		return files
+
+
+	def find_managed_devices(self):
+		# Firewalls in output from "show devices connected" on Panorama. One dict per firewall.
+		devices = []
+		for entry in self.root.iterfind('.//devices/entry'):
+			device = {'serial': str(entry.attrib['name'])}
+			for field, tag in (('hostname', 'hostname'), ('model', 'model'), ('app_version', 'app-version'), ('threat_version', 'threat-version'), ('av_version', 'av-version'), ('wf_version', 'wildfire-version')):
+				element = entry.find(tag)
+				if element is None: device[field] = None
+				else: device[field] = _text(element)
+			devices.append(device)
+		return devices
+
+
 	def find_jobid(self):
-		try:
-			str = self.soup.find('job').text
-			return str
-		except:
-			raise CheckError('Couldn\'t find any matching item %s' % s)
+		jobid = self._find_text('job')
+		if jobid is None: raise ParseError("Couldn't find any matching item in method find_jobid()")
+		return jobid
 
 
 	def findnextjobid(self):
-		try:
-			str = self.soup.find('nextjob').text
-			return str
-		except:
-			raise SoupException("Couldn't find any matching item in method findnextjobid()")
+		nextjobid = self._find_text('nextjob')
+		if nextjobid is None: raise ParseError("Couldn't find any matching item in method findnextjobid()")
+		return nextjobid
 
 
 	def find_status(self):
-		try:
-			for tags in self.soup.find_all('job'):
-				child_status = tags('status')
-				for statustag in child_status:
-					status = statustag.text
-				child_progress = tags('progress')
-				for progresstag in child_progress:
-					progress = progresstag.text
-			return status,progress
-		except:
-			print 'Couldn\'t find any matching item'
+		# Status and progress of last job in output
+		status = progress = None
+		for job in self.root.iter('job'):
+			for statustag in job.iter('status'): status = _text(statustag)
+			for progresstag in job.iter('progress'): progress = _text(progresstag)
+		if status is None or progress is None: raise ParseError("Couldn't find any matching item in method find_status()")
+		return status,progress
+
+
+	def find_model(self):
+		return self._find_text('model')
+
+
+	def find_jobs(self):
+		# Returns one dict per job element with id, status, progress, result, nextjob and details
+		jobs = []
+		for tags in self.root.iter('job'):
+			if tags.find('.//id') is None: continue  # Job id only, as returned when job is started
+			job = {}
+			for field in ('id', 'status', 'progress', 'result', 'nextjob'):
+				tag = tags.find('.//%s' % (field))
+				if tag is None: job[field] = None
+				else: job[field] = _text(tag).strip()
+			job['details'] = " ".join(_text(line).strip() for line in tags.iter('line'))
+			jobs.append(job)
+		return jobs
 
 
 	def find_content_versions(self):
+		# Versions from last system element in output
+		versions = {}
+		for system in self.root.iter('system'):
+			for field in ('app-version', 'threat-version', 'av-version', 'wildfire-version'):
+				for version in system.iter(field): versions[field] = _text(version)
 		try:
-			for tags in self.soup.find_all('system'):
-				child_threat = tags('threat-version')
-				for version in child_threat:
-					threat_version = version.text
-				child_app = tags('app-version')
-				for version in child_app:
-					app_version = version.text
-				child_av = tags('av-version')
-				for version in child_av:
-					av_version = version.text
-				child_wf = tags('wildfire-version')
-				for version in child_wf:
-					wf_version = version.text
-			return app_version,threat_version,av_version,wf_version
-		except:
-			print 'Couldn\'t find any matching item'
+			return versions['app-version'],versions['threat-version'],versions['av-version'],versions['wildfire-version']
+		except KeyError as e:
+			raise ParseError("Couldn't find %s in method find_content_versions()" % (e))
+
+
+	def find_ha_state(self):
+		# Local HA state from "show high-availability state" (active, passive, active-primary, ...), or None when HA is not enabled
+		if (self._find_text('enabled') or '').strip() != 'yes': return None
+		local = self.root.find('.//local-info')
+		if local is None or local.find('state') is None:
+			raise ParseError("Couldn't find local state in method find_ha_state()")
+		return _text(local.find('state')).strip().lower()
 
 
 class EmailSender(object):
@@ -119,6 +192,10 @@ class EmailSender(object):
 
 
     def send_email(self):
+		from email.MIMEMultipart import MIMEMultipart
+		from email.MIMEText import MIMEText
+		import smtplib
+		import socket
 		message = "%s \n\n%s" % (smtpmessage_template,self.content)
 		try:
 			msg = MIMEMultipart()
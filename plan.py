@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+#Copyright (c) 2016 Data Equipment AS
+#Author: Tor Mogstad <torm _AT_ dataequipment.no>
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+""" Module for serialized rollout plans
+
+RolloutPlan - content files to install on each device, with versions found on
+the device and bytes to transfer. Written as JSON by --plan, so a rollout can be
+reviewed and scheduled, and carried out later with --apply.
+"""
+import os
+import json
+import time
+
+
+PLAN_VERSION = 1  # Format of plan file
+
+
+class PlanError(StandardError):
+    pass
+
+
+class RolloutPlan(object):
+    def __init__(self, content_files, created=None):
+        # content_files - list of (content type, file name, size, sha256) for the newest files
+        self.content_files = content_files
+        if created is None: created = time.time()
+        self.created = created
+        self.devices = []  # Dict per device, in devices.conf order
+        self.entries = {}  # Dict of device by hostname
+
+
+    def add(self, device, files, versions, error=None):
+        # files - list of (content type, file name) the device needs
+        sizes = dict((content_file, size) for package, content_file, size, digest in self.content_files)
+        entry = {
+            "hostname": device.hostname,
+            "name": device.name,
+            "type": device.options.get("type", "firewall"),
+            "versions": versions,
+            "files": [{"type": package, "file": content_file, "bytes": sizes.get(content_file, 0)} for package, content_file in files],
+            }
+        entry["bytes"] = sum(planned["bytes"] for planned in entry["files"])
+        if error is not None: entry["error"] = error
+        self.devices.append(entry)
+        self.entries[entry["hostname"]] = entry
+
+
+    def entry(self, hostname):
+        return self.entries.get(hostname)
+
+
+    def files(self, hostname):
+        # (content type, file name) planned for device. Empty for devices not in plan
+        entry = self.entry(hostname)
+        if entry is None: return []
+        return [(planned["type"], planned["file"]) for planned in entry["files"]]
+
+
+    def summary(self):
+        # Totals for devices needing update, up to date and failing to answer, and bytes to transfer
+        needing = [entry for entry in self.devices if entry["files"]]
+        errors = [entry for entry in self.devices if "error" in entry]
+        return {
+            "devices": len(self.devices),
+            "needing_update": len(needing),
+            "up_to_date": len(self.devices) - len(needing) - len(errors),
+            "errors": len(errors),
+            "bytes": sum(entry["bytes"] for entry in self.devices),
+            }
+
+
+    def to_dict(self):
+        return {
+            "version": PLAN_VERSION,
+            "created": self.created,
+            "content_files": [{"type": package, "file": content_file, "bytes": size, "sha256": digest}
+                              for package, content_file, size, digest in self.content_files],
+            "summary": self.summary(),
+            "devices": self.devices,
+            }
+
+
+    def save(self, filename):
+        # Write to temporary file first, so a plan file is never half written
+        content = json.dumps(self.to_dict(), indent=1, sort_keys=True)
+        tmpfile = "%s.tmp" % (filename)
+        with open(tmpfile, "w") as f:
+            f.write(content)
+        os.rename(tmpfile, filename)
+
+
+    @classmethod
+    def load(cls, filename):
+        # Raises PlanError if plan file can't be read
+        try:
+            with open(filename, "r") as f:
+                data = json.load(f)
+        except (IOError, ValueError) as e:
+            raise PlanError("Unable to read plan %s: %s" % (filename, e))
+        if data.get("version") != PLAN_VERSION: raise PlanError("Unsupported plan version %s in %s" % (data.get("version"), filename))
+        try:
+            plan = cls([(entry["type"], entry["file"], entry["bytes"], entry["sha256"]) for entry in data["content_files"]], data["created"])
+            plan.devices = data["devices"]
+            plan.entries = dict((entry["hostname"], entry) for entry in plan.devices)
+        except (KeyError, TypeError) as e:
+            raise PlanError("Missing field %s in plan %s" % (e, filename))
+        return plan
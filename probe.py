@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+#Copyright (c) 2016 Data Equipment AS
+#Author: Tor Mogstad <torm _AT_ dataequipment.no>
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+""" Module for probing devices before a rollout
+
+Prober - checks that every device accepts TCP connections on its HTTPS port and
+answers an API call, on a pool of threads with a short deadline. Devices failing
+the probe are skipped by the rollout instead of each using the full API timeout.
+CircuitBreaker - failed probes per host, kept between runs. After repeated
+failures a host is not probed again until a backoff doubling with each failure
+has passed.
+"""
+from connection import ApiError
+from os import path
+import os
+import json
+import socket
+import urllib
+import httplib
+import logging
+import threading
+import time
+
+
+PROBE_TIMEOUT = 5  # Seconds for TCP connect, and for API answer
+PROBE_WORKERS = 32  # Devices probed at the same time
+BREAKER_THRESHOLD = 2  # Failed probes in a row before host is backed off
+BREAKER_BACKOFF = 900  # Seconds host is backed off after BREAKER_THRESHOLD failures. Doubled for each further failure
+BREAKER_MAX_BACKOFF = 86400
+
+
+def address(hostname):
+    # (host, port) of device hostname, which may include a port. Parsed as httplib does it
+    connection = httplib.HTTPSConnection(hostname)
+    return connection.host, connection.port
+
+
+class CircuitBreaker(object):
+    def __init__(self, filename, threshold=BREAKER_THRESHOLD, backoff=BREAKER_BACKOFF, max_backoff=BREAKER_MAX_BACKOFF):
+        self.filename = filename
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.hosts = {}  # hostname -> {"failures", "open_until", "error"}
+        if path.exists(filename):
+            try:
+                with open(filename, "r") as f:
+                    self.hosts = json.load(f)
+            except (IOError, ValueError) as e:
+                logging.warning("Unable to read circuit breaker state %s. Starting with all hosts closed. %s" % (filename, e))
+
+
+    def allow(self, hostname):
+        # False while host is backed off. After backoff one probe is allowed, and a new failure backs off again.
+        with self.lock:
+            state = self.hosts.get(hostname)
+        return state is None or state["open_until"] <= time.time()
+
+
+    def state(self, hostname):
+        with self.lock:
+            return self.hosts.get(hostname)
+
+
+    def success(self, hostname):
+        with self.lock:
+            if self.hosts.pop(hostname, None) is not None: logging.info("Circuit breaker for %s closed" % (hostname))
+
+
+    def failure(self, hostname, error):
+        with self.lock:
+            state = self.hosts.setdefault(hostname, {"failures": 0, "open_until": 0})
+            state["failures"] += 1
+            state["error"] = error
+            if state["failures"] >= self.threshold:
+                backoff = min(self.backoff * 2 ** (state["failures"] - self.threshold), self.max_backoff)
+                state["open_until"] = time.time() + backoff
+                logging.warning("Circuit breaker for %s open for %s seconds after %s failed probes" % (hostname, backoff, state["failures"]))
+
+
+    def save(self):
+        # Write to temporary file first, so an interrupted run never leaves a half written file
+        with self.lock:
+            content = json.dumps(self.hosts, indent=1, sort_keys=True)
+        tmpfile = "%s.tmp" % (self.filename)
+        with open(tmpfile, "w") as f:
+            f.write(content)
+        os.rename(tmpfile, self.filename)
+
+
+class Prober(object):
+    def __init__(self, breaker=None, timeout=PROBE_TIMEOUT, workers=PROBE_WORKERS):
+        self.breaker = breaker
+        self.timeout = timeout
+        self.workers = workers
+
+
+    def probe_device(self, device):
+        # Returns None if device answered, otherwise the reason it is unreachable
+        host, port = address(device.hostname)
+        try:
+            sock = socket.create_connection((host, port), self.timeout)
+            sock.close()
+        except (socket.error, socket.timeout) as e:
+            return "TCP connect to port %s failed: %s" % (port, e)
+        # Any API answer shows the device is alive. The connection is kept in the pool for the rollout.
+        body = urllib.urlencode({"type": "op", "cmd": "<show><clock></clock></show>", "key": device.apikey})
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        try:
+            device.pool.request(device.hostname, "POST", "/api/", body, headers, self.timeout)
+        except ApiError as e:
+            return "No API answer: %s" % (e)
+        return None
+
+
+    def probe(self, device_list):
+        # Probes all devices at the same time. Returns dict of hostname and reason for unreachable devices.
+        # Hosts backed off by the circuit breaker are not probed.
+        unreachable = {}
+        probed = []
+        for device in device_list:
+            if self.breaker is not None and not self.breaker.allow(device.hostname):
+                state = self.breaker.state(device.hostname)
+                unreachable[device.hostname] = "Backed off until %s after %s failed probes. Last error: %s" % (
+                    time.strftime("%Y/%m/%d %H:%M:%S", time.localtime(state["open_until"])), state["failures"], state.get("error"))
+            else: probed.append(device)
+        if not probed: return unreachable
+        start = time.time()
+        from multiprocessing.pool import ThreadPool  # Imported on first probe, not for runs with nothing to probe
+        pool = ThreadPool(min(self.workers, len(probed)))
+        try:
+            results = pool.map(self.probe_device, probed)
+        finally:
+            pool.close()
+            pool.join()
+        for device, error in zip(probed, results):
+            if error is None:
+                if self.breaker is not None: self.breaker.success(device.hostname)
+                continue
+            logging.warning("%s - %s is unreachable. %s" % (device.hostname, device.name, error))
+            unreachable[device.hostname] = error
+            if self.breaker is not None: self.breaker.failure(device.hostname, error)
+        backed_off = len(device_list) - len(probed)
+        logging.info("Probed %s devices in %.1f seconds. %s unreachable, %s backed off" % (len(probed), time.time() - start, len(unreachable) - backed_off, backed_off))
+        return unreachable
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+#Copyright (c) 2016 Data Equipment AS
+#Author: Tor Mogstad <torm _AT_ dataequipment.no>
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+""" Module for per-device results of a rollout
+
+ResultStream - builds one record for each device as soon as it is done (hostname,
+name, overall result and status messages), and hands it to a set of sinks.
+Records are never collected, so memory use does not grow with the fleet.
+Summary - counts of devices and messages by result, and the first failure
+messages, added to record by record. Used for the e-mail digest and daemon status.
+Sinks - LogSink and StdoutSink write each status message, FileSink appends records
+as JSON lines, WebhookSink posts each record as JSON from a background thread, and
+EmailSink sends all status messages when the rollout is done, or only the summary
+as a digest.
+"""
+import sys
+import json
+import logging
+import threading
+import time
+
+
+# Result of a device is the first of these found in its status messages
+RESULTS = ["ERROR", "UNKNOWN", "ABORTED", "SUCCESS", "SKIPPED"]
+FAILED_RESULTS = ["ERROR", "UNKNOWN", "ABORTED"]
+MAX_FAILURES = 100  # Failure messages kept in summary. Others are only counted
+WEBHOOK_TIMEOUT = 5  # Seconds for each webhook POST
+WEBHOOK_QUEUE = 1000  # Records waiting to be posted. Records are dropped when full
+WEBHOOK_MAX_ERRORS = 5  # Failed posts in a row before webhook is disabled for the rollout
+
+
+def message_result(message):
+    # Result prefix of status message, as SUCCESS in "SUCCESS: Upload of ..."
+    return message.split(':')[0]
+
+
+def device_result(statuslist):
+    results = set(message_result(message) for message in statuslist)
+    for result in RESULTS:
+        if result in results: return result
+    return "UNKNOWN"
+
+
+def device_record(device, statuslist, content_files=None):
+    result = device_result(statuslist)
+    record = {"time": time.time(), "hostname": device.hostname, "name": device.name, "result": result,
+              "failed": result in FAILED_RESULTS, "messages": list(statuslist)}
+    if content_files is not None: record["content_files"] = dict(content_files)
+    return record
+
+
+class Summary(object):
+    def __init__(self, max_failures=MAX_FAILURES):
+        self.max_failures = max_failures
+        self.devices = 0
+        self.results = {}  # Devices by result
+        self.messages = {}  # Status messages by result
+        self.failures = []  # First max_failures messages of failed devices
+        self.omitted = 0
+
+
+    def add(self, record):
+        self.devices += 1
+        self.results[record["result"]] = self.results.get(record["result"], 0) + 1
+        for message in record["messages"]:
+            result = message_result(message)
+            self.messages[result] = self.messages.get(result, 0) + 1
+            if result not in FAILED_RESULTS: continue
+            if len(self.failures) < self.max_failures: self.failures.append(message)
+            else: self.omitted += 1
+
+
+    def counts(self):
+        # "12 devices: SUCCESS 10, ERROR 2"
+        results = ", ".join("%s %s" % (result, self.results[result]) for result in RESULTS if result in self.results)
+        return "%s devices: %s" % (self.devices, results or "none processed")
+
+
+    def text(self):
+        # Digest of rollout, for e-mail
+        lines = [self.counts()]
+        if self.failures:
+            lines.append("")
+            lines.append("Failures:")
+            lines.extend(self.failures)
+        if self.omitted: lines.append("... and %s more failure messages. See results file" % (self.omitted))
+        return "\n".join(lines)
+
+
+    def to_dict(self):
+        return {"devices": self.devices, "results": dict(self.results), "messages": dict(self.messages),
+                "failures": list(self.failures), "omitted": self.omitted}
+
+
+class LogSink(object):
+    def emit(self, record):
+        for message in record["messages"]: logging.info(message)
+
+
+    def close(self, summary):
+        logging.info("Results: %s" % (summary.counts()))
+
+
+class StdoutSink(object):
+    def emit(self, record):
+        for message in record["messages"]: print message
+        sys.stdout.flush()
+
+
+    def close(self, summary):
+        print summary.counts()
+
+
+class FileSink(object):
+    def __init__(self, filename):
+        # Records are appended, one JSON object per line, and flushed as written so a crash keeps them
+        self.filename = filename
+        self.file = open(filename, "a")
+
+
+    def emit(self, record):
+        self.file.write(json.dumps(record, sort_keys=True) + "\n")
+        self.file.flush()
+
+
+    def close(self, summary):
+        self.file.close()
+
+
+class WebhookSink(object):
+    def __init__(self, url, timeout=WEBHOOK_TIMEOUT, queue_size=WEBHOOK_QUEUE):
+        # Records are posted from a thread of their own, so a slow webhook never holds up devices
+        import Queue  # Only needed with a webhook
+        self.url = url
+        self.timeout = timeout
+        self.queue = Queue.Queue(queue_size)
+        self.full = Queue.Full
+        self.dropped = 0
+        self.errors = 0
+        self.thread = threading.Thread(target=self._post_records, name="ResultWebhook")
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except self.full:
+            self.dropped += 1
+
+
+    def _post_records(self):
+        import urllib2
+        while True:
+            record = self.queue.get()
+            if record is None: return
+            if self.errors >= WEBHOOK_MAX_ERRORS:
+                self.dropped += 1
+                continue
+            try:
+                request = urllib2.Request(self.url, json.dumps(record), {"Content-Type": "application/json"})
+                urllib2.urlopen(request, timeout=self.timeout).close()
+                self.errors = 0
+            except Exception as e:
+                self.errors += 1
+                logging.warning("Unable to post result of %s to webhook: %s" % (record["name"], e))
+                if self.errors == WEBHOOK_MAX_ERRORS: logging.error("Webhook disabled for this rollout after %s failed posts" % (self.errors))
+
+
+    def close(self, summary):
+        # Records already queued are posted before closing
+        self.queue.put(None)
+        self.thread.join()
+        if self.dropped: logging.warning("%s results were not posted to webhook" % (self.dropped))
+
+
+class EmailSink(object):
+    def __init__(self, emailobj, digest=False):
+        # All status messages are sent, as one line each. digest - send only counts and failure messages from summary.
+        self.emailobj = emailobj
+        self.digest = digest
+        self.messages = []
+
+
+    def emit(self, record):
+        if not self.digest: self.messages.extend(record["messages"])
+
+
+    def close(self, summary):
+        if self.digest: self.emailobj.content = summary.text()
+        else: self.emailobj.content = "".join("\n%s" % (message) for message in self.messages)
+        self.emailobj.send_email()
+
+
+class ResultStream(object):
+    def __init__(self, sinks, content_files=None):
+        self.sinks = list(sinks)
+        self.content_files = content_files
+        self.summary = Summary()
+        self.lock = threading.Lock()
+
+
+    def emit(self, device, statuslist):
+        # Record of device is passed to all sinks. A failing sink is logged, and doesn't stop the others.
+        record = device_record(device, statuslist, self.content_files)
+        with self.lock:
+            self.summary.add(record)
+            for sink in self.sinks:
+                try:
+                    sink.emit(record)
+                except Exception as e:
+                    logging.error("Unable to write result of %s to %s: %s" % (device.name, sink.__class__.__name__, e))
+        return record
+
+
+    def close(self):
+        with self.lock:
+            for sink in self.sinks:
+                try:
+                    sink.close(self.summary)
+                except Exception as e:
+                    logging.error("Unable to close %s: %s" % (sink.__class__.__name__, e))
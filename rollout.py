@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+#Copyright (c) 2016 Data Equipment AS
+#Author: Tor Mogstad <torm _AT_ dataequipment.no>
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+""" Module for staged rollouts
+
+WaveScheduler - splits devices into waves that grow in size (a small canary set
+first), and processes each wave on its own number of worker threads. The rollout
+is stopped when the share of failed devices passes a set threshold, so a bad
+content package does not reach the whole fleet.
+
+Devices in the same HA group (ha=<group> in devices.conf) are one unit, so peers
+are never updated at the same time. Peers are updated passive first.
+"""
+import math
+import logging
+import threading
+
+
+# Order HA peers are updated in, by local HA state. Active peer is updated last.
+# States not listed (passive, suspended, non-functional, HA not enabled, unknown) come first.
+HA_ORDER = {"active-secondary": 1, "active": 2, "active-primary": 2}
+
+
+class RolloutError(StandardError):
+    pass
+
+
+def ha_groups(devices):
+    # Devices grouped into units. Devices with the same ha option are one unit, placed where the first of them is listed.
+    # Other devices are units of their own.
+    units = []
+    groups = {}
+    for device in devices:
+        group = device.options.get("ha")
+        if not group:
+            units.append([device])
+        elif group in groups:
+            groups[group].append(device)
+        else:
+            groups[group] = [device]
+            units.append(groups[group])
+    return units
+
+
+def ha_order(group):
+    # HA peers in the order they should be updated, from HA state on each device. A peer where state can't be read
+    # is placed first, so the rollout of the group stops there if it is down.
+    states = {}
+    for device in group:
+        try:
+            states[device.hostname] = device.ha_state()
+        except StandardError as e:
+            logging.warning("Unable to read HA state of %s: %s" % (device.name, e))
+            states[device.hostname] = "unknown"
+        if states[device.hostname] is None: logging.warning("HA is not enabled on %s, but it is in an HA group" % (device.name))
+    ordered = sorted(group, key=lambda device: HA_ORDER.get(states[device.hostname], 0))
+    logging.info("HA group %s: updating %s" % (group[0].options.get("ha"), ", ".join("%s (%s)" % (device.name, states[device.hostname]) for device in ordered)))
+    return ordered
+
+
+class WaveScheduler(object):
+    def __init__(self, waves=(100,), concurrency=(1,), max_failure_rate=None, min_failures=1):
+        # waves - cumulative share of devices (percent) done after each wave, last must be 100
+        # concurrency - worker threads for each wave. Last value is used for any following waves
+        # max_failure_rate - percent of processed devices that may fail before rollout is stopped. None never stops.
+        # min_failures - failures needed before rollout can be stopped
+        waves = list(waves)
+        if not waves or waves[-1] != 100 or waves != sorted(waves) or waves[0] <= 0:
+            raise RolloutError("Waves must be increasing percentages ending with 100")
+        if not concurrency or min(concurrency) < 1: raise RolloutError("Concurrency must be 1 or higher")
+        self.waves = waves
+        self.concurrency = list(concurrency)
+        self.max_failure_rate = max_failure_rate
+        self.min_failures = min_failures
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+        self.aborted = False
+
+
+    def split(self, units):
+        # Split units into waves. Each wave has at least one unit.
+        split = []
+        done = 0
+        for percent in self.waves:
+            end = max(done + 1, int(math.ceil(len(units) * percent / 100.0)))
+            end = min(end, len(units))
+            if end > done: split.append(units[done:end])
+            done = end
+        return split
+
+
+    def _record(self, failed):
+        # Count result, and stop rollout if failure threshold is passed
+        with self.lock:
+            self.processed += 1
+            if failed: self.failed += 1
+            if self.max_failure_rate is None or self.aborted: return
+            if self.failed >= self.min_failures and self.failed * 100.0 / self.processed > self.max_failure_rate:
+                self.aborted = True
+                logging.error("Stopping rollout: %s of %s processed devices failed, threshold is %s%%" % (self.failed, self.processed, self.max_failure_rate))
+
+
+    def run(self, units, process, is_failure, on_abort, order=None, start=None):
+        # Process units wave by wave. Returns list of results in same order as units.
+        # process(unit) returns result, is_failure(result) tells if unit failed, and on_abort(unit) gives result
+        # for units not processed because rollout was stopped. order(wave) can change processing order in a wave.
+        # start(wave) is called before a wave is processed, and not for waves stopped before they start.
+        results = {}
+
+        def run_unit(unit):
+            if self.aborted: return on_abort(unit)
+            result = process(unit)
+            self._record(is_failure(result))
+            return result
+
+        for number, wave in enumerate(self.split(units)):
+            if self.aborted:
+                for unit in wave: results[id(unit)] = on_abort(unit)
+                continue
+            concurrency = self.concurrency[min(number, len(self.concurrency) - 1)]
+            logging.info("Starting wave %s of %s with %s devices or HA groups, %s at a time" % (number + 1, len(self.waves), len(wave), concurrency))
+            if order is not None: wave = order(wave)
+            if start is not None: start(wave)
+            if concurrency > 1 and len(wave) > 1:
+                from multiprocessing.pool import ThreadPool  # Only imported when devices are processed in parallel
+                pool = ThreadPool(min(concurrency, len(wave)))
+                try:
+                    wave_results = pool.map(run_unit, wave, chunksize=1)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                wave_results = [run_unit(unit) for unit in wave]
+            for unit, result in zip(wave, wave_results): results[id(unit)] = result
+        return [results[id(unit)] for unit in units]
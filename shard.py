@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+#Copyright (c) 2016 Data Equipment AS
+#Author: Tor Mogstad <torm _AT_ dataequipment.no>
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+""" Module for sharded rollouts over several runner hosts
+
+Devices are split into shards deterministically, by hash of hostname or by site,
+so every runner computes the same split from the same devices.conf.
+LeaseStore - SQLite database on shared storage. A runner takes a lease on a
+device before processing it, and stores the result when done, so each device is
+handled once per run. Runners started together share a round of the rollout.
+Devices that succeeded or were skipped are done for the rollout, while failed
+devices are tried again by the next round. Leases and runner heartbeats expire, so the shard of a
+runner that dies is taken over by another.
+ShardRunner - processes the runner's own shard, then takes over shards without a
+live runner until all devices are done. The runner finishing the rollout reports
+the merged results of all shards.
+"""
+from results import device_result
+from results import FAILED_RESULTS
+from contextlib import contextmanager
+import os
+import json
+import socket
+import hashlib
+import logging
+import threading
+import time
+
+
+LEASE_TTL = 60  # Seconds before lease of a runner that stopped heartbeating can be taken over
+SHARD_POLL = 5  # Seconds between checks for finished or orphaned shards
+
+
+class ShardError(StandardError):
+    pass
+
+
+def stable_hash(text):
+    # Same on every host and Python version, unlike hash()
+    return int(hashlib.sha1(text).hexdigest()[:8], 16)
+
+
+def assign_shards(device_list, shards, by="hash"):
+    # Returns dict of hostname and shard number (0 to shards-1).
+    # by="site" keeps devices of a site in one shard. Largest sites are placed first, each on the least loaded shard.
+    # Devices without site are placed one by one. Devices of an HA group are always in the same shard, placed by
+    # the first of them, so peers are never updated by two runners at the same time.
+    first = {}
+    for device in device_list: first.setdefault(device.options.get("ha") or device.hostname, device)
+    def leader(device):
+        return first[device.options.get("ha") or device.hostname]
+    if by == "hash": return dict((device.hostname, stable_hash(leader(device).hostname) % shards) for device in device_list)
+    if by != "site": raise ShardError("Unsupported shard key %s. Use hash or site" % (by))
+    sites = {}
+    for device in device_list: sites.setdefault(leader(device).options.get("site") or leader(device).hostname, []).append(device)
+    load = [0] * shards
+    assignment = {}
+    for site in sorted(sites, key=lambda site: (-len(sites[site]), site)):
+        shard = min(range(shards), key=lambda shard: (load[shard], shard))
+        load[shard] += len(sites[site])
+        for device in sites[site]: assignment[device.hostname] = shard
+    return assignment
+
+
+def rollout_id(content_files):
+    # Runners rolling out the same content files share leases. Each invocation of the runners is a round within it.
+    return hashlib.sha1(",".join("%s:%s" % (package, content_file) for package, content_file in content_files)).hexdigest()[:16]
+
+
+class LeaseStore(object):
+    def __init__(self, filename, rollout, owner=None, ttl=LEASE_TTL):
+        import sqlite3  # Only needed in sharded mode
+        self.filename = filename
+        self.rollout = rollout
+        if owner is None: owner = "%s:%s" % (socket.gethostname(), os.getpid())
+        self.owner = owner
+        self.ttl = ttl
+        self.round = None  # Set by register()
+        self.lock = threading.Lock()
+        self.error = sqlite3.Error
+        try:
+            self.db = sqlite3.connect(filename, timeout=60, isolation_level=None, check_same_thread=False)
+            with self._transaction() as db:
+                db.execute("CREATE TABLE IF NOT EXISTS leases (rollout TEXT, device TEXT, shard INTEGER, owner TEXT, state TEXT, expires REAL, result TEXT, round INTEGER, PRIMARY KEY (rollout, device))")
+                db.execute("CREATE TABLE IF NOT EXISTS runners (rollout TEXT, round INTEGER, shard INTEGER, owner TEXT, heartbeat REAL, PRIMARY KEY (rollout, round, shard, owner))")
+                db.execute("CREATE TABLE IF NOT EXISTS reports (rollout TEXT, round INTEGER, owner TEXT, time REAL, PRIMARY KEY (rollout, round))")
+                columns = [row[1] for row in db.execute("PRAGMA table_info(leases)")]
+        except sqlite3.Error as e:
+            raise ShardError("Unable to open shard store %s: %s" % (filename, e))
+        if "round" not in columns: raise ShardError("Shard store %s was made by an older version. Remove it and start again" % (filename))
+
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the database write lock, so check and update of a lease is atomic across runners
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.db
+            except:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+
+    def register(self, shard):
+        # Join the current round of the rollout, or start a new one when the last round was reported or has no live
+        # runner. Runners started together share a round. Returns round number.
+        with self._transaction() as db:
+            if self.round is None:
+                last = db.execute("SELECT MAX(round) FROM runners WHERE rollout=?", (self.rollout,)).fetchone()[0]
+                if last is None: self.round = 1
+                else:
+                    reported = db.execute("SELECT 1 FROM reports WHERE rollout=? AND round=?", (self.rollout, last)).fetchone()
+                    alive = db.execute("SELECT 1 FROM runners WHERE rollout=? AND round=? AND heartbeat>?", (self.rollout, last, time.time() - self.ttl)).fetchone()
+                    if reported or not alive: self.round = last + 1
+                    else: self.round = last
+            db.execute("INSERT OR REPLACE INTO runners VALUES (?, ?, ?, ?, ?)", (self.rollout, self.round, shard, self.owner, time.time()))
+        return self.round
+
+
+    def heartbeat(self):
+        # Runner is alive, and keeps its running leases
+        now = time.time()
+        with self._transaction() as db:
+            db.execute("UPDATE runners SET heartbeat=? WHERE rollout=? AND round=? AND owner=?", (now, self.rollout, self.round, self.owner))
+            db.execute("UPDATE leases SET expires=? WHERE rollout=? AND owner=? AND state='running'", (now + self.ttl, self.rollout, self.owner))
+
+
+    def acquire(self, hostname, shard):
+        # Returns "acquired", "done" if device succeeded or was skipped in this rollout or failed in this round, or "leased" if
+        # another runner holds the lease. Devices that failed in an earlier round are acquired again.
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute("SELECT owner, state, expires, round FROM leases WHERE rollout=? AND device=?", (self.rollout, hostname)).fetchone()
+            if row is not None:
+                owner, state, expires, round = row
+                if state == "done": return "done"
+                if state == "failed" and round == self.round: return "done"
+                if state == "running" and owner != self.owner and expires > now: return "leased"
+                if state == "running" and owner != self.owner: logging.warning("Taking over lease on %s from %s" % (hostname, owner))
+            db.execute("INSERT OR REPLACE INTO leases VALUES (?, ?, ?, ?, 'running', ?, NULL, ?)", (self.rollout, hostname, shard, self.owner, now + self.ttl, self.round))
+        return "acquired"
+
+
+    def complete(self, hostname, statuslist, succeeded=True):
+        # Device is done for the rollout when it succeeded or was skipped. Otherwise it is only done for this round, and is tried
+        # again by the next run of the same content files.
+        if succeeded: state = "done"
+        else: state = "failed"
+        with self._transaction() as db:
+            cursor = db.execute("UPDATE leases SET state=?, result=?, round=? WHERE rollout=? AND device=? AND owner=?",
+                                (state, json.dumps(statuslist), self.round, self.rollout, hostname, self.owner))
+            if cursor.rowcount == 0:
+                logging.warning("Lease on %s was taken over by another runner before it was done. Result is stored anyway" % (hostname))
+                db.execute("UPDATE leases SET state=?, result=?, round=?, owner=? WHERE rollout=? AND device=?",
+                           (state, json.dumps(statuslist), self.round, self.owner, self.rollout, hostname))
+
+
+    def pending(self, hostnames):
+        # Hostnames not finished in this round
+        with self.lock:
+            finished = set(row[0] for row in self.db.execute("SELECT device FROM leases WHERE rollout=? AND (state='done' OR (state='failed' AND round=?))",
+                                                             (self.rollout, self.round)))
+        return [hostname for hostname in hostnames if hostname not in finished]
+
+
+    def alive_shards(self):
+        # Shards with a runner heartbeat within ttl in this round
+        with self.lock:
+            rows = self.db.execute("SELECT DISTINCT shard FROM runners WHERE rollout=? AND round=? AND heartbeat>?", (self.rollout, self.round, time.time() - self.ttl))
+            return set(row[0] for row in rows)
+
+
+    def results(self):
+        # Status messages of each device finished in this round, by hostname
+        with self.lock:
+            rows = self.db.execute("SELECT device, result FROM leases WHERE rollout=? AND round=? AND state IN ('done', 'failed')", (self.rollout, self.round)).fetchall()
+        return dict((hostname, json.loads(result)) for hostname, result in rows)
+
+
+    def claim_report(self):
+        # True for the one runner that reports the merged results of the round
+        with self._transaction() as db:
+            cursor = db.execute("INSERT OR IGNORE INTO reports VALUES (?, ?, ?, ?)", (self.rollout, self.round, self.owner, time.time()))
+            return cursor.rowcount == 1
+
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class ShardRunner(object):
+    def __init__(self, store, shard, shards, assignment, poll=SHARD_POLL):
+        self.store = store
+        self.shard = shard
+        self.shards = shards
+        self.assignment = assignment  # hostname -> shard, from assign_shards()
+        self.poll = poll
+        self.started = None
+        self.merged = False  # Set by run() when this runner reports the results of all shards
+        self.stopped = threading.Event()
+
+
+    def acquire(self, devices):
+        # Devices this runner got the lease on, and should process
+        acquired = []
+        for device in devices:
+            try:
+                if self.store.acquire(device.hostname, self.assignment[device.hostname]) == "acquired": acquired.append(device)
+            except self.store.error as e:
+                logging.error("Unable to take lease on %s: %s. Device is left to other runners" % (device.name, e))
+        return acquired
+
+
+    def complete(self, device, statuslist):
+        try:
+            self.store.complete(device.hostname, statuslist, device_result(statuslist) not in FAILED_RESULTS)
+        except self.store.error as e:
+            logging.error("Unable to store result of %s in shard store: %s" % (device.name, e))
+
+
+    def _heartbeat(self):
+        while not self.stopped.wait(self.store.ttl / 3.0):
+            try:
+                self.store.heartbeat()
+            except self.store.error as e:
+                logging.error("Shard store heartbeat failed: %s" % (e))
+
+
+    def run(self, device_list, process):
+        # process - called with list of leased devices to process. It must call complete() for each device when done.
+        # merged is set when this runner is the one to report the results of all shards.
+        self.started = time.time()
+        self.stopped.clear()
+        round = self.store.register(self.shard)
+        thread = threading.Thread(target=self._heartbeat, name="ShardHeartbeat")
+        thread.daemon = True
+        thread.start()
+        own = [device for device in device_list if self.assignment[device.hostname] == self.shard]
+        logging.info("Shard %s of %s: %s of %s devices, round %s" % (self.shard, self.shards, len(own), len(device_list), round))
+        try:
+            process(self.acquire(own))
+            # Wait for other shards, and take over shards whose runner is gone. Shards that never had a runner
+            # are given one lease ttl from our start, so runners started a little later are not raced.
+            # Own devices still pending were leased by an earlier run of this shard that died, and are retried.
+            while True:
+                pending = set(self.store.pending([device.hostname for device in device_list]))
+                if not pending: break
+                alive = self.store.alive_shards()
+                grace = time.time() - self.started > self.store.ttl
+                orphaned = [device for device in device_list if device.hostname in pending and self.assignment[device.hostname] not in alive and grace]
+                retry = [device for device in device_list if device.hostname in pending and self.assignment[device.hostname] == self.shard]
+                acquired = self.acquire(retry + orphaned)
+                if acquired:
+                    shards = sorted(set(self.assignment[device.hostname] for device in acquired if self.assignment[device.hostname] != self.shard))
+                    if shards: logging.warning("Taking over devices of shards %s without a live runner" % (", ".join(str(shard) for shard in shards)))
+                    process(acquired)
+                else: time.sleep(self.poll)
+        finally:
+            self.stopped.set()
+            thread.join()
+        self.merged = self.store.claim_report()
+        if not self.merged: logging.info("All shards done. Merged results are reported by another runner")
+        else: logging.info("All shards done. Reporting merged results")
+
+
+    def merged_results(self, device_list):
+        # Device and status messages of each done device in all shards, in devices.conf order
+        results = self.store.results()
+        return [(device, results[device.hostname]) for device in device_list if device.hostname in results]
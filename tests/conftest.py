@@ -0,0 +1,27 @@
+from os import path
+import sys
+import imp
+
+import pytest
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+class FakeDevice(object):
+    # Device with the attributes used by scheduling, sharding and reporting
+    def __init__(self, hostname, name=None, options=None):
+        self.hostname = hostname
+        self.name = name or hostname
+        self.options = options or {}
+
+
+@pytest.fixture
+def make_device():
+    return FakeDevice
+
+
+@pytest.fixture(scope="session")
+def script():
+    # pan-dyn-update.py loaded as a module
+    return imp.load_source("pan_dyn_update", path.join(ROOT, "pan-dyn-update.py"))
@@ -0,0 +1,102 @@
+import errno
+import httplib
+import socket
+
+import pytest
+
+from connection import ApiError
+from connection import ConnectionPool
+
+
+class Response(object):
+    status = 200
+    will_close = False
+
+    def read(self):
+        return "ok"
+
+
+class Connection(object):
+    # Fails with send_error while sending, or response_error when reading the answer
+    def __init__(self, send_error=None, response_error=None):
+        self.send_error = send_error
+        self.response_error = response_error
+        self.sent = 0
+        self.closed = False
+
+    def putrequest(self, method, url, skip_accept_encoding=False):
+        if self.send_error is not None: raise self.send_error
+
+    def putheader(self, header, value):
+        pass
+
+    def endheaders(self):
+        pass
+
+    def send(self, data):
+        self.sent += 1
+
+    def getresponse(self):
+        if self.response_error is not None: raise self.response_error
+        return Response()
+
+    def close(self):
+        self.closed = True
+
+
+def pool_with(connections):
+    # First connection is a reused idle one, the rest are new
+    pool = ConnectionPool(None)
+    queue = list(connections)
+    def get(host, timeout):
+        return queue.pop(0), len(queue) == len(connections) - 1
+    pool._get = get
+    return pool
+
+
+@pytest.mark.parametrize("error", [
+    socket.error(errno.ECONNRESET, "Connection reset by peer"),
+    socket.error(errno.EPIPE, "Broken pipe"),
+])
+def test_retries_when_idle_connection_fails_before_sending(error):
+    stale, fresh = Connection(send_error=error), Connection()
+    assert pool_with([stale, fresh]).request("fw", "POST", "/api/", "body") == (200, "ok")
+    assert stale.closed and fresh.sent == 1
+
+
+def test_retries_when_idle_connection_closed_without_answer():
+    stale, fresh = Connection(response_error=httplib.BadStatusLine("No status line received - the server has closed the connection")), Connection()
+    assert pool_with([stale, fresh]).request("fw", "POST", "/api/", "body") == (200, "ok")
+    assert fresh.sent == 1
+
+
+@pytest.mark.parametrize("error", [
+    socket.timeout("timed out"),
+    socket.error(errno.ECONNRESET, "Connection reset by peer"),
+    httplib.BadStatusLine("HTTP/1.1 2"),
+    httplib.IncompleteRead("partial"),
+])
+def test_never_resends_after_request_reached_device(error):
+    stale, fresh = Connection(response_error=error), Connection()
+    with pytest.raises(ApiError):
+        pool_with([stale, fresh]).request("fw", "POST", "/api/", "body")
+    assert stale.sent == 1 and fresh.sent == 0
+
+
+def test_never_resends_after_timeout_while_sending():
+    stale, fresh = Connection(send_error=socket.timeout("timed out")), Connection()
+    with pytest.raises(ApiError):
+        pool_with([stale, fresh]).request("fw", "POST", "/api/", "body")
+    assert fresh.sent == 0
+
+
+def test_new_connection_is_not_retried():
+    connections = []
+    def get(host, timeout):
+        connections.append(Connection(send_error=socket.error(errno.ECONNRESET, "Connection reset by peer")))
+        return connections[-1], False
+    pool = ConnectionPool(None)
+    pool._get = get
+    with pytest.raises(ApiError):
+        pool.request("fw", "POST", "/api/", "body")
+    assert len(connections) == 1
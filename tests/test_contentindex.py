@@ -0,0 +1,71 @@
+import os
+
+from contentindex import ContentIndex
+from contentindex import parse_version
+
+
+def write(folder, name, data, mtime=None):
+    filepath = folder.join(name)
+    filepath.write(data, mode="wb")
+    if mtime is not None: os.utime(str(filepath), (mtime, mtime))
+    return filepath
+
+
+def index(tmpdir):
+    folder = tmpdir.mkdir("panupv2-all-contents")
+    return folder, ContentIndex(str(tmpdir.join("content-index.json")), {"appthreat": str(folder)})
+
+
+def test_parse_version():
+    assert parse_version("panupv2-all-contents-595-3465") == (595, 3465)
+    assert parse_version("panupv2-all-contents-595-3465.tgz") == (595, 3465)
+    assert parse_version("panupv2-all-contents-latest") is None
+    assert parse_version("readme") is None
+
+
+def test_newest_file_and_newer_than(tmpdir):
+    folder, content = index(tmpdir)
+    write(folder, "panupv2-all-contents-595-3465", "a")
+    write(folder, "panupv2-all-contents-600-3500", "b")
+    write(folder, "notes.txt", "c")
+    assert content.refresh() == ["appthreat"]
+    assert content.newest("appthreat") == "panupv2-all-contents-600-3500"
+    assert content.newest_newer_than("appthreat", (600, 3500)) is None
+    assert content.newest_newer_than("appthreat", (595, 3465)) == "panupv2-all-contents-600-3500"
+    assert content.older_sizes("appthreat", "panupv2-all-contents-600-3500") == [1]
+    assert content.refresh() == []
+
+
+def test_file_rewritten_in_place_is_hashed_again(tmpdir):
+    folder, content = index(tmpdir)
+    filepath = write(folder, "panupv2-all-contents-600-3500", "partial", mtime=1000)
+    content.refresh()
+    old = content.digest("appthreat", "panupv2-all-contents-600-3500")
+    folder_mtime = os.stat(str(folder)).st_mtime
+    write(folder, "panupv2-all-contents-600-3500", "complete file", mtime=2000)
+    os.utime(str(folder), (folder_mtime, folder_mtime))
+    assert content.refresh() == ["appthreat"]
+    assert content.entry("appthreat", "panupv2-all-contents-600-3500")["size"] == len("complete file")
+    assert content.digest("appthreat", "panupv2-all-contents-600-3500") != old
+
+
+def test_same_size_change_is_found_by_mtime(tmpdir):
+    folder, content = index(tmpdir)
+    write(folder, "panupv2-all-contents-600-3500", "aaaa", mtime=1000)
+    content.refresh()
+    old = content.digest("appthreat", "panupv2-all-contents-600-3500")
+    folder_mtime = os.stat(str(folder)).st_mtime
+    write(folder, "panupv2-all-contents-600-3500", "bbbb", mtime=2000)
+    os.utime(str(folder), (folder_mtime, folder_mtime))
+    assert content.refresh() == ["appthreat"]
+    assert content.digest("appthreat", "panupv2-all-contents-600-3500") != old
+
+
+def test_index_is_kept_between_runs(tmpdir):
+    folder, content = index(tmpdir)
+    write(folder, "panupv2-all-contents-600-3500", "b")
+    content.refresh()
+    content.save()
+    content = ContentIndex(str(tmpdir.join("content-index.json")), {"appthreat": str(folder)})
+    assert content.newest("appthreat") == "panupv2-all-contents-600-3500"
+    assert content.refresh() == []
@@ -0,0 +1,80 @@
+import argparse
+
+import pytest
+
+from results import ResultStream
+
+CONTENT_FILES = [("appthreat", "panupv2-all-contents-600-3500")]
+
+
+class Watcher(object):
+    # Reports one change, and stops the daemon on the next wait
+    def __init__(self, directories, settle):
+        self.waits = 0
+
+    def wait(self):
+        self.waits += 1
+        if self.waits > 1: raise KeyboardInterrupt()
+        return ["panupv2-all-contents"]
+
+    def wake(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class StatusServer(object):
+    instance = None
+
+    def __init__(self, address, port, get_status, request_rollout):
+        self.get_status = get_status
+        StatusServer.instance = self
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+@pytest.fixture
+def daemon(script, monkeypatch):
+    # Runs daemon with rollout function until the watcher stops it. Returns the status server.
+    def run(run_rollout, watcher=Watcher):
+        monkeypatch.setattr(script, "DirectoryWatcher", watcher)
+        monkeypatch.setattr(script, "StatusServer", StatusServer)
+        monkeypatch.setattr(script, "find_content_files", lambda content_types, index, validator: CONTENT_FILES)
+        monkeypatch.setattr(script, "create_result_stream", lambda *args: ResultStream([]))
+        monkeypatch.setattr(script, "run_rollout", run_rollout)
+        monkeypatch.setattr(script.signal, "signal", lambda signum, handler: None)
+        args = argparse.Namespace(settle=0, status_port=1, e=False, metrics_json=None, metrics_prom=None)
+        script.run_daemon(args, [], ["appthreat"], True, None, None, None, None, None, None, None, False)
+        return StatusServer.instance
+    return run
+
+
+def test_failed_rollout_is_reported_and_daemon_keeps_watching(daemon):
+    rollouts = []
+    def run_rollout(device_list, content_files, *args, **kwargs):
+        rollouts.append(content_files)
+        if len(rollouts) == 1: raise RuntimeError("boom")
+    server = daemon(run_rollout)
+    # First rollout failed, and the same files were rolled out again on the next change
+    assert rollouts == [CONTENT_FILES, CONTENT_FILES]
+    status = server.get_status()
+    assert status["rollouts"] == 2
+    assert status["last_rollout"]["error"] is None
+
+
+def test_failed_rollout_sets_error_state(daemon):
+    def run_rollout(*args, **kwargs):
+        raise RuntimeError("boom")
+    statuses = []
+    class Stopping(Watcher):
+        def wait(self):
+            statuses.append(StatusServer.instance.get_status())
+            raise KeyboardInterrupt()
+    daemon(run_rollout, Stopping)
+    assert "boom" in statuses[0]["error"]
+    assert "boom" in statuses[0]["last_rollout"]["error"]
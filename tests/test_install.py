@@ -0,0 +1,24 @@
+import pytest
+
+
+class InstallingDevice(object):
+    def __init__(self, error=None):
+        self.hostname = "10.0.0.1"
+        self.name = "fw1"
+        self.error = error
+        self.installed = []
+
+    def wait_for_install(self, future, content_file, package):
+        if self.error is not None: raise self.error
+        return True
+
+    def set_installed_version(self, content_file, package):
+        self.installed.append(content_file)
+
+
+@pytest.mark.parametrize("error, prefix", [(None, "SUCCESS"), ("failed", "ERROR")])
+def test_one_status_per_install_job(script, error, prefix):
+    device = InstallingDevice(error and script.InstallError(error))
+    statuslist = script.install_status_messages(device, "panupv2-all-contents-600-3500", "appthreat", None)
+    assert [status.split(":")[0] for status in statuslist] == [prefix]
+    assert device.installed == ([] if error else ["panupv2-all-contents-600-3500"])
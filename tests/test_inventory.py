@@ -0,0 +1,43 @@
+import inventory
+from inventory import InventoryCache
+
+
+def versions(device, app_version="595-3465"):
+    device.app_version = device.threat_version = app_version
+    device.av_version = "2453-2943"
+    device.wf_version = "118130-120972"
+    device.model = "PA-200"
+    return device
+
+
+def test_entry_expires_after_ttl(tmpdir, make_device, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(inventory.time, "time", lambda: now[0])
+    cache = InventoryCache(str(tmpdir.join("inventory.json")), 60)
+    cache.update(versions(make_device("fw1")))
+    now[0] += 60
+    device = make_device("fw1")
+    assert cache.load(device)
+    assert (device.app_version, device.model) == ("595-3465", "PA-200")
+    now[0] += 1
+    assert not cache.load(make_device("fw1"))
+    assert cache.get("fw1") is None
+
+
+def test_cache_survives_save_and_load(tmpdir, make_device):
+    filename = str(tmpdir.join("inventory.json"))
+    cache = InventoryCache(filename, 3600)
+    cache.update(versions(make_device("fw1"), "600-3500"))
+    cache.update(versions(make_device("fw2")))
+    cache.invalidate("fw2")
+    cache.save()
+    cache = InventoryCache(filename, 3600)
+    assert cache.get("fw1")["app_version"] == "600-3500"
+    assert cache.get("fw2") is None
+    # Expired by a shorter ttl in a later run
+    assert InventoryCache(filename, -1).get("fw1") is None
+
+
+def test_unreadable_cache_starts_empty(tmpdir):
+    tmpdir.join("inventory.json").write("{not json")
+    assert InventoryCache(str(tmpdir.join("inventory.json")), 3600).devices == {}
@@ -0,0 +1,76 @@
+import threading
+import time
+
+import pytest
+
+from jobs import JobError
+from jobs import JobTracker
+
+
+def jobs_xml(jobid, status="FIN", result="OK"):
+    return ('<response status="success"><result><job><id>%s</id><status>%s</status><result>%s</result>'
+            '<progress>100</progress><details></details></job></result></response>' % (jobid, status, result))
+
+
+class Device(object):
+    # Answers job polls with finished jobs. Polls block while release is not set.
+    def __init__(self, name, status="FIN", result="OK"):
+        self.name = name
+        self.verbose = False
+        self.status = status
+        self.result = result
+        self.release = threading.Event()
+        self.release.set()
+        self.polls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def op(self, cmd, cmd_xml=False):
+        with self.lock:
+            self.polls += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        self.release.wait()
+        with self.lock: self.in_flight -= 1
+        return jobs_xml(cmd.split('"')[1], self.status, self.result)
+
+
+@pytest.fixture
+def tracker():
+    tracker = JobTracker(poll_min=0.05, poll_max=0.05)
+    yield tracker
+    tracker.stop()
+
+
+def test_job_result(tracker):
+    assert tracker.track(Device("fw1"), "5", 10).result(5)["id"] == "5"
+
+
+def test_failed_job_raises(tracker):
+    with pytest.raises(JobError):
+        tracker.track(Device("fw1", result="FAIL"), "5", 10).result(5)
+
+
+def test_slow_device_does_not_delay_other_devices(tracker):
+    slow = Device("slow")
+    slow.release.clear()
+    slow_job = tracker.track(slow, "1", 10, interval=0.01)
+    fast_job = tracker.track(Device("fast"), "2", 10, interval=0.2)
+    try:
+        assert fast_job.result(2)["id"] == "2"
+        assert not slow_job.done()
+    finally:
+        slow.release.set()
+    assert slow_job.result(2)["id"] == "1"
+
+
+def test_device_with_poll_in_flight_is_not_polled_again(tracker):
+    device = Device("fw1", status="ACT")
+    device.release.clear()
+    tracker.track(device, "1", 10, interval=0.01)
+    time.sleep(0.3)
+    assert device.polls == 1
+    device.release.set()
+    time.sleep(0.3)
+    assert device.polls > 1 and device.max_in_flight == 1
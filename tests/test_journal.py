@@ -0,0 +1,96 @@
+from journal import Journal
+
+CONTENT_FILES = [("appthreat", "panupv2-all-contents-600-3500"), ("antivirus", "panup-all-antivirus-2500-3000")]
+
+
+class Future(object):
+    def __init__(self, jobid, exception=None):
+        self.jobid = jobid
+        self._exception = exception
+
+    def exception(self):
+        return self._exception
+
+    def add_done_callback(self, callback):
+        callback(self)
+
+
+def test_resume_skips_finished_devices(tmpdir, make_device):
+    filename = str(tmpdir.join("journal.jsonl"))
+    fw1, fw2 = make_device("fw1"), make_device("fw2")
+    journal = Journal(filename)
+    journal.begin(CONTENT_FILES)
+    journal.finish(fw1, CONTENT_FILES, False)
+    journal.finish(fw2, CONTENT_FILES, True)
+    journal.close()
+    resumed = Journal(filename, resume=True)
+    assert resumed.finished(fw1, CONTENT_FILES)
+    assert not resumed.finished(fw2, CONTENT_FILES)
+    # Finished with other files is not finished
+    assert not resumed.finished(fw1, CONTENT_FILES[:1])
+
+
+def test_running_job_is_found_after_restart(tmpdir, make_device):
+    filename = str(tmpdir.join("journal.jsonl"))
+    fw = make_device("fw1")
+    journal = Journal(filename)
+    journal.begin(CONTENT_FILES)
+    journal.record(fw, "uploaded", "appthreat", "panupv2-all-contents-600-3500")
+    journal.record(fw, "started", "appthreat", "panupv2-all-contents-600-3500", "12")
+    journal.close()
+    resumed = Journal(filename, resume=True)
+    entry = resumed.entry(fw, "appthreat", "panupv2-all-contents-600-3500")
+    assert entry["phase"] == "started" and entry["jobid"] == "12"
+    assert resumed.entry(fw, "appthreat", "panupv2-all-contents-595-3465") is None
+    assert resumed.entry(fw, "antivirus", "panup-all-antivirus-2500-3000") is None
+
+
+def test_job_result_is_journaled(tmpdir, make_device):
+    fw = make_device("fw1")
+    journal = Journal(str(tmpdir.join("journal.jsonl")))
+    journal.begin(CONTENT_FILES)
+    journal.track(fw, "appthreat", "panupv2-all-contents-600-3500", Future("12"))
+    journal.track(fw, "antivirus", "panup-all-antivirus-2500-3000", Future("13", Exception("FAIL")))
+    assert journal.entry(fw, "appthreat", "panupv2-all-contents-600-3500")["phase"] == "installed"
+    assert journal.entry(fw, "antivirus", "panup-all-antivirus-2500-3000")["phase"] == "failed"
+
+
+def test_line_cut_short_by_kill_is_skipped(tmpdir, make_device):
+    filename = str(tmpdir.join("journal.jsonl"))
+    fw = make_device("fw1")
+    journal = Journal(filename)
+    journal.begin(CONTENT_FILES)
+    journal.finish(fw, CONTENT_FILES, False)
+    journal.close()
+    with open(filename, "a") as f:
+        f.write('{"device": "fw2", "pha')
+    assert Journal(filename, resume=True).finished(fw, CONTENT_FILES)
+
+
+def test_new_run_clears_journal(tmpdir, make_device):
+    filename = str(tmpdir.join("journal.jsonl"))
+    fw = make_device("fw1")
+    journal = Journal(filename)
+    journal.begin(CONTENT_FILES)
+    journal.finish(fw, CONTENT_FILES, False)
+    journal.close()
+    journal = Journal(filename)
+    journal.begin(CONTENT_FILES)
+    assert not journal.finished(fw, CONTENT_FILES)
+    journal.close()
+    assert not Journal(filename, resume=True).finished(fw, CONTENT_FILES)
+
+
+def test_resumed_journal_is_kept_for_first_rollout_only(tmpdir, make_device):
+    filename = str(tmpdir.join("journal.jsonl"))
+    fw = make_device("fw1")
+    journal = Journal(filename)
+    journal.begin(CONTENT_FILES)
+    journal.finish(fw, CONTENT_FILES, False)
+    journal.close()
+    resumed = Journal(filename, resume=True)
+    resumed.begin(CONTENT_FILES)
+    assert resumed.finished(fw, CONTENT_FILES)
+    resumed.begin(CONTENT_FILES)
+    assert not resumed.finished(fw, CONTENT_FILES)
+    resumed.close()
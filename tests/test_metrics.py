@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+from metrics import Metrics
+from metrics import Timer
+from metrics import summary
+
+
+def test_summary():
+    assert summary([]) == {"count": 0}
+    result = summary([3, 1, 2, 4])
+    assert (result["count"], result["sum"], result["min"], result["max"], result["mean"], result["p50"]) == (4, 10, 1, 4, 2.5, 3)
+
+
+def test_prometheus_histogram_and_gauges():
+    metrics = Metrics()
+    metrics.observe("upload", "1.1.1.1", 4, "fw1")
+    metrics.observe("upload", "2.2.2.2", 45, "fw2")
+    metrics.gauge("devices", "Devices by result", 3, {"result": "SUCCESS"})
+    metrics.gauge("devices", "Devices by result", 1, {"result": 'ER"ROR'})
+    metrics.finish()
+    lines = metrics.prometheus().splitlines()
+    assert "# TYPE pan_dyn_update_upload_seconds histogram" in lines
+    assert 'pan_dyn_update_upload_seconds_bucket{le="2.5"} 0' in lines
+    assert 'pan_dyn_update_upload_seconds_bucket{le="5.0"} 1' in lines
+    assert 'pan_dyn_update_upload_seconds_bucket{le="60.0"} 2' in lines
+    assert 'pan_dyn_update_upload_seconds_bucket{le="+Inf"} 2' in lines
+    assert "pan_dyn_update_upload_seconds_sum 49.0" in lines
+    assert "pan_dyn_update_upload_seconds_count 2" in lines
+    assert "pan_dyn_update_job_seconds_count 0" in lines
+    # HELP and TYPE once for each gauge name, and label values escaped
+    assert lines.count("# TYPE pan_dyn_update_devices gauge") == 1
+    assert 'pan_dyn_update_devices{result="SUCCESS"} 3.0' in lines
+    assert 'pan_dyn_update_devices{result="ER\\"ROR"} 1.0' in lines
+    assert "pan_dyn_update_last_run_timestamp_seconds %r" % (float(metrics.finished)) in lines
+
+
+def test_json_report(tmpdir):
+    metrics = Metrics()
+    metrics.observe("connect", "1.1.1.1", 0.5, "fw1")
+    metrics.write_json(str(tmpdir.join("metrics.json")))
+    metrics.write_prometheus(str(tmpdir.join("metrics.prom")))
+    report = json.loads(tmpdir.join("metrics.json").read())
+    assert report["phases"]["connect"]["count"] == 1
+    assert report["devices"]["1.1.1.1"] == {"name": "fw1", "connect": [0.5]}
+    assert sorted(path.basename for path in tmpdir.listdir()) == ["metrics.json", "metrics.prom"]
+
+
+def test_timer_records_only_blocks_that_succeed(make_device):
+    metrics = Metrics()
+    with Timer(metrics, "job", make_device("fw1")) as timer:
+        pass
+    assert timer.seconds >= 0
+    with pytest.raises(IOError):
+        with Timer(metrics, "job", make_device("fw2")):
+            raise IOError("reset")
+    assert list(metrics.devices) == ["fw1"]
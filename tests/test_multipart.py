@@ -0,0 +1,40 @@
+import pytest
+
+from multipart import MultipartError
+from multipart import MultipartFile
+
+
+def body_of(multipart):
+    # Chunks are only valid until the next one is asked for, so each is copied as it comes
+    return "".join(str(chunk) for chunk in multipart)
+
+
+@pytest.mark.parametrize("size", [0, 1, 10, 64, 100])
+def test_body_framing_and_content_length(tmpdir, size):
+    content = "".join(chr(i % 256) for i in range(size))
+    tmpdir.join("panupv2-all-contents-600-3500").write(content, mode="wb")
+    multipart = MultipartFile(str(tmpdir.join("panupv2-all-contents-600-3500")), chunksize=32)
+    body = body_of(multipart)
+    boundary = multipart.boundary
+    assert body == ('--%s\r\n'
+                    'Content-Disposition: form-data; name="file"; filename="panupv2-all-contents-600-3500"\r\n'
+                    'Content-Type: application/octet-stream\r\n'
+                    '\r\n%s\r\n--%s--\r\n' % (boundary, content, boundary))
+    assert len(body) == len(multipart) == int(multipart.headers()["Content-Length"])
+    assert multipart.headers()["Content-Type"] == "multipart/form-data; boundary=%s" % (boundary)
+    # Body can be sent again
+    assert body_of(multipart) == body
+
+
+def test_chunks_are_at_most_chunksize(tmpdir):
+    tmpdir.join("content").write("x" * 100, mode="wb")
+    chunks = [len(chunk) for chunk in MultipartFile(str(tmpdir.join("content")), chunksize=32)]
+    assert chunks[1:-1] == [32, 32, 32, 4]
+
+
+def test_changed_size_fails(tmpdir):
+    tmpdir.join("content").write("x" * 100, mode="wb")
+    multipart = MultipartFile(str(tmpdir.join("content")))
+    tmpdir.join("content").write("x" * 50, mode="wb")
+    with pytest.raises(MultipartError):
+        body_of(multipart)
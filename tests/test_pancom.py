@@ -0,0 +1,50 @@
+import subprocess
+import sys
+
+import pytest
+
+from conftest import ROOT
+from pancom import installed_version_tuple
+from pancom import is_newer
+from plan import RolloutPlan
+
+
+@pytest.mark.parametrize("file, current, newer", [
+    ("panupv2-all-contents-600-3500", "595-3465", True),
+    ("panupv2-all-contents-595-3465", "595-3465", False),
+    ("panupv2-all-contents-595-3465", "600-3500", False),
+    ("panupv2-all-contents-1000-100", "999-200", True),
+    ("panupv2-all-contents-999-200", "1000-100", False),
+    ("panupv2-all-contents-595-3466", "595-3465", True),
+    ("panupv2-all-contents-595-3465", "0", True),
+    ("panupv2-all-contents-595-3465", None, True),
+    ("panupv2-all-contents-latest", "595-3465", True),
+])
+def test_is_newer(file, current, newer):
+    assert is_newer(file, current) == newer
+
+
+def test_installed_version_tuple():
+    assert installed_version_tuple("595-3465") == (595, 3465)
+    assert installed_version_tuple(None) is None
+
+
+def test_apply_plan_without_content_files(tmpdir):
+    RolloutPlan([]).save(str(tmpdir.join("plan.json")))
+    process = subprocess.Popen([sys.executable, "%s/pan-dyn-update.py" % (ROOT), "--apply", "plan.json", "-v"], cwd=str(tmpdir),
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    assert process.returncode == 0, output
+    assert "nothing to apply" in output
+
+
+def test_plan_entries_by_hostname(tmpdir, make_device):
+    plan = RolloutPlan([("appthreat", "panupv2-all-contents-600-3500", 1000, "abc")])
+    plan.add(make_device("fw1"), [("appthreat", "panupv2-all-contents-600-3500")], {})
+    plan.add(make_device("fw2"), [], {}, "Device unreachable")
+    plan.save(str(tmpdir.join("plan.json")))
+    loaded = RolloutPlan.load(str(tmpdir.join("plan.json")))
+    assert loaded.files("fw1") == [("appthreat", "panupv2-all-contents-600-3500")]
+    assert loaded.entry("fw1")["bytes"] == 1000
+    assert loaded.entry("fw2")["error"] == "Device unreachable"
+    assert loaded.files("fw3") == []
@@ -0,0 +1,64 @@
+import threading
+
+from conftest import FakeDevice
+from results import ResultStream
+from rollout import WaveScheduler
+
+
+class Firewall(FakeDevice):
+    # Firewall already at the newest versions, or failing the version check with error
+    def __init__(self, hostname, error=None):
+        FakeDevice.__init__(self, hostname)
+        self.error = error
+        self.threads = []
+
+    def check_installed_version(self):
+        self.threads.append(threading.current_thread().name)
+        if self.error is not None: raise self.error
+
+    def needs_update(self, content_file, package):
+        return False
+
+
+class Collector(object):
+    def __init__(self):
+        self.records = {}
+
+    def emit(self, record):
+        self.records[record["hostname"]] = record
+
+    def close(self, summary):
+        pass
+
+
+CONTENT_FILES = [("appthreat", "panupv2-all-contents-600-3500")]
+
+
+def run(script, devices, rollout):
+    collector = Collector()
+    results = ResultStream([collector])
+    script.process_devices(devices, CONTENT_FILES, False, rollout, results)
+    return collector.records
+
+
+def test_failing_worker_does_not_stop_others(script):
+    devices = [Firewall("fw%s" % (number)) for number in range(8)]
+    devices[2].error = RuntimeError("unexpected")
+    devices[5].error = script.UploadError("timeout")
+    records = run(script, devices, WaveScheduler([100], [4]))
+    assert sorted(records) == sorted(device.hostname for device in devices)
+    assert "Unexpected error" in records["fw2"]["messages"][0]
+    assert records["fw5"]["messages"][0].startswith("ERROR: Timeout when checking")
+    assert [records["fw%s" % (number)]["result"] for number in (0, 1, 3, 4, 6, 7)] == ["SKIPPED"] * 6
+    # Worker threads are named after the device while it is processed
+    assert devices[0].threads == ["fw0"]
+    assert threading.current_thread().name == "MainThread"
+
+
+def test_failed_canary_aborts_other_workers(script):
+    devices = [Firewall("fw%s" % (number)) for number in range(10)]
+    devices[0].error = RuntimeError("unexpected")
+    records = run(script, devices, WaveScheduler([10, 100], [1, 4], max_failure_rate=20))
+    assert records["fw0"]["result"] == "ERROR"
+    assert [records["fw%s" % (number)]["result"] for number in range(1, 10)] == ["ABORTED"] * 9
+    assert [device.hostname for device in devices if device.threads] == ["fw0"]
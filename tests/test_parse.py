@@ -0,0 +1,109 @@
+import os
+
+import pytest
+
+from conftest import ROOT
+from parse import ParseError
+from parse import XmlReader
+
+
+def response(name):
+    with open(os.path.join(ROOT, "bench", "responses", name)) as f:
+        return XmlReader(f.read())
+
+
+def test_find_managed_devices():
+    devices = response("devices_connected.xml").find_managed_devices()
+    assert len(devices) == 40
+    assert devices[1] == {"serial": "001801000001", "hostname": "fw-branch-01", "model": "PA-200", "app_version": "595-3465",
+                          "threat_version": "595-3465", "av_version": "2453-2943", "wf_version": "118130-120972"}
+    assert response("devices_connected.xml").find_serial("entry")[:2] == ["001801000000", "vsys1"]
+
+
+def test_find_managed_device_without_versions():
+    devices = XmlReader('<response status="success"><result><devices><entry name="0018"><hostname>fw1</hostname></entry>'
+                        '</devices></result></response>').find_managed_devices()
+    assert devices == [{"serial": "0018", "hostname": "fw1", "model": None, "app_version": None, "threat_version": None,
+                        "av_version": None, "wf_version": None}]
+
+
+def test_find_content_versions_and_model():
+    reader = response("system_info.xml")
+    assert reader.find_content_versions() == ("595-3465", "595-3465", "2453-2943", "118130-120972")
+    assert reader.find_model() == "PA-200"
+
+
+def test_missing_content_version():
+    reader = XmlReader('<response status="success"><result><system><app-version>595-3465</app-version></system></result></response>')
+    with pytest.raises(ParseError):
+        reader.find_content_versions()
+    assert reader.find_model() is None
+
+
+def test_install_started():
+    reader = response("install_started.xml")
+    assert reader.find_response_status() == ("success", "Content install job enqueued with jobid 1482")
+    assert reader.find_jobid() == "1482"
+    assert reader.find_jobs() == []  # Job id only, no job details
+
+
+def test_job_active():
+    reader = response("job_active.xml")
+    assert reader.find_status() == ("ACT", "55")
+    assert reader.find_jobs() == [{"id": "1482", "status": "ACT", "progress": "55", "result": "PEND", "nextjob": None, "details": ""}]
+    with pytest.raises(ParseError):
+        reader.findnextjobid()
+
+
+def test_job_finished_with_next_job():
+    reader = response("job_fin_nextjob.xml")
+    assert reader.find_status() == ("FIN", "100")
+    assert reader.findnextjobid() == "1483"
+    job = reader.find_jobs()[0]
+    assert (job["result"], job["nextjob"]) == ("OK", "1483")
+    assert job["details"] == "Configuration committed successfully Successfully committed last configuration"
+
+
+def test_show_jobs_all():
+    jobs = response("show_jobs_all.xml").find_jobs()
+    assert len(jobs) == 60
+    assert jobs[0] == {"id": "1482", "status": "ACT", "progress": "40", "result": "PEND", "nextjob": None, "details": "Successfully completed job"}
+    assert [job["id"] for job in jobs[:3]] == ["1482", "1481", "1480"]
+
+
+def test_missing_job_elements():
+    reader = XmlReader('<response status="success"><result></result></response>')
+    for method in (reader.find_jobid, reader.findnextjobid, reader.find_status):
+        with pytest.raises(ParseError):
+            method()
+    assert reader.find_jobs() == []
+    assert reader.find_managed_devices() == []
+
+
+def test_error_response():
+    reader = XmlReader('<response status="error"><msg><line>Invalid credentials.</line></msg></response>')
+    assert reader.find_response_status() == ("error", "Invalid credentials.")
+    reader = XmlReader('<response status="error" code="17"><msg>Invalid file name</msg></response>')
+    assert reader.find_response_status() == ("error", "Invalid file name")
+
+
+def test_invalid_xml():
+    with pytest.raises(ParseError):
+        XmlReader("<html>Service unavailable")
+
+
+def test_find_downloaded_files():
+    reader = XmlReader('<response status="success"><result><content-updates>'
+                       '<entry><filename>panupv2-all-contents-600-3500</filename><downloaded>yes</downloaded></entry>'
+                       '<entry><filename>panupv2-all-contents-601-3501</filename><downloaded>no</downloaded></entry>'
+                       '</content-updates></result></response>')
+    assert reader.find_downloaded_files() == ["panupv2-all-contents-600-3500"]
+
+
+def test_find_ha_state():
+    assert XmlReader('<response status="success"><result><enabled>no</enabled></result></response>').find_ha_state() is None
+    reader = XmlReader('<response status="success"><result><enabled>yes</enabled><group><local-info><state>Active</state>'
+                       '</local-info></group></result></response>')
+    assert reader.find_ha_state() == "active"
+    with pytest.raises(ParseError):
+        XmlReader('<response status="success"><result><enabled>yes</enabled></result></response>').find_ha_state()
@@ -0,0 +1,163 @@
+import socket
+import time
+
+from connection import ApiError
+from probe import CircuitBreaker
+from probe import Prober
+from probe import address
+
+
+class Pool(object):
+    def __init__(self, error=None):
+        self.error = error
+        self.requests = []
+
+    def request(self, hostname, method, url, body, headers, timeout):
+        self.requests.append(hostname)
+        if self.error is not None: raise ApiError(self.error)
+        return 200, '<response status="success"/>'
+
+
+def listening_socket():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(5)
+    return sock
+
+
+def device(make_device, hostname, pool):
+    fw = make_device(hostname)
+    fw.pool = pool
+    fw.apikey = "key"
+    return fw
+
+
+def test_address_with_and_without_port():
+    assert address("10.0.0.1") == ("10.0.0.1", 443)
+    assert address("10.0.0.1:8443") == ("10.0.0.1", 8443)
+
+
+def test_breaker_opens_after_threshold_and_backs_off_doubling(tmpdir):
+    breaker = CircuitBreaker(str(tmpdir.join("breaker.json")), threshold=2, backoff=100, max_backoff=300)
+    breaker.failure("fw1", "refused")
+    assert breaker.allow("fw1")
+    now = time.time()
+    breaker.failure("fw1", "refused")
+    assert not breaker.allow("fw1")
+    assert 99 <= breaker.state("fw1")["open_until"] - now <= 101
+    breaker.failure("fw1", "refused")
+    assert 199 <= breaker.state("fw1")["open_until"] - now <= 201
+    breaker.failure("fw1", "refused")
+    assert breaker.state("fw1")["open_until"] - now <= 301
+    breaker.success("fw1")
+    assert breaker.allow("fw1") and breaker.state("fw1") is None
+
+
+def test_breaker_state_is_kept_between_runs(tmpdir):
+    filename = str(tmpdir.join("breaker.json"))
+    breaker = CircuitBreaker(filename, threshold=1, backoff=100)
+    breaker.failure("fw1", "refused")
+    breaker.save()
+    assert not CircuitBreaker(filename).allow("fw1")
+    tmpdir.join("breaker.json").write("not json")
+    assert CircuitBreaker(filename).allow("fw1")
+
+
+def test_probe_finds_unreachable_devices(tmpdir, make_device):
+    sock = listening_socket()
+    closed = listening_socket()
+    closed_port = closed.getsockname()[1]
+    closed.close()
+    try:
+        alive = device(make_device, "127.0.0.1:%s" % (sock.getsockname()[1]), Pool())
+        refused = device(make_device, "127.0.0.1:%s" % (closed_port), Pool())
+        breaker = CircuitBreaker(str(tmpdir.join("breaker.json")), threshold=1)
+        unreachable = Prober(breaker, timeout=1).probe([alive, refused])
+        assert list(unreachable) == [refused.hostname]
+        assert "TCP connect" in unreachable[refused.hostname]
+        assert alive.pool.requests == [alive.hostname]
+        # Backed off host is reported without being probed again
+        unreachable = Prober(breaker, timeout=1).probe([refused])
+        assert "Backed off" in unreachable[refused.hostname]
+    finally:
+        sock.close()
+
+
+def test_probe_reports_device_without_api_answer(make_device):
+    sock = listening_socket()
+    try:
+        silent = device(make_device, "127.0.0.1:%s" % (sock.getsockname()[1]), Pool("timed out"))
+        unreachable = Prober(None, timeout=1).probe([silent])
+        assert "No API answer" in unreachable[silent.hostname]
+    finally:
+        sock.close()
+
+
+def test_probe_of_no_devices_does_nothing():
+    assert Prober(None).probe([]) == {}
+
+
+class Inventory(object):
+    # Cached versions: devices in uptodate need nothing
+    def __init__(self, uptodate):
+        self.uptodate = uptodate
+
+    def load(self, device):
+        device.cached = device.hostname in self.uptodate
+        return True
+
+
+class Plan(object):
+    def __init__(self, files):
+        self.planned = files
+
+    def files(self, hostname):
+        return self.planned.get(hostname, [])
+
+
+class RecordingProber(object):
+    def __init__(self, unreachable):
+        self.unreachable = unreachable
+        self.probed = []
+        self.breaker = None
+
+    def probe(self, device_list):
+        self.probed.extend(device.hostname for device in device_list)
+        return dict((device.hostname, self.unreachable[device.hostname]) for device in device_list if device.hostname in self.unreachable)
+
+
+class Results(object):
+    def __init__(self):
+        self.devices = {}
+
+    def emit(self, device, statuslist):
+        self.devices[device.hostname] = statuslist
+
+
+def test_rollout_only_probes_devices_needing_work(script, make_device):
+    from rollout import WaveScheduler
+    files = [("appthreat", "panupv2-all-contents-600-3500")]
+    devices = [make_device(hostname) for hostname in ("cached", "unplanned", "down")]
+    for fw in devices: fw.needs_update = lambda content_file, package, fw=fw: not fw.cached
+    prober = RecordingProber({"down": "refused"})
+    results = Results()
+    script.process_devices(devices, files, False, WaveScheduler(), results, Inventory(["cached", "unplanned"]),
+                           plan=Plan({"cached": files, "down": files}), prober=prober)
+    assert prober.probed == ["down"]
+    assert "Device unreachable: refused" in results.devices["down"][0]
+    assert "No content files planned" in results.devices["unplanned"][0]
+
+
+def test_waves_stopped_before_start_are_not_probed(script, make_device):
+    from rollout import WaveScheduler
+    files = [("appthreat", "panupv2-all-contents-600-3500")]
+    devices = [make_device("fw%s" % (i)) for i in range(4)]
+    for fw in devices:
+        fw.cached = False
+        fw.needs_update = lambda content_file, package: True
+    # Every device fails (fake devices can't be updated), so rollout stops after first wave
+    prober = RecordingProber({})
+    results = Results()
+    script.process_devices(devices, files, False, WaveScheduler([25, 100], [1], 0), results, Inventory([]), prober=prober)
+    assert prober.probed == ["fw0"]
+    assert results.devices["fw3"][0].startswith("ABORTED")
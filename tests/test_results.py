@@ -0,0 +1,85 @@
+import json
+
+from results import EmailSink
+from results import FileSink
+from results import ResultStream
+from results import Summary
+from results import device_result
+
+CONTENT_FILES = [("appthreat", "panupv2-all-contents-600-3500")]
+
+
+class Email(object):
+    def __init__(self):
+        self.content = None
+        self.sent = 0
+
+    def send_email(self):
+        self.sent += 1
+
+
+class FailingSink(object):
+    def emit(self, record):
+        raise IOError("disk full")
+
+    def close(self, summary):
+        raise IOError("disk full")
+
+
+def test_device_result_is_worst_status():
+    assert device_result(["SUCCESS: upload", "ERROR: install"]) == "ERROR"
+    assert device_result(["SKIPPED: upload", "SUCCESS: upload"]) == "SUCCESS"
+    assert device_result(["SKIPPED: upload"]) == "SKIPPED"
+    assert device_result(["Timeout when checking"]) == "UNKNOWN"
+
+
+def test_file_sink_appends_one_json_line_per_device(tmpdir, make_device):
+    filename = str(tmpdir.join("results.jsonl"))
+    for run in range(2):
+        stream = ResultStream([FileSink(filename)], CONTENT_FILES)
+        stream.emit(make_device("fw1"), ["SUCCESS: Upload of file to fw1"])
+        stream.emit(make_device("fw2"), ["SUCCESS: Upload of file to fw2", "ERROR: Install failed on fw2"])
+        stream.close()
+    records = [json.loads(line) for line in tmpdir.join("results.jsonl").readlines()]
+    assert [record["hostname"] for record in records] == ["fw1", "fw2", "fw1", "fw2"]
+    assert records[1]["result"] == "ERROR" and records[1]["failed"]
+    assert records[1]["messages"] == ["SUCCESS: Upload of file to fw2", "ERROR: Install failed on fw2"]
+    assert records[0]["content_files"] == dict(CONTENT_FILES)
+
+
+def test_email_has_all_status_messages(make_device):
+    email = Email()
+    stream = ResultStream([EmailSink(email)])
+    stream.emit(make_device("fw1"), ["SUCCESS: Upload of file to fw1", "SUCCESS: Installation on fw1"])
+    stream.emit(make_device("fw2"), ["SKIPPED: Upload of file to fw2"])
+    stream.close()
+    assert email.sent == 1
+    assert email.content == "\nSUCCESS: Upload of file to fw1\nSUCCESS: Installation on fw1\nSKIPPED: Upload of file to fw2"
+
+
+def test_email_digest_has_counts_and_failures(make_device):
+    email = Email()
+    stream = ResultStream([EmailSink(email, digest=True)])
+    stream.emit(make_device("fw1"), ["SUCCESS: Upload of file to fw1"])
+    stream.emit(make_device("fw2"), ["ERROR: Install failed on fw2"])
+    stream.close()
+    assert email.content == "2 devices: ERROR 1, SUCCESS 1\n\nFailures:\nERROR: Install failed on fw2"
+
+
+def test_summary_keeps_first_failures_only():
+    summary = Summary(max_failures=2)
+    for i in range(5): summary.add({"result": "ERROR", "messages": ["ERROR: failed %s" % (i)]})
+    assert summary.failures == ["ERROR: failed 0", "ERROR: failed 1"]
+    assert summary.omitted == 3
+    assert "3 more failure messages" in summary.text()
+    assert summary.counts() == "5 devices: ERROR 5"
+    assert Summary().counts() == "0 devices: none processed"
+
+
+def test_failing_sink_does_not_stop_others(make_device):
+    email = Email()
+    stream = ResultStream([FailingSink(), EmailSink(email)])
+    stream.emit(make_device("fw1"), ["SUCCESS: Upload of file to fw1"])
+    stream.close()
+    assert email.content == "\nSUCCESS: Upload of file to fw1"
+    assert stream.summary.devices == 1
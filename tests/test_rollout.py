@@ -0,0 +1,64 @@
+import pytest
+
+from rollout import RolloutError
+from rollout import WaveScheduler
+from rollout import ha_groups
+from rollout import ha_order
+
+
+def test_waves_grow_and_cover_all_units():
+    scheduler = WaveScheduler([1, 10, 100])
+    waves = scheduler.split(range(50))
+    assert [len(wave) for wave in waves] == [1, 4, 45]
+    assert sum(waves, []) == range(50)
+    # Each wave has at least one unit, and empty waves are dropped
+    assert WaveScheduler([1, 2, 100]).split(range(2)) == [[0], [1]]
+
+
+@pytest.mark.parametrize("waves, concurrency", [([50], [1]), ([50, 10, 100], [1]), ([100], [0]), ([], [1])])
+def test_invalid_waves(waves, concurrency):
+    with pytest.raises(RolloutError):
+        WaveScheduler(waves, concurrency)
+
+
+def test_rollout_stops_when_failure_rate_is_passed():
+    scheduler = WaveScheduler([10, 100], [1, 4], max_failure_rate=20)
+    results = scheduler.run(range(20), lambda unit: "failed" if unit == 0 else "ok", lambda result: result == "failed", lambda unit: "aborted")
+    # Failed canary stops the rollout, and the rest of its wave and later waves are not processed
+    assert results == ["failed"] + ["aborted"] * 19
+    assert scheduler.aborted
+
+
+def test_failures_below_min_failures_do_not_stop_rollout():
+    scheduler = WaveScheduler([10, 100], [1], max_failure_rate=20, min_failures=3)
+    results = scheduler.run(range(20), lambda unit: "failed" if unit < 2 else "ok", lambda result: result == "failed", lambda unit: "aborted")
+    assert "aborted" not in results
+
+
+def test_rollout_without_failures_processes_all_in_order():
+    scheduler = WaveScheduler([10, 50, 100], [1, 3], max_failure_rate=0)
+    assert scheduler.run(range(30), lambda unit: unit * 2, lambda result: False, lambda unit: None) == [unit * 2 for unit in range(30)]
+
+
+class HaDevice(object):
+    def __init__(self, hostname, group=None, state=None):
+        self.hostname = hostname
+        self.name = hostname
+        self.options = {}
+        if group: self.options["ha"] = group
+        self.state = state
+
+    def ha_state(self):
+        if isinstance(self.state, Exception): raise self.state
+        return self.state
+
+
+def test_ha_peers_are_one_unit_where_first_peer_is_listed():
+    fw1, fw2, fw3, fw4 = HaDevice("fw1", "a"), HaDevice("fw2"), HaDevice("fw3", "a"), HaDevice("fw4", "b")
+    assert ha_groups([fw1, fw2, fw3, fw4]) == [[fw1, fw3], [fw2], [fw4]]
+
+
+def test_passive_peer_first_and_unreadable_peer_before_active():
+    active, passive, down = HaDevice("fw1", "a", "active"), HaDevice("fw2", "a", "passive"), HaDevice("fw3", "a", StandardError("timeout"))
+    assert ha_order([active, passive]) == [passive, active]
+    assert ha_order([active, down]) == [down, active]
@@ -0,0 +1,125 @@
+import time
+
+import pytest
+
+from shard import LeaseStore
+from shard import ShardRunner
+from shard import ShardError
+from shard import assign_shards
+from shard import rollout_id
+
+FILES = [("appthreat", "panupv2-all-contents-600-3500")]
+
+
+def store(tmpdir, owner, ttl=60):
+    return LeaseStore(str(tmpdir.join("shards.sqlite")), rollout_id(FILES), owner, ttl)
+
+
+def test_assign_shards_by_hash_is_stable(make_device):
+    devices = [make_device("10.0.0.%s" % (i)) for i in range(20)]
+    first = assign_shards(devices, 3)
+    assert first == assign_shards(list(reversed(devices)), 3)
+    assert set(first.values()) <= set([0, 1, 2])
+
+
+def test_ha_peers_are_in_one_shard(make_device):
+    devices = [make_device("10.0.0.%s" % (i), options={"ha": "pair%s" % (i // 2)}) for i in range(20)]
+    for by in ("hash", "site"):
+        assignment = assign_shards(devices, 4, by)
+        for a, b in zip(devices[0::2], devices[1::2]): assert assignment[a.hostname] == assignment[b.hostname]
+
+
+def test_assign_shards_by_site_balances_sites(make_device):
+    devices = [make_device("a%s" % (i), options={"site": "a"}) for i in range(4)]
+    devices += [make_device("b%s" % (i), options={"site": "b"}) for i in range(2)]
+    devices += [make_device("c%s" % (i), options={"site": "c"}) for i in range(2)]
+    assignment = assign_shards(devices, 2, "site")
+    assert len(set(assignment["a%s" % (i)] for i in range(4))) == 1
+    assert assignment["b0"] == assignment["c0"] != assignment["a0"]
+
+
+def test_unsupported_shard_key(make_device):
+    with pytest.raises(ShardError):
+        assign_shards([make_device("a")], 2, "model")
+
+
+def test_lease_is_held_until_it_expires(tmpdir):
+    first, second = store(tmpdir, "one", ttl=60), store(tmpdir, "two", ttl=60)
+    first.register(0)
+    second.register(1)
+    assert first.acquire("fw1", 0) == "acquired"
+    assert second.acquire("fw1", 0) == "leased"
+    first.db.execute("UPDATE leases SET expires=?", (time.time() - 1,))
+    assert second.acquire("fw1", 0) == "acquired"
+    first.complete("fw1", ["SUCCESS: Upload"])
+    assert second.results() == {"fw1": ["SUCCESS: Upload"]}
+    assert second.acquire("fw1", 0) == "done"
+
+
+def test_runners_started_together_share_round(tmpdir):
+    first, second = store(tmpdir, "one"), store(tmpdir, "two")
+    assert first.register(0) == second.register(1) == 1
+    assert first.claim_report()
+    assert not second.claim_report()
+
+
+def test_failed_device_is_done_for_round_only(tmpdir):
+    first = store(tmpdir, "one")
+    first.register(0)
+    first.acquire("fw1", 0)
+    first.complete("fw1", ["ERROR: Upload failed"], succeeded=False)
+    assert first.pending(["fw1"]) == []
+    assert first.acquire("fw1", 0) == "done"
+    first.claim_report()
+    later = store(tmpdir, "later")
+    assert later.register(0) == 2
+    assert later.pending(["fw1"]) == ["fw1"]
+    assert later.acquire("fw1", 0) == "acquired"
+
+
+def run_shard(tmpdir, owner, devices, results):
+    # One sharded run with a single shard. results maps hostname to status messages of this run.
+    processed = []
+    runner = ShardRunner(store(tmpdir, owner), 0, 1, assign_shards(devices, 1), poll=0.01)
+    def process(leased):
+        for device in leased:
+            processed.append(device.hostname)
+            runner.complete(device, results[device.hostname])
+    runner.run(devices, process)
+    merged = dict((device.hostname, statuslist) for device, statuslist in runner.merged_results(devices))
+    runner.store.close()
+    return runner, processed, merged
+
+
+def test_rerun_retries_failed_devices_and_reports(tmpdir, make_device):
+    devices = [make_device("fw1"), make_device("fw2"), make_device("fw3"), make_device("fw4")]
+    runner, processed, merged = run_shard(tmpdir, "first", devices, {
+        "fw1": ["SUCCESS: Installation of file to fw1"],
+        "fw2": ["ERROR: Error while uploading file to fw2"],
+        "fw3": ["UNKNOWN: Installation of file to fw3 returned unknown status"],
+        "fw4": ["SKIPPED: Upload of file to fw4. Current version is the same or newer"]})
+    assert runner.merged
+    assert sorted(processed) == ["fw1", "fw2", "fw3", "fw4"]
+    assert sorted(merged) == ["fw1", "fw2", "fw3", "fw4"]
+    # Same content files again: only failed devices are processed, and the run reports them. Skipped devices are done.
+    runner, processed, merged = run_shard(tmpdir, "second", devices, {
+        "fw2": ["SUCCESS: Installation of file to fw2"],
+        "fw3": ["SUCCESS: Installation of file to fw3"]})
+    assert runner.merged
+    assert sorted(processed) == ["fw2", "fw3"]
+    assert merged == {"fw2": ["SUCCESS: Installation of file to fw2"], "fw3": ["SUCCESS: Installation of file to fw3"]}
+    # Nothing left to do
+    runner, processed, merged = run_shard(tmpdir, "third", devices, {})
+    assert runner.merged
+    assert processed == [] and merged == {}
+
+
+def test_store_from_older_version_is_refused(tmpdir):
+    import sqlite3
+    filename = str(tmpdir.join("shards.sqlite"))
+    db = sqlite3.connect(filename)
+    db.execute("CREATE TABLE leases (rollout TEXT, device TEXT, shard INTEGER, owner TEXT, state TEXT, expires REAL, result TEXT, PRIMARY KEY (rollout, device))")
+    db.commit()
+    db.close()
+    with pytest.raises(ShardError):
+        LeaseStore(filename, rollout_id(FILES), "one")
@@ -0,0 +1,82 @@
+from history import History
+from timeouts import MIN_API_TIMEOUT
+from timeouts import TimeoutPolicy
+from timeouts import install_key
+
+
+class Device(object):
+    def __init__(self, hostname, model=None, options=None):
+        self.hostname = hostname
+        self.model = model
+        self.options = options or {}
+
+
+def policy(tmpdir, model_timeouts=None):
+    return TimeoutPolicy(History(str(tmpdir.join("history.json"))), 300, model_timeouts)
+
+
+def test_defaults_without_history(tmpdir):
+    timeouts = policy(tmpdir)
+    fw = Device("fw1")
+    assert timeouts.api_timeout(fw) == 300
+    assert timeouts.upload_timeout(fw, 10 ** 8) == 300
+    assert timeouts.job_timeout(fw, "appthreat") == 300
+    assert timeouts.poll_interval(fw, "appthreat") is None
+
+
+def test_install_samples_are_kept_per_content_type(tmpdir):
+    timeouts = policy(tmpdir)
+    fw = Device("fw1")
+    for seconds in (600, 700, 800): timeouts.record(fw, install_key("antivirus"), seconds)
+    for seconds in (20, 30, 40): timeouts.record(fw, install_key("wildfire"), seconds)
+    assert timeouts.job_timeout(fw, "antivirus") == 2400
+    assert timeouts.job_timeout(fw, "wildfire") == 120
+    assert timeouts.job_timeout(fw, "appthreat") == 300
+    assert timeouts.poll_interval(fw, "antivirus") == 30
+    assert timeouts.poll_interval(fw, "wildfire") == 3.0
+
+
+def test_model_samples_used_for_device_without_history(tmpdir):
+    timeouts = policy(tmpdir)
+    for seconds in (600, 700, 800): timeouts.record(Device("fw1", "PA-220"), install_key("antivirus"), seconds)
+    assert timeouts.job_timeout(Device("fw2", "PA-220"), "antivirus") == 2400
+    assert timeouts.job_timeout(Device("fw3", "PA-5220"), "antivirus") == 300
+
+
+def test_upload_timeout_from_slowest_throughput_not_api_calls(tmpdir):
+    timeouts = policy(tmpdir)
+    fw = Device("fw1")
+    for seconds in (0.1, 0.1, 0.1): timeouts.record(fw, "system_info", seconds)
+    for throughput in (100000, 1000000, 1000000): timeouts.record(fw, "throughput", throughput)
+    assert timeouts.api_timeout(fw) == MIN_API_TIMEOUT
+    assert timeouts.upload_timeout(fw, 10 ** 7) == 300
+    assert timeouts.upload_timeout(fw, 10 ** 5) == MIN_API_TIMEOUT
+
+
+def test_overrides_win_over_history(tmpdir):
+    timeouts = policy(tmpdir, {"PA-220": 900})
+    fw = Device("fw1", "PA-220")
+    for seconds in (600, 700, 800): timeouts.record(fw, install_key("antivirus"), seconds)
+    assert timeouts.job_timeout(fw, "antivirus") == 900
+    assert timeouts.upload_timeout(fw, 10 ** 9) == 900
+    assert timeouts.job_timeout(Device("fw2", "PA-220", {"timeout": "60"}), "antivirus") == 60
+
+
+def test_expected_uses_install_time_of_each_content_type(tmpdir):
+    timeouts = policy(tmpdir)
+    fw = Device("fw1")
+    for key, value in (("system_info", 1), ("throughput", 1000000), (install_key("antivirus"), 600), (install_key("wildfire"), 30)):
+        for i in range(3): timeouts.record(fw, key, value)
+    files = [("antivirus", 2000000), ("wildfire", 1000000)]
+    assert timeouts.expected(fw, files, True) == 1 + 3 + 600 + 30
+    assert timeouts.expected(fw, files, False) == 1 + 3 + 600
+
+
+class FailingCache(object):
+    def save(self):
+        raise IOError(28, "No space left on device")
+
+
+def test_failed_history_write_is_logged_and_run_goes_on(script, caplog):
+    script.save_cache(FailingCache(), "history.json", "history")
+    assert "Unable to write history history.json" in caplog.text
@@ -0,0 +1,84 @@
+import time
+
+import pytest
+
+from history import History
+from uploadsched import TokenBucket
+from uploadsched import UploadScheduleError
+from uploadsched import UploadScheduler
+from uploadsched import parse_rate
+
+
+def test_parse_rate():
+    assert parse_rate("1000") == 1000
+    assert parse_rate("512k") == 512 * 1024
+    assert parse_rate("1.5M") == int(1.5 * 1024 ** 2)
+    with pytest.raises(UploadScheduleError):
+        parse_rate("fast")
+
+
+def test_token_bucket_limits_rate_after_burst():
+    bucket = TokenBucket(100000)
+    start = time.time()
+    bucket.consume(100000)  # Burst of one second is free
+    assert time.time() - start < 0.1
+    bucket.consume(20000)
+    assert time.time() - start >= 0.18
+
+
+def test_throttled_body_uses_device_bandwidth(make_device):
+    scheduler = UploadScheduler()
+    fw = make_device("fw1", options={"bandwidth": "100k"})
+    body = scheduler.throttle(fw, ["x" * 102400, "x" * 20480], None)
+    start = time.time()
+    assert "".join(body) == "x" * 122880
+    assert time.time() - start >= 0.18
+    assert scheduler.throttle(make_device("fw2"), ["x"], None) == ["x"]
+
+
+def test_passed_deadline_stops_upload(make_device):
+    body = UploadScheduler().throttle(make_device("fw1"), ["x", "x"], time.time() - 1)
+    with pytest.raises(UploadScheduleError):
+        list(body)
+
+
+def test_upload_is_retried_and_throughput_recorded(tmpdir, make_device):
+    history = History(str(tmpdir.join("history.json")))
+    scheduler = UploadScheduler(history, retries=2, backoff=0.01)
+    fw = make_device("fw1")
+    fw.model = "PA-220"
+    attempts = []
+    def upload(deadline):
+        attempts.append(deadline)
+        if len(attempts) < 3: raise IOError("reset")
+    scheduler.run(fw, upload, 1000)
+    assert len(attempts) == 3
+    assert len(history.samples("fw1", "throughput")) == 1
+
+
+def test_upload_fails_after_retries(make_device):
+    scheduler = UploadScheduler(retries=1, backoff=0.01)
+    def upload(deadline):
+        raise IOError("reset")
+    with pytest.raises(UploadScheduleError):
+        scheduler.run(make_device("fw1"), upload, 1000)
+
+
+def test_no_retry_when_whole_file_cannot_be_sent_before_deadline(tmpdir, make_device):
+    history = History(str(tmpdir.join("history.json")))
+    history.record("fw1", "throughput", 1000)
+    scheduler = UploadScheduler(history, retries=3, backoff=0.01, deadline=60)
+    attempts = []
+    def upload(deadline):
+        attempts.append(deadline)
+        raise IOError("reset")
+    with pytest.raises(UploadScheduleError):
+        scheduler.run(make_device("fw1"), upload, 100000)  # 100 seconds at measured throughput
+    assert len(attempts) == 1
+
+
+def test_slowest_devices_first(tmpdir, make_device):
+    history = History(str(tmpdir.join("history.json")))
+    for hostname, throughput in (("fast", 1000000), ("slow", 1000)): history.record(hostname, "throughput", throughput)
+    devices = [make_device(hostname) for hostname in ("fast", "slow", "new")]
+    assert [device.hostname for device in UploadScheduler(history).order(devices)] == ["new", "slow", "fast"]
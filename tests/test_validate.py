@@ -0,0 +1,71 @@
+import os
+import tarfile
+import time
+
+import pytest
+
+from validate import ContentValidator
+from validate import ValidationError
+
+NAME = "panupv2-all-contents-600-3500"
+
+
+def content_file(folder, name=NAME, size=4096):
+    datafile = folder.join("content.bin")
+    datafile.write(os.urandom(size), mode="wb")
+    with tarfile.open(str(folder.join(name)), "w:gz") as archive:
+        archive.add(str(datafile), arcname="content.bin")
+    datafile.remove()
+    return folder.join(name)
+
+
+@pytest.fixture
+def folder(tmpdir):
+    return tmpdir.mkdir("panupv2-all-contents")
+
+
+def test_valid_file_is_cached(tmpdir, folder):
+    content_file(folder)
+    validator = ContentValidator(str(tmpdir.join("validation.json")))
+    validator.validate(str(folder), NAME, "digest")
+    folder.join(NAME).remove()
+    validator.validate(str(folder), NAME, "digest")
+
+
+def test_name_is_always_checked(tmpdir, folder):
+    content_file(folder, "other-600-3500")
+    validator = ContentValidator(str(tmpdir.join("validation.json")))
+    with pytest.raises(ValidationError):
+        validator.validate(str(folder), "other-600-3500", "digest")
+
+
+def test_truncated_and_small_files_fail(tmpdir, folder):
+    data = content_file(folder).read(mode="rb")
+    folder.join(NAME).write(data[:len(data) // 2], mode="wb")
+    validator = ContentValidator(str(tmpdir.join("validation.json")), settle=0)
+    with pytest.raises(ValidationError):
+        validator.validate(str(folder), NAME, "truncated")
+    with pytest.raises(ValidationError):
+        validator.validate(str(folder), NAME, "truncated", [len(data) * 4])
+
+
+def test_failure_of_settled_file_is_cached(tmpdir, folder):
+    filepath = folder.join(NAME)
+    filepath.write("not an archive" * 100, mode="wb")
+    validator = ContentValidator(str(tmpdir.join("validation.json")), settle=10)
+    old = time.time() - 60
+    os.utime(str(filepath), (old, old))
+    with pytest.raises(ValidationError):
+        validator.validate(str(folder), NAME, "digest")
+    content_file(folder)
+    with pytest.raises(ValidationError):
+        validator.validate(str(folder), NAME, "digest")
+
+
+def test_failure_of_file_still_being_written_is_not_cached(tmpdir, folder):
+    folder.join(NAME).write("not an archive" * 100, mode="wb")
+    validator = ContentValidator(str(tmpdir.join("validation.json")), settle=10)
+    with pytest.raises(ValidationError):
+        validator.validate(str(folder), NAME, "digest")
+    content_file(folder)
+    validator.validate(str(folder), NAME, "digest")
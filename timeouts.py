@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+#Copyright (c) 2016 Data Equipment AS
+#Author: Tor Mogstad <torm _AT_ dataequipment.no>
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+
+""" Module for adaptive timeouts and rollout ETA
+
+TimeoutPolicy - API timeout, upload timeout, install job deadline and job poll
+interval for each device. Learned from durations recorded in history for the
+device, or for its model when the device has too few samples, with fixed
+overrides per device and per model from devices.conf. Install durations are kept
+per content type, as an antivirus install takes much longer than a wildfire one.
+Progress - tracks devices started and finished in a rollout, and reports an ETA
+for the whole fleet from expected durations, corrected by how long devices in
+this run have actually taken.
+"""
+from history import percentile
+import logging
+import threading
+import time
+
+
+FACTOR = 3  # Timeout is this many times the slowest normal (90th percentile) duration
+MIN_SAMPLES = 3  # Samples needed before learned durations are used
+MIN_API_TIMEOUT = 30
+MIN_JOB_TIMEOUT = 120
+MAX_TIMEOUT = 3600
+POLL_MIN = 2
+POLL_MAX = 30
+POLL_STEPS = 10  # Poll interval is expected job duration divided by this
+# Expected durations used for ETA when nothing is recorded
+DEFAULT_SYSTEM_INFO = 2
+DEFAULT_THROUGHPUT = 1000000
+DEFAULT_INSTALL = 120
+ETA_INTERVAL = 30  # Seconds between progress reports
+
+
+def _clamp(value, lowest, highest):
+    return max(lowest, min(highest, value))
+
+
+def install_key(package):
+    # History key for install job durations of content type
+    return "install:%s" % (package)
+
+
+class TimeoutPolicy(object):
+    def __init__(self, history, default, model_timeouts=None, factor=FACTOR, min_samples=MIN_SAMPLES):
+        # default - timeout used when no override or history is found (API_TIMEOUT)
+        # model_timeouts - dict of model and fixed timeout in seconds
+        self.history = history
+        self.default = default
+        self.model_timeouts = model_timeouts or {}
+        self.factor = factor
+        self.min_samples = min_samples
+
+
+    def record(self, device, key, value):
+        # Record duration for device and its model
+        if self.history is not None: self.history.record(device.hostname, key, value, device.model)
+
+
+    def samples(self, device, key):
+        # Samples for device, or for its model if device has too few
+        if self.history is None: return []
+        samples = self.history.samples(device.hostname, key)
+        if len(samples) < self.min_samples and device.model is not None: samples = self.history.model_samples(device.model, key)
+        if len(samples) < self.min_samples: return []
+        return samples
+
+
+    def override(self, device):
+        # Fixed timeout from devices.conf - timeout= on device line, or model-timeout= setting
+        if "timeout" in device.options: return int(device.options["timeout"])
+        if device.model in self.model_timeouts: return self.model_timeouts[device.model]
+        return None
+
+
+    def api_timeout(self, device):
+        # Timeout for each API call
+        fixed = self.override(device)
+        if fixed is not None: return fixed
+        slowest = percentile(self.samples(device, "system_info"), 0.9)
+        if slowest is None: return self.default
+        return _clamp(slowest * self.factor, MIN_API_TIMEOUT, MAX_TIMEOUT)
+
+
+    def upload_timeout(self, device, size):
+        # Timeout for socket operations during upload of size bytes. Device only answers when the whole file is
+        # received, so this is learned from the slowest normal upload throughput, not from API call durations.
+        fixed = self.override(device)
+        if fixed is not None: return fixed
+        slowest = percentile(self.samples(device, "throughput"), 0.1)
+        if not slowest: return self.default
+        return _clamp(size / float(slowest) * self.factor, MIN_API_TIMEOUT, MAX_TIMEOUT)
+
+
+    def job_timeout(self, device, package):
+        # Max seconds to wait for an install job (and any next job) of content type to complete
+        fixed = self.override(device)
+        if fixed is not None: return fixed
+        slowest = percentile(self.samples(device, install_key(package)), 0.9)
+        if slowest is None: return self.default
+        return _clamp(slowest * self.factor, MIN_JOB_TIMEOUT, MAX_TIMEOUT)
+
+
+    def poll_interval(self, device, package):
+        # Seconds between polls of an install job of content type, or None to use job tracker default
+        expected = percentile(self.samples(device, install_key(package)), 0.5)
+        if expected is None: return None
+        return _clamp(float(expected) / POLL_STEPS, POLL_MIN, POLL_MAX)
+
+
+    def expected(self, device, files, wait):
+        # Expected seconds to check, upload and install files on device. files is list of (package, size in bytes)
+        system_info = percentile(self.samples(device, "system_info"), 0.5) or DEFAULT_SYSTEM_INFO
+        throughput = percentile(self.samples(device, "throughput"), 0.5) or DEFAULT_THROUGHPUT
+        installs = [percentile(self.samples(device, install_key(package)), 0.5) or DEFAULT_INSTALL for package, size in files]
+        # Last install job is not waited for without -w
+        if not wait: installs = installs[:-1]
+        return system_info + sum(size for package, size in files) / float(throughput) + sum(installs)
+
+
+class Progress(object):
+    def __init__(self, devices, estimate, workers, verbose=False, interval=ETA_INTERVAL):
+        # estimate - function returning expected seconds for a device. workers - devices processed at the same time
+        self.estimates = dict((id(device), estimate(device)) for device in devices)
+        self.total = len(devices)
+        self.workers = max(workers, 1)
+        self.verbose = verbose
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.running = {}  # id(device) -> start time
+        self.done = set()
+        self.actual = 0.0  # Seconds used by finished devices
+        self.expected_done = 0.0  # Estimates for finished devices
+        self.stopped = threading.Event()
+        self.thread = None
+
+
+    def started(self, device):
+        with self.lock: self.running[id(device)] = time.time()
+
+
+    def finished(self, device):
+        with self.lock:
+            start = self.running.pop(id(device), None)
+            self.done.add(id(device))
+            if start is not None:
+                self.actual += time.time() - start
+                self.expected_done += self.estimates.get(id(device), 0)
+
+
+    def eta(self):
+        # Seconds until all devices are done. Estimates are scaled by actual/expected time of finished devices.
+        with self.lock:
+            scale = 1.0
+            if self.expected_done > 0: scale = self.actual / self.expected_done
+            now = time.time()
+            remaining = 0.0
+            for key, estimate in self.estimates.items():
+                if key in self.done: continue
+                if key in self.running: remaining += max(estimate * scale - (now - self.running[key]), 0)
+                else: remaining += estimate * scale
+            return remaining / self.workers
+
+
+    def report(self):
+        with self.lock:
+            done, running = len(self.done), len(self.running)
+        eta = int(self.eta())
+        message = "Progress: %s of %s devices done, %s running. ETA %02d:%02d:%02d" % (done, self.total, running, eta // 3600, eta % 3600 // 60, eta % 60)
+        logging.info(message)
+        if self.verbose: print message
+
+
+    def start(self):
+        # Reports progress every interval seconds until stop()
+        def run():
+            while not self.stopped.wait(self.interval): self.report()
+        self.thread = threading.Thread(target=run, name="Progress")
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None: self.thread.join()
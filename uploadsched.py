@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+#Copyright (c) 2016 Data Equipment AS
+#Author: Tor Mogstad <torm _AT_ dataequipment.no>
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+""" Module for scheduling content uploads
+
+UploadScheduler - limits upload bandwidth globally, per site and per device with
+token buckets, retries failed uploads with backoff until a deadline, and records
+measured throughput per device. Throughput from earlier runs decides the order
+devices are handled in, and how many uploads run at the same time.
+"""
+import re
+import time
+import logging
+import threading
+
+
+RETRIES = 3  # Retries after first failed attempt
+BACKOFF = 10  # Seconds before first retry. Doubled for each retry
+DEADLINE = 3600  # Max seconds from first attempt until upload must be complete
+
+
+class UploadScheduleError(StandardError):
+    pass
+
+
+def parse_rate(value):
+    # Bytes per second from value with optional k, M or G suffix - "512k", "10M"
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([kKmMgG]?)\s*$", value)
+    if match is None: raise UploadScheduleError("Invalid bandwidth value: %s" % (value))
+    multiplier = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}[match.group(2).lower()]
+    return int(float(match.group(1)) * multiplier)
+
+
+class TokenBucket(object):
+    def __init__(self, rate):
+        # rate in bytes per second. Up to one second of traffic can be sent in a burst.
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+
+    def consume(self, amount):
+        # Take amount tokens, and sleep until bucket is no longer in debt
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate
+        if wait > 0: time.sleep(wait)
+
+
+class _ThrottledBody(object):
+    # Wraps a request body (iterable of chunks), and spends tokens from all buckets for each chunk
+    def __init__(self, body, buckets, deadline):
+        self.body = body
+        self.buckets = buckets
+        self.deadline = deadline
+
+
+    def __len__(self):
+        return len(self.body)
+
+
+    def __iter__(self):
+        for chunk in self.body:
+            if time.time() > self.deadline: raise UploadScheduleError("Upload deadline passed")
+            for bucket in self.buckets: bucket.consume(len(chunk))
+            yield chunk
+
+
+class UploadScheduler(object):
+    def __init__(self, history=None, global_rate=None, site_rates=None, retries=RETRIES, backoff=BACKOFF, deadline=DEADLINE):
+        self.history = history
+        self.retries = retries
+        self.backoff = backoff
+        self.deadline = deadline
+        self.global_bucket = None
+        if global_rate: self.global_bucket = TokenBucket(global_rate)
+        self.site_buckets = {}
+        for site, rate in (site_rates or {}).items(): self.site_buckets[site] = TokenBucket(rate)
+        self.device_buckets = {}
+        self.lock = threading.Lock()
+        self.slots = None  # Semaphore limiting concurrent uploads - set by plan_waves()
+
+
+    def _buckets(self, device):
+        buckets = []
+        if self.global_bucket is not None: buckets.append(self.global_bucket)
+        site = device.options.get("site")
+        if site in self.site_buckets: buckets.append(self.site_buckets[site])
+        rate = device.options.get("bandwidth")
+        if rate:
+            with self.lock:
+                if device.hostname not in self.device_buckets: self.device_buckets[device.hostname] = TokenBucket(parse_rate(rate))
+                buckets.append(self.device_buckets[device.hostname])
+        return buckets
+
+
+    def throttle(self, device, body, deadline):
+        buckets = self._buckets(device)
+        if not buckets and deadline is None: return body
+        if deadline is None: deadline = float("inf")
+        return _ThrottledBody(body, buckets, deadline)
+
+
+    def throughput(self, device, key="throughput"):
+        # Median measured upload throughput (bytes/s) for device from earlier runs, or None
+        if self.history is None: return None
+        return self.history.median(device.hostname, key)
+
+
+    def order(self, devices):
+        # Devices ordered slowest first by measured throughput, so the longest uploads start first.
+        # Devices without measurements are treated as the slowest.
+        def key(item):
+            throughput = self.throughput(item[1])
+            if throughput is None: return (0, 0, item[0])
+            return (1, throughput, item[0])
+        return [device for index, device in sorted(enumerate(devices), key=key)]
+
+
+    def plan_waves(self, devices, parallel):
+        # Number of uploads to run at the same time. With a global bandwidth cap, this is the number of devices
+        # with median measured throughput that fit within the cap - more would only share the same bandwidth.
+        slots = parallel
+        if self.global_bucket is not None:
+            measured = sorted(filter(None, [self.throughput(device) for device in devices]))
+            if measured:
+                median = measured[len(measured) // 2]
+                slots = max(1, min(parallel, int(self.global_bucket.rate // median) or 1))
+        self.slots = threading.Semaphore(slots)
+        logging.info("Upload scheduler: up to %s uploads at the same time" % (slots))
+        return slots
+
+
+    def run(self, device, upload, size, key="throughput"):
+        # Run upload(deadline) with retries and backoff. upload must raise UploadError-like exception on failure.
+        # Throughput is recorded in history under key.
+        # Retries are not resumable - each one sends the whole file again, and spends bandwidth tokens again. A retry
+        # is not started when it is not expected to finish by the deadline: the whole file at measured throughput,
+        # and never less time than the failed attempt used.
+        deadline = time.time() + self.deadline
+        delay = self.backoff
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                if self.slots is not None: self.slots.acquire()
+                try:
+                    start = time.time()
+                    upload(deadline)
+                finally:
+                    if self.slots is not None: self.slots.release()
+            except StandardError as e:
+                expected = time.time() - start
+                throughput = self.throughput(device, key)
+                if throughput: expected = max(expected, float(size) / throughput)
+                if attempt > self.retries or time.time() + delay + expected > deadline:
+                    raise UploadScheduleError("Upload to %s failed after %s attempts: %s" % (device.name, attempt, e))
+                logging.warning("Upload attempt %s to %s failed: %s. Retrying in %s seconds" % (attempt, device.name, e, delay))
+                time.sleep(delay)
+                delay *= 2
+                continue
+            elapsed = max(time.time() - start, 0.001)
+            throughput = size / elapsed
+            logging.info("Uploaded %s bytes to %s in %.1f seconds (%.0f bytes/s)" % (size, device.name, elapsed, throughput))
+            if self.history is not None: self.history.record(device.hostname, key, throughput, device.model)
+            return throughput
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+#Copyright (c) 2016 Data Equipment AS
+#Author: Tor Mogstad <torm _AT_ dataequipment.no>
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+""" Module for validating content files before upload
+
+ContentValidator - checks that a content file is a readable archive, that its
+name has the content type prefix and version fields, and that its size is sane
+compared with earlier files of the same type. Results are cached by sha256 in a
+JSON file, so each file is only checked once, however many devices and runs use
+it. A file that fails while it may still be being written (changed within the
+settle time) is not cached as invalid, and is checked again next time.
+"""
+from os import path
+import os
+import json
+import logging
+import threading
+import time
+from contentindex import parse_version
+
+
+MIN_SIZE = 1024  # Smallest content file accepted, in bytes
+MIN_SIZE_RATIO = 0.5  # Smallest accepted size compared with median of earlier files of the same type
+READ_BLOCKSIZE = 1024 * 1024
+SETTLE = 10  # Seconds after last change before a failed file is cached as invalid. Same default as --settle
+
+
+class ValidationError(StandardError):
+    pass
+
+
+def check_archive(filepath):
+    # Raises ValidationError unless file is a tar archive (gzip compressed or not) with at least one member.
+    # A gzip file is read to the end first, so a truncated or corrupt file fails the CRC or length check.
+    # Archive modules are imported here, as files are normally found valid in the cache.
+    import gzip
+    import zlib
+    import struct
+    import tarfile
+    try:
+        with open(filepath, "rb") as f:
+            compressed = f.read(2) == "\x1f\x8b"
+        if compressed:
+            with gzip.open(filepath, "rb") as f:
+                while f.read(READ_BLOCKSIZE): pass
+        with tarfile.open(filepath, "r:*") as archive:
+            if archive.next() is None: raise ValidationError("Archive %s is empty" % (path.basename(filepath)))
+    except (IOError, EOFError, zlib.error, struct.error, tarfile.TarError) as e:
+        raise ValidationError("Archive %s can't be read: %s" % (path.basename(filepath), e))
+
+
+def check_name(folder, name):
+    # File name must be <folder name>-<major>-<minor>, as the version is read from it
+    prefix = path.basename(path.normpath(folder)) + "-"
+    if not name.startswith(prefix): raise ValidationError("%s doesn't start with %s" % (name, prefix))
+    if parse_version(name) is None: raise ValidationError("%s doesn't have version fields <major>-<minor> after %s" % (name, prefix))
+
+
+def check_size(name, size, earlier_sizes):
+    if size < MIN_SIZE: raise ValidationError("%s is only %s bytes" % (name, size))
+    if earlier_sizes:
+        earlier_sizes = sorted(earlier_sizes)
+        median = earlier_sizes[len(earlier_sizes) // 2]
+        if size < median * MIN_SIZE_RATIO:
+            raise ValidationError("%s is %s bytes, less than %s%% of earlier files (median %s bytes)" % (name, size, int(MIN_SIZE_RATIO * 100), median))
+
+
+class ContentValidator(object):
+    def __init__(self, filename, settle=SETTLE):
+        self.filename = filename
+        self.settle = settle
+        self.lock = threading.Lock()
+        self.results = {}  # sha256 -> {"file", "valid", "error", "time"}
+        if path.exists(filename):
+            try:
+                with open(filename, "r") as f:
+                    self.results = json.load(f)
+            except (IOError, ValueError) as e:
+                logging.warning("Unable to read validation cache %s. Files are validated again. %s" % (filename, e))
+
+
+    def validate(self, folder, name, digest, earlier_sizes=()):
+        # Raises ValidationError if file is not valid. earlier_sizes - sizes of older files of the same content type.
+        # Name is checked every time, as a file with the same content can be copied under another name.
+        check_name(folder, name)
+        with self.lock:
+            result = self.results.get(digest)
+        if result is None:
+            filepath = path.join(folder, name)
+            start = time.time()
+            result = {"file": name, "valid": True, "error": None, "time": time.time()}
+            settled = True
+            try:
+                settled = time.time() - os.path.getmtime(filepath) >= self.settle
+                check_size(name, os.path.getsize(filepath), earlier_sizes)
+                check_archive(filepath)
+            except (ValidationError, OSError) as e:
+                result.update(valid=False, error=str(e))
+            logging.info("Validated %s in %.2f seconds: %s" % (name, time.time() - start, result["error"] or "OK"))
+            if result["valid"] or settled:
+                with self.lock:
+                    self.results[digest] = result
+        if not result["valid"]: raise ValidationError(result["error"])
+
+
+    def save(self):
+        # Write to temporary file first, so an interrupted run never leaves a half written cache
+        with self.lock:
+            content = json.dumps(self.results, indent=1, sort_keys=True)
+        tmpfile = "%s.tmp" % (self.filename)
+        with open(tmpfile, "w") as f:
+            f.write(content)
+        os.rename(tmpfile, self.filename)
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+#Copyright (c) 2016 Data Equipment AS
+#Author: Tor Mogstad <torm _AT_ dataequipment.no>
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+
+""" Module for daemon mode
+
+DirectoryWatcher - waits for changes in the content folders. Uses inotify when
+available, and polls the folders otherwise. Changes that arrive in bursts are
+reported once, when the folders have been quiet for a few seconds.
+StatusServer - small HTTP server on localhost. GET /status returns daemon status
+as JSON, and POST /trigger starts a rollout of the newest files.
+"""
+from os import path
+import os
+import json
+import errno
+import select
+import struct
+import logging
+import threading
+import time
+
+
+SETTLE = 10  # Seconds without changes in folders before changes are reported
+POLL_INTERVAL = 5  # Seconds between scans of folders not watched by inotify
+
+# inotify constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+# IN_MODIFY keeps the folder from settling while a file is being written
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_MOVE_SELF
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len - followed by len bytes of file name
+
+
+def _snapshot(directory):
+    # Size and mtime of files in folder, or None if folder does not exist
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return None
+    files = {}
+    for name in names:
+        try:
+            stat = os.stat(path.join(directory, name))
+        except OSError:
+            continue
+        files[name] = (stat.st_size, stat.st_mtime)
+    return files
+
+
+class DirectoryWatcher(object):
+    def __init__(self, directories, settle=SETTLE, poll_interval=POLL_INTERVAL, use_inotify=True):
+        self.directories = list(directories)
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self.libc = None
+        self.fd = None
+        self.watches = {}  # inotify watch descriptor -> folder
+        self.snapshots = {}  # Folder -> files, for folders that are polled
+        # wake() writes to pipe to end a wait
+        self.wake_read, self.wake_write = os.pipe()
+        if use_inotify: self._init_inotify()
+        for directory in self.directories:
+            self.snapshots[directory] = _snapshot(directory)
+            self._add_watch(directory)
+        if self.fd is None: logging.info("Polling content folders every %s seconds" % (self.poll_interval))
+
+
+    def _init_inotify(self):
+        # ctypes and BaseHTTPServer are imported when used, as this module is loaded on every run, not only in daemon mode
+        import ctypes
+        import ctypes.util
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            logging.warning("inotify not available: %s" % (e))
+            return
+        if fd < 0:
+            logging.warning("inotify not available: %s" % (os.strerror(ctypes.get_errno())))
+            return
+        self.libc = libc
+        self.fd = fd
+
+
+    def _add_watch(self, directory):
+        if self.fd is None or self.watching(directory) or not path.isdir(directory): return False
+        wd = self.libc.inotify_add_watch(self.fd, directory, WATCH_MASK)
+        if wd < 0:
+            import ctypes
+            logging.warning("Unable to watch %s: %s. Folder is polled" % (directory, os.strerror(ctypes.get_errno())))
+            return False
+        self.watches[wd] = directory
+        logging.debug("Watching %s with inotify" % (directory))
+        return True
+
+
+    def watching(self, directory):
+        return directory in self.watches.values()
+
+
+    def wake(self):
+        # Ends a wait() in another thread
+        os.write(self.wake_write, "x")
+
+
+    def wait(self, timeout=None):
+        # Blocks until files in the folders change, and no more changes are seen for settle seconds.
+        # Returns changed folders. Returns an empty list on timeout. When woken, changes seen so far are returned.
+        changed = set()
+        quiet_until = None
+        deadline = None
+        if timeout is not None: deadline = time.time() + timeout
+        while True:
+            now = time.time()
+            if quiet_until is not None:
+                if now >= quiet_until: return sorted(changed)
+                waittime = quiet_until - now
+            elif deadline is not None:
+                if now >= deadline: return []
+                waittime = deadline - now
+            else: waittime = None
+            if len(self.watches) < len(self.directories):
+                if waittime is None: waittime = self.poll_interval
+                else: waittime = min(waittime, self.poll_interval)
+            woken, found = self._select(waittime)
+            if found:
+                changed.update(found)
+                quiet_until = time.time() + self.settle
+            if woken: return sorted(changed)
+
+
+    def _select(self, waittime):
+        readers = [self.wake_read]
+        if self.fd is not None: readers.append(self.fd)
+        try:
+            ready = select.select(readers, [], [], waittime)[0]
+        except select.error as e:
+            if e.args[0] != errno.EINTR: raise
+            ready = []
+        woken = self.wake_read in ready
+        if woken: os.read(self.wake_read, 1024)
+        found = set()
+        if self.fd is not None and self.fd in ready: found.update(self._read_events())
+        found.update(self._poll())
+        return woken, found
+
+
+    def _read_events(self):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN: return set()
+            raise
+        found = set()
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost. Report all folders as changed
+                found.update(self.directories)
+                continue
+            directory = self.watches.get(wd)
+            if directory is None: continue
+            found.add(directory)
+            if mask & IN_MOVE_SELF: self.libc.inotify_rm_watch(self.fd, wd)
+            if mask & IN_IGNORED:
+                # Folder removed or moved. Polled until it is back
+                del self.watches[wd]
+                self.snapshots[directory] = _snapshot(directory)
+                logging.warning("Content folder %s removed or moved" % (directory))
+        return found
+
+
+    def _poll(self):
+        # Folders not watched by inotify are compared with last snapshot
+        found = set()
+        for directory in self.directories:
+            if self.watching(directory): continue
+            snapshot = _snapshot(directory)
+            if snapshot != self.snapshots.get(directory):
+                found.add(directory)
+                self.snapshots[directory] = snapshot
+            if snapshot is not None: self._add_watch(directory)
+        return found
+
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        os.close(self.wake_read)
+        os.close(self.wake_write)
+
+
+class _StatusHandler:
+    # Request handler methods, combined with BaseHTTPRequestHandler when the server is created
+    def do_GET(self):
+        if self.path.split('?')[0] != "/status": return self._reply(404, {"error": "Not found"})
+        self._reply(200, self.server.status())
+
+
+    def do_POST(self):
+        if self.path.split('?')[0] != "/trigger": return self._reply(404, {"error": "Not found"})
+        self.server.trigger()
+        self._reply(202, {"triggered": True})
+
+
+    def _reply(self, code, content):
+        body = json.dumps(content, indent=1, sort_keys=True)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        logging.debug("Status server: %s - %s" % (self.client_address[0], format % args))
+
+
+class StatusServer(object):
+    def __init__(self, address, port, status, trigger):
+        # status - returns dict with daemon status. trigger - called to start a rollout
+        from BaseHTTPServer import BaseHTTPRequestHandler
+        from BaseHTTPServer import HTTPServer
+        class StatusHandler(_StatusHandler, BaseHTTPRequestHandler): pass
+        self.server = HTTPServer((address, port), StatusHandler)
+        self.server.status = status
+        self.server.trigger = trigger
+        self.address, self.port = self.server.server_address[:2]
+        self.thread = None
+
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="StatusServer")
+        self.thread.daemon = True
+        self.thread.start()
+        logging.info("Status server listening on http://%s:%s/status" % (self.address, self.port))
+
+
+    def stop(self):
+        if self.thread is not None:
+            self.server.shutdown()
+            self.thread.join()
+        self.server.server_close()